@@ -0,0 +1,489 @@
+'''
+Benchmarks for performance-sensitive parts of the app. Like generate_saml_metadata.py, these should be run inside the flask-app container, e.g.:
+    python benchmark.py encryption --rows 100000 --workers 4
+    python benchmark.py saml-settings
+    python benchmark.py authorize-url
+    python benchmark.py serialize --rows 100000
+    python benchmark.py startup
+    python benchmark.py flow --users 500 --concurrency 20
+    python benchmark.py harvest --rows 1000
+    python benchmark.py push --rows 200 --works 50
+    python benchmark.py flow --users 500 --concurrency 20 --server "-c gunicorn.conf.py"
+    python benchmark.py flow --users 1000 --concurrency 100 --server "-c gunicorn.conf.py" --rate-limits '{"views.index": {"rate": 20, "burst": 20, "concurrency": 4, "methods": ["POST"]}}'
+The serialize, flow, harvest and push benchmarks write to the database, so the POSTGRES_* environment variables should point to a throwaway database. Use --save to record the results as JSON, and --compare to report regressions against a saved run.
+'''
+import argparse
+import json
+import math
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from cryptography.fernet import Fernet
+import requests
+from tests.helpers import seed_tokens, delete_tokens, start_stub, FakeIdp
+
+# Results of the current run, by label, as (value, unit, higher_is_better)
+results = {}
+
+def report(label, count, elapsed, unit='values'):
+    print(f'{label}: {count} {unit} in {elapsed:.3f}s ({count / elapsed:,.0f} {unit}/s)')
+    results[label] = (count / elapsed, f'{unit}/s', True)
+
+def record(label, value, unit, higher_is_better=False):
+    '''
+    Records a result other than a throughput (e.g., a latency or memory use)
+    '''
+    results[label] = (value, unit, higher_is_better)
+
+def percentile(values, p):
+    '''
+    Returns the p-th percentile (nearest rank) of a non-empty list of values
+    '''
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+def compare(baseline_file, tolerance):
+    '''
+    Prints the results that are worse than those in a file saved with --save by more than the tolerance (a fraction), and returns the number of such regressions
+    '''
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    regressions = 0
+    for label, (value, unit, higher_is_better) in results.items():
+        if label not in baseline or not baseline[label][0]:
+            continue
+        change = (value - baseline[label][0]) / baseline[label][0]
+        if (-change if higher_is_better else change) > tolerance:
+            regressions += 1
+            print(f'REGRESSION {label}: {baseline[label][0]:,.4g} -> {value:,.4g} {unit} ({change:+.0%})')
+    return regressions
+
+def benchmark_encryption(args):
+    '''
+    Compares per-row and batched decryption throughput for EncryptedValue columns.
+    '''
+    from orcidflask.models import get_cipher, fernet_decrypt_many
+    key = Fernet.generate_key()
+    # ORCID access and refresh tokens are UUIDs
+    values = [get_cipher([key]).encrypt(f'{i:036d}'.encode()) for i in range(args.rows)]
+
+    # Per-row decryption with a new cipher for every value
+    start = time.perf_counter()
+    for value in values:
+        Fernet(key).decrypt(value).decode()
+    report('per-row, new cipher', len(values), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for value in values:
+        get_cipher([key]).decrypt(value).decode()
+    report('per-row, cached cipher', len(values), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    fernet_decrypt_many(values, keys=[key])
+    report('batched', len(values), time.perf_counter() - start)
+
+    # Encryption and decryption as done by the Token model's columns, using the app's key
+    from orcidflask import create_app
+    from orcidflask.models import EncryptedValue
+    column_type = EncryptedValue()
+    plaintexts = [f'{i:036d}' for i in range(args.rows)]
+    with create_app().app_context():
+        start = time.perf_counter()
+        encrypted = [column_type.process_bind_param(value, None) for value in plaintexts]
+        report('EncryptedValue encrypt', len(encrypted), time.perf_counter() - start)
+        start = time.perf_counter()
+        for value in encrypted:
+            column_type.process_result_value(value, None)
+        report('EncryptedValue decrypt', len(encrypted), time.perf_counter() - start)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        # Start the worker processes before timing
+        fernet_decrypt_many(values[:args.workers], executor=executor, chunk_size=1, keys=[key])
+        start = time.perf_counter()
+        fernet_decrypt_many(values, executor=executor, keys=[key])
+        report(f'batched, {args.workers} processes', len(values), time.perf_counter() - start)
+
+def benchmark_saml_settings(args):
+    '''
+    Compares the per-request cost of setting up a python3-saml auth object (as done for every ACS, SLS and metadata request) with settings loaded from disk vs. cached settings.
+    '''
+    from onelogin.saml2.auth import OneLogin_Saml2_Auth
+    from saml_utils import get_saml_settings
+    request_data = {'https': 'on', 'http_host': 'localhost', 'server_port': None, 'script_name': '/',
+                    'get_data': {'acs': ''}, 'post_data': {}, 'lowercase_urlencoding': True}
+
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        OneLogin_Saml2_Auth(request_data, custom_base_path=args.saml_path).get_settings().get_sp_key()
+    report('settings loaded per request', args.requests, time.perf_counter() - start, 'requests')
+
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        OneLogin_Saml2_Auth(request_data, old_settings=get_saml_settings(args.saml_path)).get_settings().get_sp_key()
+    report('cached settings', args.requests, time.perf_counter() - start, 'requests')
+
+def benchmark_authorize_url(args):
+    '''
+    Compares building the ORCID authorization URL with str.format and url_for on every request (as the orcid_login view used to) with AuthorizeUrlBuilder. (The encoding of the URL is checked by tests/test_authorize_url.py.)
+    '''
+    from flask import url_for
+    from orcidflask import create_app
+    from orcid_utils import extract_saml_user_data
+    app = create_app()
+    builder = app.config['orcid_authorize_url']
+    session = {'samlUserdata': {'firstname': ['Jane'], 'lastname': ['Doe'], 'emailaddress': ['jdoe@example.edu']}}
+    scopes = '/read-limited /activities/update'
+    template = app.config['orcid_token_url'].replace('/token', '/authorize') + '?client_id={orcid_client_id}&response_type=code&scope={scopes}&redirect_uri={redirect_uri}&family_names={lastname}&given_names={firstname}&email={emailaddress}'
+    with app.test_request_context(base_url=f'https://{app.config["SERVER_NAME"]}'):
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            template.format(orcid_client_id=app.config['CLIENT_ID'], scopes=scopes,
+                            redirect_uri=url_for('views.orcid_redirect', _scheme='https', _external=True),
+                            **extract_saml_user_data(session))
+        report('str.format and url_for', args.requests, time.perf_counter() - start, 'urls')
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            builder.build(scopes, **extract_saml_user_data(session))
+        report('AuthorizeUrlBuilder', args.requests, time.perf_counter() - start, 'urls')
+
+def benchmark_serialize(args):
+    '''
+    Measures the time and peak memory use of the serialize-db command, run as a separate process (as it would be in the container), over a table with the provided number of tokens.
+    '''
+    from orcidflask import create_app
+    from orcidflask.models import Token
+    app = create_app()
+    prefix = f'benchmark-{uuid.uuid4().hex[:8]}-'
+    with app.app_context():
+        seed_tokens(args.rows, prefix)
+        total = Token.query.count()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for label, options in (('serialize-db', []), ('serialize-db --jsonl', ['--jsonl']),
+                                   (f'serialize-db --jsonl --workers {args.workers}', ['--jsonl', '--workers', str(args.workers)])):
+                start = time.perf_counter()
+                process = subprocess.Popen([sys.executable, '-m', 'flask', 'serialize-db', os.path.join(tmp, 'dump.json'), *options],
+                                           stdout=subprocess.DEVNULL, env={**os.environ, 'FLASK_APP': 'orcidflask'})
+                # wait4 returns the resource usage of this process alone; ru_maxrss is in KiB on Linux
+                _, status, usage = os.wait4(process.pid, 0)
+                process.returncode = os.waitstatus_to_exitcode(status)
+                if process.returncode:
+                    raise subprocess.CalledProcessError(process.returncode, process.args)
+                report(label, total, time.perf_counter() - start, 'tokens')
+                print(f'{label}: peak memory {usage.ru_maxrss / 1024:,.1f} MiB')
+                record(f'{label} peak memory', usage.ru_maxrss / 1024, 'MiB')
+    finally:
+        with app.app_context():
+            delete_tokens(prefix)
+
+# Entry points for the startup benchmark: (label, Python statement to time, or flask command to run)
+ENTRY_POINTS = (('import orcidflask', 'import orcidflask', None),
+                ('create_app()', 'import orcidflask; orcidflask.create_app()', None),
+                ('web (gunicorn)', 'import web', None),
+                ('flask create-secret-key', None, ['create-secret-key', os.path.join(tempfile.gettempdir(), 'benchmark-startup.key')]),
+                ('flask serialize-db --help', None, ['serialize-db', '--help']))
+
+# Reports the time taken by a statement in a new interpreter, and whether it loaded the SAML libraries
+STARTUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+exec(sys.argv[1])
+print(time.perf_counter() - start, 'onelogin.saml2.auth' in sys.modules, 'xmlsec' in sys.modules)
+'''
+
+def benchmark_startup(args):
+    '''
+    Measures the time to import or start each entry point (the web app, and flask commands), each in a new process, and whether it loads the SAML libraries (python3-saml and xmlsec).
+    For Python statements, the time excludes starting the interpreter; for flask commands, it is the time for the whole command.
+    '''
+    env = {**os.environ, 'FLASK_APP': 'orcidflask'}
+    for label, statement, command in ENTRY_POINTS:
+        times = []
+        for _ in range(args.repeat):
+            if statement:
+                output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, statement], check=True, env=env,
+                                        capture_output=True, text=True).stdout.split()
+                times.append(float(output[0]))
+                saml_loaded = output[1] == 'True' or output[2] == 'True'
+            else:
+                start = time.perf_counter()
+                subprocess.run([sys.executable, '-m', 'flask', *command], check=True, env=env, stdout=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+        if command:
+            # Python's import profiler lists every module imported by the command
+            imports = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'flask', *command], check=True, env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+            saml_loaded = 'onelogin.saml2' in imports or 'xmlsec' in imports
+        elapsed = percentile(times, 50)
+        print(f'{label}: {elapsed * 1000:.0f}ms (median of {args.repeat}); SAML libraries loaded: {saml_loaded}')
+        record(f'startup {label}', elapsed * 1000, 'ms')
+
+class TestClientUser:
+    '''
+    A simulated user making requests through Flask's test client, in this process
+    '''
+    def __init__(self, app, base_url):
+        self.client = app.test_client()
+        self.base_url = base_url
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, base_url=self.base_url, data=data)
+        return response.status_code, response.location
+
+class HttpUser:
+    '''
+    A simulated user making requests over HTTP to a server on this host, keeping its own session cookie (the app's cookie is scoped to SERVER_NAME, not to the server's address)
+    '''
+    def __init__(self, server_url, server_name):
+        self.http = requests.Session()
+        self.server_url = server_url
+        self.server_name = server_name
+        self.cookie = None
+
+    def request(self, method, path, data=None):
+        # As set by the proxy in front of the app; gunicorn trusts it from 127.0.0.1
+        headers = {'Host': self.server_name, 'X-Forwarded-Proto': 'https'}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        response = self.http.request(method, self.server_url + path, data=data, headers=headers, allow_redirects=False)
+        if 'session' in response.cookies:
+            self.cookie = f'session={response.cookies["session"]}'
+        return response.status_code, response.headers.get('Location')
+
+def benchmark_harvest(args):
+    '''
+    Runs the harvest of ORCID records (see the harvest-records command) for the provided number of tokens against the stub ORCID API, three times: with an empty cache, with every record unchanged (so each is revalidated with a 304), and after every record has changed.
+    '''
+    from orcidflask import create_app
+    from orcidflask.harvest import harvest_records
+    app = create_app()
+    stub, stub_url = start_stub(args.orcid_delay)
+    app.config['orcid_api_url'] = stub_url + '/v3.0'
+    prefix = f'benchmark-{uuid.uuid4().hex[:8]}-'
+    orcids = [f'0000-0000-{i:09d}' for i in range(args.rows)]
+    with app.app_context():
+        seed_tokens(args.rows, prefix)
+    try:
+        with tempfile.TemporaryDirectory() as tmp, app.app_context():
+            for label, version in (('empty cache', 1), ('unchanged', 1), ('changed', 2)):
+                stub.version = version
+                with open(os.path.join(tmp, 'records.jsonl'), 'w') as output:
+                    start = time.perf_counter()
+                    outcomes = harvest_records(output, os.path.join(tmp, 'cache'), orcids=orcids, workers=args.workers, rate=args.rate, log=lambda message: None)
+                    elapsed = time.perf_counter() - start
+                print(f'{label}: ' + ', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()))
+                report(f'harvest, {label}', sum(outcomes.values()), elapsed, 'records')
+    finally:
+        stub.shutdown()
+        with app.app_context():
+            delete_tokens(prefix)
+
+def benchmark_push(args):
+    '''
+    Pushes a feed of works (args.works per researcher, for args.rows researchers) to the stub ORCID API three times (see the push-works command): to empty records, unchanged, and with every other work changed. Reports the throughput of each run and the number of requests made to ORCID.
+    '''
+    import io
+    from orcidflask import create_app
+    from orcidflask.push import push_works
+    app = create_app()
+    stub, stub_url = start_stub(args.orcid_delay)
+    app.config['orcid_api_url'] = stub_url + '/v3.0'
+    prefix = f'benchmark-{uuid.uuid4().hex[:8]}-'
+
+    def feed(revision):
+        lines = []
+        for i in range(args.rows):
+            for j in range(args.works):
+                title = f'Benchmark work {j}' + (f' (revision {revision})' if j % 2 else '')
+                work = {'title': {'title': {'value': title}}, 'type': 'journal-article',
+                        'external-ids': {'external-id': [{'external-id-type': 'doi', 'external-id-value': f'10.1234/{i}.{j}', 'external-id-relationship': 'self'}]}}
+                lines.append(json.dumps({'orcid': f'0000-0000-{i:09d}', 'key': f'10.1234/{i}.{j}', 'work': work}) + '\n')
+        return io.StringIO(''.join(lines))
+
+    with app.app_context():
+        seed_tokens(args.rows, prefix, scope='/read-limited /activities/update')
+    try:
+        with tempfile.TemporaryDirectory() as tmp, app.app_context():
+            for label, revision in (('new works', 1), ('unchanged', 1), ('half changed', 2)):
+                stub.requests.clear()
+                start = time.perf_counter()
+                outcomes = push_works(feed(revision), os.path.join(tmp, 'index.sqlite'), workers=args.workers, rate=args.rate, log=lambda message: None)
+                elapsed = time.perf_counter() - start
+                print(f'{label}: ' + ', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()) +
+                      f'; requests to ORCID: ' + (', '.join(f'{method} {count}' for method, count in stub.requests.items()) or 'none'))
+                report(f'push, {label}', sum(outcomes.values()), elapsed, 'works')
+    finally:
+        stub.shutdown()
+        with app.app_context():
+            delete_tokens(prefix)
+
+def start_server(args, saml_path, orcid_base_url):
+    '''
+    Starts gunicorn with the provided options (args.server), using a copy of the app's settings that trusts the fake IdP and uses the stub ORCID server. Returns the process and its URL.
+    '''
+    tmp = tempfile.mkdtemp()
+    config = os.path.join(tmp, 'config.py')
+    with open(config, 'w') as f:
+        f.write(f'exec(open({os.environ["ORCIDFLASK_SETTINGS"]!r}).read())\n'
+                f'SAML_PATH = {saml_path!r}\n'
+                f'ORCID_BASE_URL = {orcid_base_url!r}\n'
+                f'ADMISSION_STATE_FILE = {os.path.join(tmp, "admission")!r}\n')
+        if args.rate_limits is not None:
+            f.write(f'RATE_LIMITS = {json.loads(args.rate_limits)!r}\n')
+    metrics_dir = os.path.join(tmp, 'metrics')
+    os.mkdir(metrics_dir)
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    env = {**os.environ, 'ORCIDFLASK_SETTINGS': config, 'PROMETHEUS_MULTIPROC_DIR': metrics_dir}
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', *shlex.split(args.server), '--bind', f'127.0.0.1:{port}', 'web:app'], env=env)
+    server_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(server_url + '/metadata/', timeout=1)
+            break
+        except requests.exceptions.ConnectionError:
+            if process.poll() is not None:
+                raise RuntimeError(f'gunicorn exited with status {process.returncode}')
+            time.sleep(0.2)
+    return process, server_url
+
+def benchmark_flow(args):
+    '''
+    Drives the full login flow (/?sso, the ACS, /orcid and /orcid-redirect) for many simulated users at once, against a fake IdP and a stub ORCID token endpoint, and reports the latency percentiles and throughput of each stage.
+    By default, requests are made through Flask's test client, in this process, so the results cover the app's own work (including the database and the calls to ORCID) but not the WSGI server. With --server, the app is run under gunicorn with the provided options, and requests are made over HTTP.
+    '''
+    from orcidflask import create_app
+    app = create_app()
+    stub, orcid_base_url = start_stub(args.orcid_delay)
+    idp = FakeIdp(app.config['SAML_PATH'])
+    if args.server:
+        server, server_url = start_server(args, idp.saml_path, orcid_base_url)
+        new_user = lambda: HttpUser(server_url, app.config['SERVER_NAME'])
+    else:
+        server = None
+        app.config['orcid_token_url'] = orcid_base_url + '/oauth/token'
+        app.config['SAML_PATH'] = idp.saml_path
+        if args.rate_limits is not None:
+            app.config['RATE_LIMITS'] = json.loads(args.rate_limits)
+        new_user = lambda: TestClientUser(app, f'https://{app.config["SERVER_NAME"]}')
+    prefix = f'benchmark-{uuid.uuid4().hex[:8]}-'
+    stages = ('sso', 'acs', 'orcid', 'orcid-redirect')
+    timings = {stage: [] for stage in stages}
+    # Times of the requests turned away by admission control (see RATE_LIMITS)
+    shed = {stage: [] for stage in stages}
+    failures = {stage: 0 for stage in stages}
+    lock = threading.Lock()
+
+    def timed_request(stage, user, method, path, data=None):
+        start = time.perf_counter()
+        status, location = user.request(method, path, data=data)
+        elapsed = time.perf_counter() - start
+        with lock:
+            if status == 503:
+                shed[stage].append(elapsed)
+            else:
+                timings[stage].append(elapsed)
+                if status != 302:
+                    failures[stage] += 1
+        return status, location or ''
+
+    def simulate_user(i):
+        user = new_user()
+        _, location = timed_request('sso', user, 'GET', '/?sso')
+        relay_state = parse_qs(urlparse(location).query).get('RelayState', [''])[0]
+        # The IdP's work is not part of the measurements
+        saml_response = idp.response(f'{prefix}{i}', {'firstname': 'Benchmark', 'lastname': f'User {i}', 'emailaddress': f'user{i}@example.org'})
+        status, location = timed_request('acs', user, 'POST', '/?acs', data={'SAMLResponse': saml_response, 'RelayState': relay_state})
+        # A user turned away would come back later; the simulated one gives up
+        if status == 503:
+            return
+        orcid_url = urlparse(location)
+        timed_request('orcid', user, 'GET', f'{orcid_url.path}?{orcid_url.query}')
+        # ORCID would redirect the user back with a code; the stub returns the code as the user's ORCID iD
+        timed_request('orcid-redirect', user, 'GET', f'/orcid-redirect?code=0000-0000-{i:09d}')
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(simulate_user, range(args.users)))
+        elapsed = time.perf_counter() - start
+        for stage in stages:
+            if not timings[stage]:
+                print(f'{stage}: no requests admitted; {len(shed[stage])} turned away')
+                continue
+            p50, p95, p99 = (percentile(timings[stage], p) * 1000 for p in (50, 95, 99))
+            print(f'{stage}: p50 {p50:.1f}ms; p95 {p95:.1f}ms; p99 {p99:.1f}ms; {len(timings[stage]) / elapsed:,.1f} requests/s; {failures[stage]} failed' +
+                  (f'; {len(shed[stage])} turned away (p99 {percentile(shed[stage], 99) * 1000:.1f}ms)' if shed[stage] else ''))
+            for p, value in (('p50', p50), ('p95', p95), ('p99', p99)):
+                record(f'flow {stage} {p}', value, 'ms')
+        completed = len(timings['orcid-redirect']) - failures['orcid-redirect']
+        report(f'flow, {args.concurrency} concurrent users', completed, elapsed, 'logins')
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        stub.shutdown()
+        with app.app_context():
+            delete_tokens(prefix)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run micro-benchmarks.')
+    subparsers = parser.add_subparsers(required=True)
+    encryption = subparsers.add_parser('encryption', help='Throughput of per-row vs. batched token decryption')
+    encryption.add_argument('--rows', type=int, default=100000)
+    encryption.add_argument('--workers', type=int, default=4)
+    encryption.set_defaults(func=benchmark_encryption)
+    saml_settings = subparsers.add_parser('saml-settings', help='Per-request SAML setup with and without cached settings')
+    saml_settings.add_argument('--requests', type=int, default=1000)
+    saml_settings.add_argument('--saml-path', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'orcidflask/saml'))
+    saml_settings.set_defaults(func=benchmark_saml_settings)
+    authorize_url = subparsers.add_parser('authorize-url', help='Building the ORCID authorization URL')
+    authorize_url.add_argument('--requests', type=int, default=100000)
+    authorize_url.set_defaults(func=benchmark_authorize_url)
+    serialize = subparsers.add_parser('serialize', help='Time and peak memory of serialize-db (writes to the database)')
+    serialize.add_argument('--rows', type=int, default=100000)
+    serialize.add_argument('--workers', type=int, default=4)
+    serialize.set_defaults(func=benchmark_serialize)
+    startup = subparsers.add_parser('startup', help='Import and startup time of each entry point')
+    startup.add_argument('--repeat', type=int, default=5)
+    startup.set_defaults(func=benchmark_startup)
+    flow = subparsers.add_parser('flow', help='Latency and throughput of the login flow with concurrent users (writes to the database)')
+    flow.add_argument('--users', type=int, default=500)
+    flow.add_argument('--concurrency', type=int, default=20)
+    flow.add_argument('--orcid-delay', type=float, default=0.1, help='Simulated latency of ORCID\'s token endpoint, in seconds')
+    flow.add_argument('--server', help='Run the app under gunicorn with these options (e.g., "-c gunicorn.conf.py") and make requests over HTTP')
+    flow.add_argument('--rate-limits', help='RATE_LIMITS setting for the app, as JSON (e.g., "{}" to turn admission control off)')
+    flow.set_defaults(func=benchmark_flow)
+    harvest = subparsers.add_parser('harvest', help='Harvest of ORCID records with cold and warm caches, against a stub ORCID API (writes to the database)')
+    harvest.add_argument('--rows', type=int, default=1000)
+    harvest.add_argument('--workers', type=int, default=8)
+    harvest.add_argument('--rate', type=float, default=1000.0, help='Maximum number of requests per second to the stub')
+    harvest.add_argument('--orcid-delay', type=float, default=0.05, help='Simulated latency of ORCID\'s API, in seconds')
+    harvest.set_defaults(func=benchmark_harvest)
+    push = subparsers.add_parser('push', help='Pushing works with the bulk endpoint and put-code index, against a stub ORCID API (writes to the database)')
+    push.add_argument('--rows', type=int, default=200, help='Number of researchers')
+    push.add_argument('--works', type=int, default=50, help='Number of works per researcher')
+    push.add_argument('--workers', type=int, default=8)
+    push.add_argument('--rate', type=float, default=1000.0, help='Maximum number of requests per second to the stub')
+    push.add_argument('--orcid-delay', type=float, default=0.05, help='Simulated latency of ORCID\'s API, in seconds')
+    push.set_defaults(func=benchmark_push)
+    for subparser in subparsers.choices.values():
+        subparser.add_argument('--save', help='Write the results to this JSON file')
+        subparser.add_argument('--compare', help='Report regressions against results saved with --save')
+        subparser.add_argument('--tolerance', type=float, default=0.2, help='Fraction by which a result may be worse than the saved one before it is reported as a regression')
+    args = parser.parse_args()
+    args.func(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare and compare(args.compare, args.tolerance):
+        sys.exit(1)
@@ -1,22 +1,29 @@
 import os
-from onelogin.saml2.settings import OneLogin_Saml2_Settings
+import argparse
+from saml_utils import load_saml_settings, render_sp_metadata
 
 saml_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'orcidflask/saml')
 
-def get_metadata():
-    settings = OneLogin_Saml2_Settings(custom_base_path=saml_path)
-    metadata = settings.get_sp_metadata()
-    errors = settings.validate_metadata(metadata)
+def get_metadata(path=saml_path):
+    settings = load_saml_settings(path)
+    metadata, errors = render_sp_metadata(settings)
     if len(errors) == 0:
         return metadata
     else:
         print(errors)
 
-def save_metadata():
-    metadata = get_metadata()
+def save_metadata(output=None, path=saml_path):
+    '''
+    Writes the SP metadata to the output file (by default, orcid-integration-metadata.xml in the SAML directory). The app can serve this file at /metadata/ if SAML_METADATA_FILE is set to its path.
+    '''
+    metadata = get_metadata(path)
     if metadata:
-        with open(saml_path + '/orcid-integration-metadata.xml', 'wb') as f:
+        with open(output or os.path.join(path, 'orcid-integration-metadata.xml'), 'wb') as f:
             f.write(metadata)
 
 if __name__ == '__main__':
-    save_metadata()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Generate the SAML SP metadata.')
+    parser.add_argument('--output', help='File to which to write the metadata (defaults to orcid-integration-metadata.xml in the SAML directory)')
+    parser.add_argument('--saml-path', default=saml_path, help='Directory containing settings.json')
+    args = parser.parse_args()
+    save_metadata(args.output, args.saml_path)
@@ -0,0 +1,67 @@
+'''
+Gunicorn settings for running the app in production (see the Dockerfile). Each setting can be overridden with an environment variable, e.g., in docker-compose.yml:
+    GUNICORN_WORKERS: number of worker processes (defaults to 2 x the number of CPU cores + 1)
+    GUNICORN_WORKER_CLASS: 'gthread' (the default), 'sync' or 'gevent' (requires the gevent and psycogreen packages)
+    GUNICORN_THREADS: number of threads per gthread worker
+    GUNICORN_PRELOAD: set to 'false' to load the app in each worker rather than once, before forking
+    GUNICORN_METRICS_DIR: directory in which the workers record their Prometheus metrics (defaults to /tmp/prometheus; see orcidflask/metrics.py)
+With gthread or gevent workers, make sure that SQLALCHEMY_ENGINE_OPTIONS allows each worker enough database connections (pool_size + max_overflow) for its threads or greenlets.
+'''
+import multiprocessing
+import os
+import shutil
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8080')
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 100))
+# Load the app (and parse the SAML settings) once in the master process, so that workers start quickly and share memory
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+# Restart workers now and then to limit the effects of memory leaks; the jitter keeps them from restarting at once
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', None)
+# Metrics are only shared through files by the web server's processes. The variable is set here, before the app is loaded, rather than in the image, so that flask commands (and their worker processes) keep their metrics in memory instead of adding files that /metrics would report.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.getenv('GUNICORN_METRICS_DIR', '/tmp/prometheus'))
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+def on_starting(server):
+    '''
+    Clears the Prometheus metrics left by a previous run (see orcidflask/metrics.py)
+    '''
+    metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            path = os.path.join(metrics_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+def post_fork(server, worker):
+    '''
+    With preload_app, the workers inherit the master's database connection pool. Connections must not be shared between processes, so each worker starts with a new pool, leaving the inherited connections for the master to close.
+    '''
+    if worker_class == 'gevent':
+        # Makes psycopg2 yield to other greenlets while waiting on the database
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    if preload_app:
+        from orcidflask import db
+        app = server.app.wsgi()
+        with app.app_context():
+            db.engine.dispose(close=False)
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+    # Free the requests a worker was handling when it exited (e.g., after a timeout), so that they no longer count towards the concurrency caps
+    if preload_app:
+        from orcidflask.admission import get_admission_controller
+        controller = get_admission_controller(server.app.wsgi())
+        if controller:
+            controller.release_process(worker.pid)
@@ -0,0 +1,24 @@
+"""Add index on token timestamp and id for incremental exports.
+
+Revision ID: 12a11535db12
+Revises: 648657faed74
+Create Date: 2026-10-17 16:05:47.118392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '12a11535db12'
+down_revision = '648657faed74'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_token_timestamp_id', 'token', ['timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_token_timestamp_id', table_name='token')
@@ -0,0 +1,25 @@
+"""Save ORCID's response on token_exchange until the token is stored.
+
+Revision ID: 5b8e1f0c9a27
+Revises: d2a02d9f1d80
+Create Date: 2026-10-17 21:14:09.518237
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b8e1f0c9a27'
+down_revision = 'd2a02d9f1d80'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Encrypted, like the code (see orcidflask.models.EncryptedValue)
+    op.add_column('token_exchange', sa.Column('response', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('token_exchange', 'response')
@@ -0,0 +1,30 @@
+"""Add saml_replay table for detecting replayed SAML responses.
+
+Revision ID: 648657faed74
+Revises: cc36a5e5b25c
+Create Date: 2026-10-17 14:12:05.302114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '648657faed74'
+down_revision = 'cc36a5e5b25c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('saml_replay',
+    sa.Column('id', sa.String(length=256), nullable=False),
+    sa.Column('expires', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_saml_replay_expires'), 'saml_replay', ['expires'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_saml_replay_expires'), table_name='saml_replay')
+    op.drop_table('saml_replay')
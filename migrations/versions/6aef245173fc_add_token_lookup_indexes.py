@@ -0,0 +1,26 @@
+"""Add indexes for token lookups by ORCID iD and user.
+
+Revision ID: 6aef245173fc
+Revises: ac9a61050c66
+Create Date: 2026-10-17 09:12:31.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6aef245173fc'
+down_revision = 'ac9a61050c66'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_token_orcid_timestamp', 'token', ['orcid', sa.text('"timestamp" DESC')], unique=False, postgresql_include=['id', 'expires_in'])
+    op.create_index('ix_token_userId_timestamp', 'token', ['userId', sa.text('"timestamp" DESC')], unique=False, postgresql_include=['id', 'expires_in'])
+
+
+def downgrade():
+    op.drop_index('ix_token_userId_timestamp', table_name='token')
+    op.drop_index('ix_token_orcid_timestamp', table_name='token')
@@ -0,0 +1,53 @@
+"""Add append-only audit_event table.
+
+Revision ID: a343d46edbf1
+Revises: 12a11535db12
+Create Date: 2026-10-17 18:21:09.554031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a343d46edbf1'
+down_revision = '12a11535db12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('audit_event',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('event', sa.String(length=32), nullable=False),
+    sa.Column('userId', sa.String(length=80), nullable=True),
+    sa.Column('orcid', sa.String(length=80), nullable=True),
+    sa.Column('ip', sa.String(length=45), nullable=True),
+    sa.Column('details', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_audit_event_timestamp'), 'audit_event', ['timestamp'], unique=False)
+    op.create_index(op.f('ix_audit_event_userId'), 'audit_event', ['userId'], unique=False)
+    op.create_index(op.f('ix_audit_event_orcid'), 'audit_event', ['orcid'], unique=False)
+    # Keep the audit trail append-only
+    op.execute("""
+        CREATE FUNCTION audit_event_append_only() RETURNS trigger AS $$
+        BEGIN
+            RAISE EXCEPTION 'audit_event is append-only';
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute('CREATE TRIGGER audit_event_no_update_or_delete BEFORE UPDATE OR DELETE ON audit_event FOR EACH ROW EXECUTE FUNCTION audit_event_append_only()')
+    op.execute('CREATE TRIGGER audit_event_no_truncate BEFORE TRUNCATE ON audit_event FOR EACH STATEMENT EXECUTE FUNCTION audit_event_append_only()')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER audit_event_no_truncate ON audit_event')
+    op.execute('DROP TRIGGER audit_event_no_update_or_delete ON audit_event')
+    op.execute('DROP FUNCTION audit_event_append_only()')
+    op.drop_index(op.f('ix_audit_event_orcid'), table_name='audit_event')
+    op.drop_index(op.f('ix_audit_event_userId'), table_name='audit_event')
+    op.drop_index(op.f('ix_audit_event_timestamp'), table_name='audit_event')
+    op.drop_table('audit_event')
@@ -0,0 +1,38 @@
+"""Add token_exchange table for queued token exchanges.
+
+Revision ID: a7284475ddfe
+Revises: 6aef245173fc
+Create Date: 2026-10-17 10:02:47.381206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7284475ddfe'
+down_revision = '6aef245173fc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('token_exchange',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('userId', sa.String(length=80), nullable=False),
+    sa.Column('code', sa.LargeBinary(), nullable=True),
+    sa.Column('redirect_uri', sa.String(length=255), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.Column('next_attempt', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_token_exchange_status_next_attempt', 'token_exchange', ['status', 'next_attempt'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_token_exchange_status_next_attempt', table_name='token_exchange')
+    op.drop_table('token_exchange')
@@ -0,0 +1,31 @@
+"""Add web_session table for server-side sessions.
+
+Revision ID: cc36a5e5b25c
+Revises: e7f5344f8995
+Create Date: 2026-10-17 13:41:19.550472
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'cc36a5e5b25c'
+down_revision = 'e7f5344f8995'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('web_session',
+    sa.Column('id', sa.String(length=64), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('expires', sa.DateTime(timezone=True), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_web_session_expires'), 'web_session', ['expires'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_web_session_expires'), table_name='web_session')
+    op.drop_table('web_session')
@@ -0,0 +1,73 @@
+"""Partition token_history by the time tokens were superseded.
+
+Revision ID: d2a02d9f1d80
+Revises: a343d46edbf1
+Create Date: 2026-10-17 19:02:41.273806
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a02d9f1d80'
+down_revision = 'a343d46edbf1'
+branch_labels = None
+depends_on = None
+
+COLUMNS = '"userId", access_token, refresh_token, expires_in, token_scope, orcid, "timestamp"'
+
+
+def upgrade():
+    op.execute('ALTER TABLE token_history RENAME TO token_history_old')
+    op.execute('ALTER INDEX token_history_pkey RENAME TO token_history_old_pkey')
+    # The partition key must be part of the primary key. The existing id sequence is kept.
+    op.execute('''
+        CREATE TABLE token_history (
+            id integer NOT NULL DEFAULT nextval('token_history_id_seq'),
+            token_id integer NOT NULL,
+            "userId" varchar(80) NOT NULL,
+            access_token bytea NOT NULL,
+            refresh_token bytea NOT NULL,
+            expires_in integer NOT NULL,
+            token_scope varchar(80) NOT NULL,
+            orcid varchar(80) NOT NULL,
+            "timestamp" timestamp with time zone,
+            superseded timestamp with time zone NOT NULL DEFAULT now(),
+            CONSTRAINT token_history_pkey PRIMARY KEY (id, superseded)
+        ) PARTITION BY RANGE (superseded)
+    ''')
+    op.execute('ALTER SEQUENCE token_history_id_seq OWNED BY token_history.id')
+    # Holds the rows outside the monthly partitions, which compact-tokens creates (moving these rows into them)
+    op.execute('CREATE TABLE token_history_default PARTITION OF token_history DEFAULT')
+    op.execute(f'''
+        INSERT INTO token_history (id, token_id, {COLUMNS}, superseded)
+        SELECT id, token_id, {COLUMNS}, coalesce(superseded, "timestamp", now()) FROM token_history_old
+    ''')
+    op.execute('DROP TABLE token_history_old')
+
+
+def downgrade():
+    op.execute('ALTER SEQUENCE token_history_id_seq OWNED BY NONE')
+    op.execute('ALTER TABLE token_history RENAME TO token_history_partitioned')
+    op.execute('ALTER INDEX token_history_pkey RENAME TO token_history_partitioned_pkey')
+    op.create_table('token_history',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('token_history_id_seq')"), nullable=False),
+    sa.Column('token_id', sa.Integer(), nullable=False),
+    sa.Column('userId', sa.String(length=80), nullable=False),
+    sa.Column('access_token', sa.LargeBinary(), nullable=False),
+    sa.Column('refresh_token', sa.LargeBinary(), nullable=False),
+    sa.Column('expires_in', sa.Integer(), nullable=False),
+    sa.Column('token_scope', sa.String(length=80), nullable=False),
+    sa.Column('orcid', sa.String(length=80), nullable=False),
+    sa.Column('timestamp', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('superseded', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute('ALTER SEQUENCE token_history_id_seq OWNED BY token_history.id')
+    op.execute(f'''
+        INSERT INTO token_history (id, token_id, {COLUMNS}, superseded)
+        SELECT id, token_id, {COLUMNS}, superseded FROM token_history_partitioned
+    ''')
+    # Drops the partitions too; partitions already detached as archives (see compact-tokens) are left in place
+    op.execute('DROP TABLE token_history_partitioned')
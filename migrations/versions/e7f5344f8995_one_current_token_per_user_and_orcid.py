@@ -0,0 +1,58 @@
+"""Keep one current token per user and ORCID iD, with a token_history table.
+
+Revision ID: e7f5344f8995
+Revises: a7284475ddfe
+Create Date: 2026-10-17 11:20:05.913342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7f5344f8995'
+down_revision = 'a7284475ddfe'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('token_history',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('token_id', sa.Integer(), nullable=False),
+    sa.Column('userId', sa.String(length=80), nullable=False),
+    sa.Column('access_token', sa.LargeBinary(), nullable=False),
+    sa.Column('refresh_token', sa.LargeBinary(), nullable=False),
+    sa.Column('expires_in', sa.Integer(), nullable=False),
+    sa.Column('token_scope', sa.String(length=80), nullable=False),
+    sa.Column('orcid', sa.String(length=80), nullable=False),
+    sa.Column('timestamp', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('superseded', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    # Move all but the latest token for each user and ORCID iD to token_history
+    op.execute('''
+        CREATE TEMPORARY TABLE superseded_token ON COMMIT DROP AS
+        SELECT id FROM (
+            SELECT id, row_number() OVER (PARTITION BY "userId", orcid ORDER BY "timestamp" DESC, id DESC) AS n
+            FROM token) AS ranked
+        WHERE n > 1
+    ''')
+    op.execute('''
+        INSERT INTO token_history (token_id, "userId", access_token, refresh_token, expires_in, token_scope, orcid, "timestamp")
+        SELECT id, "userId", access_token, refresh_token, expires_in, token_scope, orcid, "timestamp"
+        FROM token WHERE id IN (SELECT id FROM superseded_token)
+    ''')
+    op.execute('DELETE FROM token WHERE id IN (SELECT id FROM superseded_token)')
+    op.create_unique_constraint('uq_token_userId_orcid', 'token', ['userId', 'orcid'])
+
+
+def downgrade():
+    op.drop_constraint('uq_token_userId_orcid', 'token', type_='unique')
+    # Restore superseded tokens to the token table
+    op.execute('''
+        INSERT INTO token ("userId", access_token, refresh_token, expires_in, token_scope, orcid, "timestamp")
+        SELECT "userId", access_token, refresh_token, expires_in, token_scope, orcid, "timestamp"
+        FROM token_history
+    ''')
+    op.drop_table('token_history')
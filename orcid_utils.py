@@ -1,17 +1,241 @@
 from flask import current_app, url_for
 from cryptography.fernet import Fernet
 from os.path import exists
+import os
+import time
+import threading
+import requests
+from urllib.parse import urlparse, urlencode, quote
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+class CircuitOpenError(Exception):
+    '''
+    Raised when a request is not attempted because the circuit breaker is open
+    '''
+    pass
+
+class CircuitBreaker:
+    '''
+    Stops calls to a failing service for a cool-down period after a number of consecutive failures. After the cool-down, calls are allowed again; one more failure reopens the circuit.
+    :param failure_threshold: number of consecutive failures after which to open the circuit
+    :param reset_timeout: number of seconds for which to keep the circuit open
+    '''
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        '''
+        Raises CircuitOpenError if the circuit is open
+        '''
+        with self.lock:
+            if self.opened_at and time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'Circuit open after {self.failures} consecutive failures')
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+class RateLimiter:
+    '''
+    Token-bucket rate limiter, safe to share between threads. acquire() blocks until a request may be made.
+    :param rate: average number of requests per second
+    :param burst: maximum number of requests that may be made at once
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class HostRateLimiter:
+    '''
+    Applies a separate RateLimiter, with the same rate and burst, to each host
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                limiter = self.limiters[host] = RateLimiter(self.rate, self.burst)
+        limiter.acquire()
+
+class OrcidRetry(Retry):
+    '''
+    Retry policy that retries POST requests (e.g., exchanging a one-time code, or adding works in bulk) only when ORCID cannot have acted on them: on connection errors, and on 429 and 503 responses. Retrying after a read timeout or another 5xx response could repeat a request that ORCID has already processed. Other methods (listed in allowed_methods) are retried on those too.
+    '''
+    # Responses to a POST after which it is safe to repeat it
+    SAFE_POST_STATUSES = frozenset([429, 503])
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method and method.upper() == 'POST':
+            return bool(self.total) and status_code in self.SAFE_POST_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
+
+class OrcidClient:
+    '''
+    HTTP client for ORCID's APIs, with keep-alive connection pooling, timeouts, retries with backoff (see OrcidRetry), and a circuit breaker.
+    :param timeout: a (connect, read) tuple of timeouts in seconds
+    :param retries: maximum number of retries per request
+    :param backoff_factor: backoff factor between retries (see urllib3's Retry)
+    :param pool_size: maximum number of connections to keep alive per host
+    :param failure_threshold: see CircuitBreaker
+    :param reset_timeout: see CircuitBreaker
+    :param rate_limiter: an optional HostRateLimiter to apply to all requests
+    '''
+    def __init__(self, timeout=(3.05, 10), retries=3, backoff_factor=0.5, pool_size=10, failure_threshold=5, reset_timeout=30, rate_limiter=None):
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        # POST is left out of allowed_methods, so that it is not retried after read errors (see OrcidRetry)
+        retry = OrcidRetry(total=retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                           allowed_methods=frozenset(['GET', 'PUT']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+
+    def request(self, method, url, **kwargs):
+        '''
+        Makes a request through the pooled session, returning the response. Raises CircuitOpenError if ORCID has been failing, and requests.exceptions.RequestException if the request could not be completed.
+        '''
+        self.breaker.before_call()
+        if self.rate_limiter:
+            self.rate_limiter.acquire(url)
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500 or response.status_code == 429:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+# One client per process, so that pooled connections are not shared between forked workers
+_clients = {}
+
+def get_orcid_client():
+    '''
+    Returns the current process's OrcidClient, creating it from the app's config object if necessary
+    '''
+    pid = os.getpid()
+    client = _clients.get(pid)
+    if client is None:
+        _clients.clear()
+        client = _clients[pid] = create_orcid_client()
+    return client
+
+def create_orcid_client(**kwargs):
+    '''
+    Creates an OrcidClient with the settings in the app's config object. Keyword arguments are passed to OrcidClient, overriding those settings.
+    '''
+    app = current_app._get_current_object()
+    settings = dict(timeout=app.config['ORCID_HTTP_TIMEOUT'],
+                    retries=app.config['ORCID_HTTP_RETRIES'],
+                    backoff_factor=app.config['ORCID_HTTP_BACKOFF'],
+                    pool_size=app.config['ORCID_HTTP_POOL_SIZE'],
+                    failure_threshold=app.config['ORCID_CIRCUIT_FAILURE_THRESHOLD'],
+                    reset_timeout=app.config['ORCID_CIRCUIT_RESET_TIMEOUT'])
+    settings.update(kwargs)
+    return OrcidClient(**settings)
+
+def request_orcid_token(payload, client=None):
+    '''
+    Posts to ORCID's token endpoint and returns the response, recording the latency and outcome of the call (see orcidflask.metrics).
+    :param payload: the form data for the request (see prepare_token_payload)
+    :param client: the OrcidClient to use; defaults to the current process's shared client
+    '''
+    from orcidflask.metrics import timed, ORCID_RESPONSES
+    app = current_app._get_current_object()
+    headers = {'Accept': 'application/json',
+                'Content-Type': 'application/x-www-form-urlencoded'}
+    status = 'error'
+    try:
+        with timed('orcid_token_request'):
+            response = (client or get_orcid_client()).post(app.config['orcid_token_url'], headers=headers, data=payload)
+        status = response.status_code
+        return response
+    finally:
+        ORCID_RESPONSES.labels(status).inc()
     
-def prepare_token_payload(code: str):
+def get_redirect_uri():
+    '''
+    Returns the URL of the orcid_redirect view: built once by create_app if SERVER_NAME is set, or otherwise for the host of the current request
+    '''
+    return current_app.config.get('orcid_redirect_uri') or url_for('views.orcid_redirect', _external=True, _scheme='https')
+
+def get_authorize_url_builder():
+    '''
+    Returns the AuthorizeUrlBuilder for the app: built once by create_app if SERVER_NAME is set, or otherwise for the host of the current request
+    '''
+    app = current_app._get_current_object()
+    return app.config.get('orcid_authorize_url') or AuthorizeUrlBuilder(app.config['orcid_authorize_endpoint'], app.config['CLIENT_ID'], get_redirect_uri())
+
+def prepare_token_payload(code: str, redirect_uri: str = None):
     '''
     :param code: the code returned from ORCID after the user authorizes our application.
+    :param redirect_uri: the redirect URI with which the code was requested; defaults to the URL of the orcid_redirect view
     '''
     app = current_app._get_current_object()
     return  {'client_id': app.config['CLIENT_ID'],
             'client_secret': app.config['CLIENT_SECRET'],
             'grant_type': 'authorization_code',
             'code': code,
-            'redirect_uri': url_for('orcid_redirect', _external=True, _scheme='https')}
+            'redirect_uri': redirect_uri or get_redirect_uri()}
+
+def prepare_refresh_payload(refresh_token: str, revoke_old: bool = False):
+    '''
+    :param refresh_token: the refresh token stored with the user's access token
+    :param revoke_old: set to True to have ORCID revoke the access token being replaced
+    '''
+    app = current_app._get_current_object()
+    return {'client_id': app.config['CLIENT_ID'],
+            'client_secret': app.config['CLIENT_SECRET'],
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'revoke_old': 'true' if revoke_old else 'false'}
 
 def extract_saml_user_data(session, populate=True):
     '''
@@ -20,19 +244,46 @@ def extract_saml_user_data(session, populate=True):
     :param populate: set to False to turn off this feature (returns attributes mapped to empty strings)
     '''
     saml_attrs = ['emailaddress', 'firstname', 'lastname']
-    saml_data = {}
+    saml_data = {s: '' for s in saml_attrs}
     if 'samlUserdata' in session and populate:
         user_data = session['samlUserdata']
         for saml_attr in saml_attrs:
-            value = user_data.get(saml_attr)
-            # Name and email attributes appear to be arrays; not sure if there can be more than one element
-            if value:
-                value = value[0]
-            saml_data[saml_attr] = value
-    else:
-        saml_data = {s: '' for s in saml_attrs}
+            values = user_data.get(saml_attr) or []
+            if isinstance(values, str):
+                values = [values]
+            # SAML attributes may have more than one value; ORCID takes a single name and email, so use the first non-blank one
+            saml_data[saml_attr] = next((value.strip() for value in values if value and value.strip()), '')
     return saml_data
 
+class AuthorizeUrlBuilder:
+    '''
+    Builds the URLs to which users are sent to authorize the app on ORCID. The parameters that are the same for every user (the client ID and redirect URI) are encoded once, when the builder is created; the scopes and the user's name and email are URL-encoded on each call, and left out if blank.
+    :param authorize_url: ORCID's authorization endpoint
+    :param client_id: the app's ORCID client ID
+    :param redirect_uri: the URL of the orcid_redirect view
+    '''
+    # Names of ORCID's parameters for prefilling the registration form, by SAML attribute (see extract_saml_user_data)
+    user_params = {'lastname': 'family_names', 'firstname': 'given_names', 'emailaddress': 'email'}
+
+    def __init__(self, authorize_url, client_id, redirect_uri):
+        self.prefix = authorize_url + '?' + urlencode({'client_id': client_id, 'response_type': 'code', 'redirect_uri': redirect_uri}, quote_via=quote)
+
+    def build(self, scopes, register=False, **saml_user_data):
+        '''
+        Returns the authorization URL for a user
+        :param scopes: the requested scopes, separated by spaces
+        :param register: set to True to show ORCID's registration form rather than its sign-in form
+        :param saml_user_data: the user's name and email, as returned by extract_saml_user_data
+        '''
+        url = self.prefix + '&scope=' + quote(scopes, safe='/')
+        for attr, param in self.user_params.items():
+            value = saml_user_data.get(attr)
+            if value:
+                url += f'&{param}=' + quote(value, safe='')
+        if register:
+            url += '&show_login=false'
+        return url
+
 def new_encryption_key(file, replace=False):
     '''
     Creates and stores a new encryption key at the provided path to file and returns the key. If file exists and replace=True, it will overwrite an existing file; otherwise, it will skip saving.
@@ -59,4 +310,16 @@ def load_encryption_key(file):
             key = f.read()
     except FileNotFoundError:
         key = new_encryption_key(file)
-    return key
\ No newline at end of file
+    return key
+
+def load_previous_encryption_keys(files):
+    '''
+    Loads previous (retired) secret keys from a comma-separated list of files, for use in decrypting database values during a key rotation. Unlike load_encryption_key, does not create missing files.
+    :param files: a comma-separated list of paths, or None
+    '''
+    keys = []
+    for file in (files or '').split(','):
+        if file.strip():
+            with open(file.strip(), 'rb') as f:
+                keys.append(f.read())
+    return keys
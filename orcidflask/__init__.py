@@ -1,67 +1,82 @@
-from flask import Flask
+from flask import Flask, url_for
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 import os
-import click
-from orcid_utils import load_encryption_key, new_encryption_key
-import json
+import tempfile
 
-app = Flask(__name__)
-# load default configs from default_settings.py
-app.config.from_object('orcidflask.default_settings')
-# load sensitive config settings 
-app.config.from_envvar('ORCIDFLASK_SETTINGS')
-# Set the ORCID URL based on the setting in default_settings.py
-if os.getenv('ORCID_SERVER') == 'sandbox':
-    base_url = 'https://sandbox.orcid.org'
-else:
-    base_url = 'https://orcid.org'
-# Personal attributes from SAML metadata definitions
-app.config['orcid_auth_url'] = base_url + '/oauth/authorize?client_id={orcid_client_id}&response_type=code&scope={scopes}&redirect_uri={redirect_uri}&family_names={lastname}&given_names={firstname}&email={emailaddress}'
-app.config['orcid_register_url'] = base_url + '/oauth/authorize?client_id={orcid_client_id}&response_type=code&scope={scopes}&redirect_uri={redirect_uri}&family_names={lastname}&given_names={firstname}&email={emailaddress}&show_login=false'
-app.config['orcid_token_url'] = base_url + '/oauth/token'
-app.config['SAML_PATH'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saml')
-app.config["SESSION_COOKIE_DOMAIN"] = app.config["SERVER_NAME"]
-app.secret_key = app.config['SECRET_KEY']
-postgres_user = os.getenv('POSTGRES_USER')
-postgres_pwd = os.getenv('POSTGRES_PASSWORD')
-postgres_db_host = os.getenv('POSTGRES_DB_HOST')
-postgres_port = os.getenv('POSTGRES_PORT')
-postgres_db = os.getenv('POSTGRES_DB')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{postgres_user}:{postgres_pwd}@{postgres_db_host}:{postgres_port}/{postgres_db}'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db_key_file = os.getenv('DB_ENCRYPTION_FILE')
-app.config['db_encryption_key'] = load_encryption_key(db_key_file)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+db = SQLAlchemy()
+migrate = Migrate()
 
-import orcidflask.views
-from orcidflask.models import Token
-
-@app.cli.command('create-secret-key')
-@click.argument('file')
-def create_secret_key(file):
+def create_app():
     '''
-    Creates a new database encryption key and saves to the provided file path. Will not overwrite the existing file, if it exists.
+    Creates the Flask app. Only what every entry point needs is set up here; the SAML libraries, the encryption keys and the database engine are loaded when first used (or, for the web app, up front by preload; see web.py), so that flask commands start quickly.
     '''
-    store_encryption_key(file)
+    app = Flask(__name__)
+    # load default configs from default_settings.py
+    app.config.from_object('orcidflask.default_settings')
+    # load sensitive config settings 
+    app.config.from_envvar('ORCIDFLASK_SETTINGS')
+    # Set the ORCID URL based on the setting in default_settings.py
+    if app.config['ORCID_BASE_URL']:
+        base_url = app.config['ORCID_BASE_URL']
+        app.config['orcid_api_url'] = base_url + '/v3.0'
+    elif os.getenv('ORCID_SERVER') == 'sandbox':
+        base_url = 'https://sandbox.orcid.org'
+        app.config['orcid_api_url'] = 'https://api.sandbox.orcid.org/v3.0'
+    else:
+        base_url = 'https://orcid.org'
+        app.config['orcid_api_url'] = 'https://api.orcid.org/v3.0'
+    app.config['orcid_token_url'] = base_url + '/oauth/token'
+    app.config.setdefault('SAML_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'saml'))
+    app.config["SESSION_COOKIE_DOMAIN"] = app.config["SERVER_NAME"]
+    app.secret_key = app.config['SECRET_KEY']
+    postgres_user = os.getenv('POSTGRES_USER')
+    postgres_pwd = os.getenv('POSTGRES_PASSWORD')
+    postgres_db_host = os.getenv('POSTGRES_DB_HOST')
+    postgres_port = os.getenv('POSTGRES_PORT')
+    postgres_db = os.getenv('POSTGRES_DB')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{postgres_user}:{postgres_pwd}@{postgres_db_host}:{postgres_port}/{postgres_db}'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # The encryption keys are loaded from these files when first needed (see models.get_encryption_keys)
+    app.config['DB_ENCRYPTION_FILE'] = os.getenv('DB_ENCRYPTION_FILE')
+    # Keys being rotated out; tokens encrypted with these can still be decrypted until the rotate-key command has been run
+    app.config['DB_PREVIOUS_ENCRYPTION_FILES'] = os.getenv('DB_PREVIOUS_ENCRYPTION_FILES')
+    db.init_app(app)
+    migrate.init_app(app, db)
+    from orcidflask.metrics import instrument_app
+    instrument_app(app, db)
+    if not app.config['ADMISSION_STATE_FILE']:
+        app.config['ADMISSION_STATE_FILE'] = os.path.join(tempfile.gettempdir(), 'orcidflask-admission')
+    from orcidflask.admission import install_admission_control
+    install_admission_control(app)
 
-@app.cli.command('reset-db')
-def reset_db():
-    '''
-    Resets the associated database by dropping all tables. Warning: for development purposes only. Do not run on a production instance without first backing up the database, as this command will result in the loss of all data.
-    '''
-    db.drop_all()
+    from orcidflask.views import views
+    app.register_blueprint(views)
+    from orcidflask.api import api
+    app.register_blueprint(api)
+    app.config['orcid_authorize_endpoint'] = base_url + '/oauth/authorize'
+    # The redirect URI and the static parts of the ORCID authorization URL are the same for every request, so they are built once here. External URLs built outside a request require SERVER_NAME; without it, they are built for each request instead (see orcid_utils.get_redirect_uri).
+    if app.config['SERVER_NAME']:
+        from orcid_utils import AuthorizeUrlBuilder
+        with app.app_context():
+            app.config['orcid_redirect_uri'] = url_for('views.orcid_redirect', _external=True, _scheme='https')
+        app.config['orcid_authorize_url'] = AuthorizeUrlBuilder(app.config['orcid_authorize_endpoint'], app.config['CLIENT_ID'], app.config['orcid_redirect_uri'])
+    from orcidflask.commands import register_commands
+    register_commands(app)
+
+    if app.config['SESSION_BACKEND'] != 'cookie':
+        from orcidflask.sessions import ServerSideSessionInterface
+        app.session_interface = ServerSideSessionInterface.from_config(app)
+    return app
 
-@app.cli.command('serialize-db')
-@click.argument('file', type=click.File('w'))
-def serialize_db(file):
+def preload(app):
     '''
-    Serializes the database as a JSON dump. Argument should be the path to a file, preferably in a volume mapped to the container, such as /opt/orcid_integration/data
+    Loads the encryption keys (creating the key file if it does not exist) and, if SAML_VALIDATE_ON_STARTUP is set, the SAML settings and SP metadata, so that any errors in them surface when the app starts rather than on the first request.
     '''
-    # get all records from the database
-    records = Token.query.all()
-    # convert to Python dicts
-    records = [record.to_dict() for record in records] 
-    json.dump(records, file)
-    
\ No newline at end of file
+    from orcidflask.models import get_encryption_keys
+    with app.app_context():
+        get_encryption_keys()
+    if app.config['SAML_VALIDATE_ON_STARTUP']:
+        from saml_utils import get_saml_settings, get_sp_metadata
+        get_saml_settings(app.config['SAML_PATH'])
+        get_sp_metadata(app.config['SAML_PATH'], app.config['SAML_METADATA_FILE'])
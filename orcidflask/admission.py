@@ -0,0 +1,189 @@
+'''
+Admission control for expensive endpoints (see RATE_LIMITS). Each limited endpoint has a token bucket, capping the rate of requests, and a cap on the number of requests handled at once. Their state is kept in a small memory-mapped file, shared by all worker processes on the host, so the limits apply to the app as a whole rather than to each worker. Requests over a limit are turned away at once, with a 503 page and a Retry-After header, instead of queueing behind the requests already being handled.
+'''
+import fcntl
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, request, g, render_template, make_response
+from prometheus_client import Counter, Gauge
+
+IN_FLIGHT = Gauge('orcidflask_admission_in_flight', 'Number of requests being handled by each rate-limited endpoint', ['endpoint'], multiprocess_mode='livesum')
+REJECTED = Counter('orcidflask_admission_rejected_total', 'Number of requests turned away by admission control, by endpoint and limit reached', ['endpoint', 'reason'])
+
+# Maximum number of worker processes whose requests are counted towards the concurrency caps
+MAX_PROCESSES = 256
+# Header: magic number and a hash of the rules, so that a file written for other rules is reset
+HEADER = struct.Struct('8s32s')
+# Per endpoint: the bucket's tokens and when they were last updated, followed by a (pid, requests) entry per process
+BUCKET = struct.Struct('dd')
+ENTRIES = struct.Struct(f'{2 * MAX_PROCESSES}q')
+SLOT_SIZE = BUCKET.size + ENTRIES.size
+
+class AdmissionController:
+    '''
+    Token buckets and concurrency caps for a set of endpoints, with state shared through a memory-mapped file. Safe to use from multiple threads and processes.
+    :param path: path to the state file (created if necessary)
+    :param rules: a dict mapping endpoint names to dicts with the keys rate (requests per second), burst (requests allowed at once above the rate), concurrency (optional; requests handled at once), methods (optional; the HTTP methods to limit) and retry_after (optional; seconds a client should wait when the concurrency cap is reached)
+    '''
+    def __init__(self, path, rules):
+        self.rules = rules
+        self.slots = {endpoint: i for i, endpoint in enumerate(sorted(rules))}
+        self.path = path
+        # Threads in a process share the file descriptor, which flock does not lock them out of, so they also take this lock
+        self.lock = threading.Lock()
+        size = HEADER.size + SLOT_SIZE * len(self.slots)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        header = HEADER.pack(b'orcidadm', hashlib.sha256(json.dumps(rules, sort_keys=True).encode()).digest())
+        with self.locked_file():
+            if os.fstat(self.fd).st_size != size or os.pread(self.fd, HEADER.size, 0) != header:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, header, 0)
+        self.map = mmap.mmap(self.fd, size)
+
+    @contextmanager
+    def locked_file(self):
+        '''
+        Locks the state against other threads and processes
+        '''
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def applies(self, endpoint, method):
+        rule = self.rules.get(endpoint)
+        return rule is not None and method in rule.get('methods', (method,))
+
+    def _entries(self, offset):
+        values = ENTRIES.unpack_from(self.map, offset + BUCKET.size)
+        return list(zip(values[::2], values[1::2]))
+
+    def _set_entry(self, offset, index, pid, count):
+        struct.pack_into('qq', self.map, offset + BUCKET.size + index * 16, pid, count)
+
+    def acquire(self, endpoint):
+        '''
+        Admits a request to the endpoint if it is within the limits, returning None; the caller must then call release once the request has been handled. Otherwise, returns a (reason, retry_after) tuple, where reason is 'rate' or 'concurrency' and retry_after is a number of seconds.
+        '''
+        rule = self.rules[endpoint]
+        offset = HEADER.size + SLOT_SIZE * self.slots[endpoint]
+        pid = os.getpid()
+        with self.locked_file():
+            tokens, updated = BUCKET.unpack_from(self.map, offset)
+            now = time.monotonic()
+            # A new bucket starts full. The monotonic clock restarts when the host does, so a bucket last updated in the future was left in the file by an earlier boot, and also starts full (rather than never refilling).
+            if not updated or updated > now:
+                tokens = rule['burst']
+            else:
+                tokens = min(rule['burst'], tokens + (now - updated) * rule['rate'])
+            entries = self._entries(offset)
+            concurrency = rule.get('concurrency')
+            if concurrency and sum(count for _, count in entries) >= concurrency:
+                # Free the requests of worker processes that have died while handling them
+                for index, (entry_pid, count) in enumerate(entries):
+                    if count and not process_exists(entry_pid):
+                        self._set_entry(offset, index, 0, 0)
+                        entries[index] = (0, 0)
+                if sum(count for _, count in entries) >= concurrency:
+                    BUCKET.pack_into(self.map, offset, tokens, now)
+                    return 'concurrency', rule.get('retry_after', 1)
+            if tokens < 1:
+                BUCKET.pack_into(self.map, offset, tokens, now)
+                return 'rate', math.ceil((1 - tokens) / rule['rate'])
+            BUCKET.pack_into(self.map, offset, tokens - 1, now)
+            if concurrency:
+                index = next((i for i, (entry_pid, _) in enumerate(entries) if entry_pid == pid), None)
+                if index is None:
+                    index = next((i for i, (_, count) in enumerate(entries) if not count), None)
+                # With more processes than entries, the requests of the extra processes are not counted
+                if index is not None:
+                    self._set_entry(offset, index, pid, entries[index][1] + 1 if entries[index][0] == pid else 1)
+        return None
+
+    def release(self, endpoint):
+        '''
+        Records that a request admitted by acquire has been handled
+        '''
+        if not self.rules[endpoint].get('concurrency'):
+            return
+        offset = HEADER.size + SLOT_SIZE * self.slots[endpoint]
+        pid = os.getpid()
+        with self.locked_file():
+            for index, (entry_pid, count) in enumerate(self._entries(offset)):
+                if entry_pid == pid and count:
+                    self._set_entry(offset, index, pid, count - 1)
+                    break
+
+    def release_process(self, pid):
+        '''
+        Frees the requests counted for a worker process that has exited (see gunicorn.conf.py)
+        '''
+        with self.locked_file():
+            for endpoint, slot in self.slots.items():
+                offset = HEADER.size + SLOT_SIZE * slot
+                for index, (entry_pid, _) in enumerate(self._entries(offset)):
+                    if entry_pid == pid:
+                        self._set_entry(offset, index, 0, 0)
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# One controller per process, since the memory map is opened after forking
+_controllers = {}
+
+def get_admission_controller(app):
+    '''
+    Returns the current process's AdmissionController for the rules in the app's config object (RATE_LIMITS), or None if there are no rules
+    '''
+    if not app.config['RATE_LIMITS']:
+        return None
+    pid = os.getpid()
+    controller = _controllers.get(pid)
+    if controller is None:
+        _controllers.clear()
+        controller = _controllers[pid] = AdmissionController(app.config['ADMISSION_STATE_FILE'], app.config['RATE_LIMITS'])
+    return controller
+
+def install_admission_control(app):
+    '''
+    Adds the request hooks that apply the limits in RATE_LIMITS
+    '''
+    @app.before_request
+    def admit():
+        controller = get_admission_controller(current_app)
+        if controller is None or not controller.applies(request.endpoint, request.method):
+            return None
+        rejection = controller.acquire(request.endpoint)
+        if rejection is None:
+            g.admitted_endpoint = request.endpoint
+            IN_FLIGHT.labels(request.endpoint).inc()
+            return None
+        reason, retry_after = rejection
+        REJECTED.labels(request.endpoint, reason).inc()
+        # Pages requested with GET (e.g., the redirect back from ORCID, which carries a code) can simply be reloaded
+        response = make_response(render_template('busy.html', refresh=retry_after if request.method == 'GET' else None), 503)
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @app.teardown_request
+    def release(exc):
+        endpoint = g.pop('admitted_endpoint', None)
+        if endpoint is not None:
+            IN_FLIGHT.labels(endpoint).dec()
+            get_admission_controller(current_app).release(endpoint)
@@ -0,0 +1,97 @@
+'''
+Read-only JSON API through which internal services (e.g., jobs that push works to ORCID) look up users' tokens, rather than reading and decrypting the token table themselves. Requests must carry one of the keys in API_KEYS as a bearer token. Decrypted tokens are kept in a per-process cache, which orcid_redirect invalidates when it saves a new token.
+'''
+import hmac
+import os
+from flask import Blueprint, current_app, request, jsonify, abort, g
+from werkzeug.exceptions import HTTPException
+from orcidflask.cache import TTLCache
+from orcidflask.models import Token
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+# One cache per process, keyed by ORCID iD
+_caches = {}
+
+def get_token_cache():
+    '''
+    Returns the current process's cache of decrypted tokens, creating it from the app's config object if necessary
+    '''
+    pid = os.getpid()
+    cache = _caches.get(pid)
+    if cache is None:
+        _caches.clear()
+        cache = _caches[pid] = TTLCache(maxsize=current_app.config['API_CACHE_MAXSIZE'], ttl=current_app.config['API_CACHE_TTL'])
+    return cache
+
+def invalidate_tokens(orcids):
+    '''
+    Removes the cached tokens for the provided ORCID iDs, after new tokens have been saved for them
+    '''
+    cache = _caches.get(os.getpid())
+    if cache is not None:
+        for orcid in orcids:
+            cache.delete(orcid)
+
+def lookup_tokens(orcids):
+    '''
+    Returns a dict of the latest valid token (see Token.latest) for each of the provided ORCID iDs that has one, as Python dicts (see Token.to_dict). Tokens not in the cache are loaded with a single query and decrypted in bulk.
+    :param orcids: a list of ORCID iDs
+    '''
+    cache = get_token_cache()
+    tokens = {}
+    uncached = []
+    for orcid in dict.fromkeys(orcids):
+        record = cache.get(orcid)
+        if record is None:
+            uncached.append(orcid)
+        else:
+            tokens[orcid] = record
+    if uncached:
+        rows = Token.latest(by='orcid', values=uncached).with_entities(*Token.raw_columns()).all()
+        for record in Token.decrypt_rows(rows):
+            cache.set(record['orcid'], record)
+            tokens[record['orcid']] = record
+    return tokens
+
+@api.before_request
+def authenticate():
+    '''
+    Requires one of the keys in API_KEYS as a bearer token. The API is turned off (all requests get 404) if no keys are configured.
+    '''
+    keys = current_app.config['API_KEYS']
+    if not keys:
+        abort(404)
+    authorization = request.headers.get('Authorization', '')
+    # Check every key, so that the time taken does not reveal which one matched
+    clients = [client for client, key in keys.items() if hmac.compare_digest(authorization, f'Bearer {key}')]
+    if not clients:
+        abort(401)
+    g.api_client = clients[0]
+
+@api.errorhandler(HTTPException)
+def json_error(e):
+    return jsonify(error=e.name, description=e.description), e.code
+
+@api.route('/tokens/<orcid>')
+def get_token(orcid):
+    '''
+    Returns the latest valid token for an ORCID iD
+    '''
+    record = lookup_tokens([orcid]).get(orcid)
+    if record is None:
+        abort(404, description=f'No valid token for ORCID iD {orcid}')
+    return jsonify(record)
+
+@api.route('/tokens:lookup', methods=['POST'])
+def batch_lookup():
+    '''
+    Returns the latest valid tokens for a list of ORCID iDs, posted as JSON: {"orcids": [...]}. The response holds the tokens found, keyed by ORCID iD, and the ORCID iDs without a valid token: {"tokens": {...}, "missing": [...]}.
+    '''
+    orcids = (request.get_json(silent=True) or {}).get('orcids')
+    if not isinstance(orcids, list) or not all(isinstance(orcid, str) for orcid in orcids):
+        abort(400, description='Expected a JSON object with a list of ORCID iDs: {"orcids": [...]}')
+    if len(orcids) > current_app.config['API_LOOKUP_MAX_BATCH']:
+        abort(400, description=f'At most {current_app.config["API_LOOKUP_MAX_BATCH"]} ORCID iDs may be looked up at a time')
+    tokens = lookup_tokens(orcids)
+    return jsonify(tokens=tokens, missing=[orcid for orcid in dict.fromkeys(orcids) if orcid not in tokens])
@@ -0,0 +1,175 @@
+'''
+Audit trail of authorizations (see AUDIT_SINK): consent granted, access denied, OAuth and SAML errors, and logouts. Request handlers record events with audit(), which only puts them on an in-memory queue; a background thread in each process writes them in batches to the audit_event table or to rotating JSON Lines files, so that a slow sink does not slow down requests.
+'''
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from flask import current_app, request, has_request_context
+from prometheus_client import Counter
+from orcidflask import db
+from orcidflask.models import AuditEvent
+
+AUDIT_EVENTS = Counter('orcidflask_audit_events_total', 'Number of audit events recorded, by event', ['event'])
+AUDIT_DROPPED = Counter('orcidflask_audit_events_dropped_total', 'Number of audit events dropped because the queue was full')
+
+class SQLAuditSink:
+    '''
+    Appends events to the audit_event table
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def write(self, events):
+        with self.app.app_context():
+            try:
+                db.session.execute(AuditEvent.__table__.insert(), [{**event, 'timestamp': datetime.fromisoformat(event['timestamp'])} for event in events])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+class JSONLinesAuditSink:
+    '''
+    Appends events to a JSON Lines file, which is rotated (to file.1, file.2, ...) when it grows past max_bytes
+    :param path: path to the file
+    :param max_bytes: size at which to rotate the file
+    :param backup_count: number of rotated files to keep
+    '''
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, backup_count=10):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+    def rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        os.replace(self.path, f'{self.path}.1')
+
+    def write(self, events):
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self.rotate()
+        # Each batch is written with a single call to an O_APPEND file, so that the lines of concurrent worker processes are not interleaved
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in events))
+
+class AuditLog:
+    '''
+    Queues audit events and writes them to a sink on a background thread, in batches. If the sink fails, the batch is retried, and after the last attempt its events are written to the app's log instead, so they are not lost. If the queue is full, events are dropped (and counted) rather than blocking the request.
+    :param app: the Flask app
+    :param sink: an SQLAuditSink or JSONLinesAuditSink
+    :param maxsize: maximum number of events waiting to be written
+    :param max_batch: maximum number of events per write
+    :param max_wait: maximum number of seconds to wait for more events before writing a batch
+    :param retries: number of times to retry a failed write
+    '''
+    def __init__(self, app, sink, maxsize=10000, max_batch=500, max_wait=1.0, retries=3):
+        self.app = app
+        self.sink = sink
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.retries = retries
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.writing = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+        self.thread.start()
+        # Write the events still queued when the process exits (e.g., when gunicorn restarts a worker)
+        atexit.register(self.flush)
+
+    def emit(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            AUDIT_DROPPED.inc()
+            self.app.logger.error(f'Audit queue full; dropped event {json.dumps(event)}')
+
+    def _next_batch(self, first, block=True):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if block and remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining) if block else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                self.sink.write(batch)
+                return
+            except Exception as e:
+                error = e
+                time.sleep(min(2 ** attempt, 30) * 0.1)
+        for event in batch:
+            self.app.logger.error(f'Failed to write audit event ({error!r}): {json.dumps(event)}')
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            # Held from the first event of a batch until it has been written, so that flush can wait for it
+            with self.writing:
+                self._write(self._next_batch(first))
+
+    def flush(self, timeout=30):
+        '''
+        Writes the events in the queue from the current thread, and waits (up to timeout seconds) for the batch being written by the background thread, if any
+        '''
+        while True:
+            try:
+                first = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self._write(self._next_batch(first, block=False))
+        if self.writing.acquire(timeout=timeout):
+            self.writing.release()
+
+# One audit log per process, since threads do not survive a fork
+_logs = {}
+
+def get_audit_log():
+    '''
+    Returns the current process's AuditLog, creating it from the app's config object if necessary, or None if auditing is turned off
+    '''
+    app = current_app._get_current_object()
+    backend = app.config['AUDIT_SINK']
+    if not backend:
+        return None
+    pid = os.getpid()
+    log = _logs.get(pid)
+    if log is None:
+        if backend == 'sqlalchemy':
+            sink = SQLAuditSink(app)
+        elif backend == 'jsonl':
+            sink = JSONLinesAuditSink(app.config['AUDIT_LOG_FILE'], max_bytes=app.config['AUDIT_LOG_MAX_BYTES'],
+                                      backup_count=app.config['AUDIT_LOG_BACKUP_COUNT'])
+        else:
+            raise ValueError(f'Unknown audit sink: {backend}')
+        _logs.clear()
+        log = _logs[pid] = AuditLog(app, sink, maxsize=app.config['AUDIT_QUEUE_SIZE'], max_batch=app.config['AUDIT_BATCH_SIZE'],
+                                    max_wait=app.config['AUDIT_FLUSH_INTERVAL'])
+    return log
+
+def audit(event, user_id=None, orcid=None, **details):
+    '''
+    Records an audit event, without waiting for it to be written. In a request, the client's IP address is recorded with it.
+    :param event: the type of event: consent_granted, access_denied, oauth_error, saml_error or slo
+    :param user_id: the user's ID from the SSO process, if known
+    :param orcid: the user's ORCID iD, if known
+    :param details: other information to record with the event
+    '''
+    log = get_audit_log()
+    if log is None:
+        return
+    AUDIT_EVENTS.labels(event).inc()
+    log.emit({'timestamp': datetime.now(timezone.utc).isoformat(), 'event': event, 'userId': user_id, 'orcid': orcid,
+              'ip': request.remote_addr if has_request_context() else None, 'details': details or None})
@@ -0,0 +1,79 @@
+'''
+A bounded, in-process cache with least-recently-used eviction and a time-to-live for each entry.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    '''
+    Thread-safe LRU cache whose entries expire after a time-to-live. Each worker process has its own cache.
+    :param maxsize: maximum number of entries; the least recently used entry is evicted when the cache is full
+    :param ttl: default number of seconds for which an entry is kept
+    '''
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        '''
+        Returns the value for key, or default if the key is missing or has expired
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        '''
+        Stores value under key, for ttl seconds (defaults to the cache's ttl)
+        '''
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        '''
+        Stores value under key only if the key is missing or has expired. Returns True if the value was stored.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return False
+            self.entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def purge_expired(self):
+        '''
+        Removes all expired entries, returning the number removed
+        '''
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, (_, expires) in self.entries.items() if expires <= now]
+            for key in expired:
+                del self.entries[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self.entries)
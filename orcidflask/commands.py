@@ -0,0 +1,450 @@
+'''
+The app's flask commands (see register_commands). Commands import what they need when they run, so that, e.g., create-secret-key does not load the database or SAML libraries.
+'''
+import os
+import json
+import gzip
+import time
+import asyncio
+import hashlib
+import itertools
+import re
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.sql import func
+from orcidflask import db
+from orcidflask.models import Token, get_encryption_keys, encrypted_tables, rotate_encryption, copy_tokens, reset_token_id_sequence, _encrypt_chunk
+from orcid_utils import new_encryption_key
+
+@click.command('create-secret-key')
+@click.argument('file')
+@with_appcontext
+def create_secret_key(file):
+    '''
+    Creates a new database encryption key and saves to the provided file path. Will not overwrite the existing file, if it exists.
+    '''
+    new_encryption_key(file)
+
+@click.command('reset-db')
+@with_appcontext
+def reset_db():
+    '''
+    Resets the associated database by dropping all tables. Warning: for development purposes only. Do not run on a production instance without first backing up the database, as this command will result in the loss of all data.
+    '''
+    db.drop_all()
+
+def open_dump_file(file, mode):
+    '''
+    Opens a database dump for reading or writing, transparently compressing it if the path ends in .gz
+    :param file: path to the dump file
+    :param mode: one of 'r', 'w' or 'a'
+    '''
+    if file.endswith('.gz'):
+        return gzip.open(file, mode + 't', encoding='utf-8')
+    return open(file, mode, encoding='utf-8')
+
+def find_last_serialized_id(file):
+    '''
+    Returns the id of the last complete record in a JSON Lines dump, or 0 if the file is missing or empty. For uncompressed files, a partially written final line (from an interrupted run) is truncated so that the dump can be appended to.
+    :param file: path to the dump file
+    '''
+    if not os.path.exists(file):
+        return 0
+    last_id = 0
+    # Byte offset just past the last complete record
+    offset = 0
+    try:
+        with open_dump_file(file, 'r') as f:
+            for line in iter(f.readline, ''):
+                # A final line without a newline was cut off, even if what remains of it parses
+                if not line.endswith('\n'):
+                    if file.endswith('.gz'):
+                        raise click.ClickException(f'Cannot resume from {file}: the last record is incomplete.')
+                    break
+                last_id = json.loads(line)['id']
+                if not file.endswith('.gz'):
+                    offset = f.tell()
+    # EOFError is raised for a truncated .gz file
+    except (ValueError, KeyError, TypeError, EOFError) as e:
+        raise click.ClickException(f'Cannot resume from {file}: {type(e).__name__}: {e}')
+    if not file.endswith('.gz'):
+        with open(file, 'r+b') as f:
+            f.truncate(offset)
+    return last_id
+
+@click.command('serialize-db')
+@click.argument('file', type=click.Path(dir_okay=False, writable=True))
+@click.option('--jsonl', is_flag=True, help='Write one JSON record per line instead of a single JSON array.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of records to load from the database at a time.')
+@click.option('--resume', is_flag=True, help='Append to an existing JSON Lines dump, starting after the last id written to it. Requires --jsonl.')
+@click.option('--workers', default=1, show_default=True, help='Number of worker processes to use for decrypting tokens.')
+@with_appcontext
+def serialize_db(file, jsonl, batch_size, resume, workers):
+    '''
+    Serializes the database as a JSON dump. Argument should be the path to a file, preferably in a volume mapped to the container, such as /opt/orcid_integration/data. Paths ending in .gz are gzip-compressed.
+    Records are streamed from the database in batches, ordered by id, so memory use does not grow with the size of the table.
+    '''
+    if resume and not jsonl:
+        raise click.UsageError('--resume is only supported for JSON Lines dumps (--jsonl).')
+    after_id = find_last_serialized_id(file) if resume else 0
+    total = Token.query.filter(Token.id > after_id).count()
+    with open_dump_file(file, 'a' if resume else 'w') as f, \
+        click.progressbar(length=total, label='Serializing tokens') as progress:
+        if not jsonl:
+            f.write('[')
+        first = True
+        for batch in Token.iter_dict_batches(batch_size=batch_size, after_id=after_id, workers=workers):
+            for record in batch:
+                if jsonl:
+                    f.write(json.dumps(record) + '\n')
+                else:
+                    f.write(('' if first else ', ') + json.dumps(record))
+                first = False
+            f.flush()
+            progress.update(len(batch))
+        if not jsonl:
+            f.write(']')
+
+# Separators between the records of a JSON array dump
+_SEPARATORS = re.compile(r'[\s,]*')
+
+def iter_dump_records(file, chunk_size=1 << 20):
+    '''
+    Yields the records in a dump written by serialize-db, either a JSON array or JSON Lines (possibly gzip-compressed). The array is decoded incrementally, since serialize-db writes it on a single line, so that memory use does not grow with the size of the dump.
+    :param file: path to the dump file
+    :param chunk_size: number of characters to read at a time from a JSON array dump
+    '''
+    try:
+        with open_dump_file(file, 'r') as f:
+            buffer = f.read(chunk_size).lstrip()
+            if not buffer.startswith('['):
+                for line in itertools.chain((buffer + f.readline()).splitlines(), f):
+                    if line.strip():
+                        yield json.loads(line)
+                return
+            decoder = json.JSONDecoder()
+            pos = 1
+            while True:
+                pos = _SEPARATORS.match(buffer, pos).end()
+                if pos < len(buffer):
+                    if buffer[pos] == ']':
+                        return
+                    try:
+                        record, pos = decoder.raw_decode(buffer, pos)
+                        yield record
+                        continue
+                    except ValueError:
+                        # The record continues past the end of the buffer
+                        pass
+                more = f.read(chunk_size)
+                if not more:
+                    raise click.ClickException(f'{file} is not a complete JSON dump.')
+                buffer = buffer[pos:] + more
+                pos = 0
+    # EOFError is raised for a truncated .gz file, and ValueError for a JSON Lines record that was cut off
+    except (ValueError, EOFError) as e:
+        raise click.ClickException(f'{file} is not a complete dump: {type(e).__name__}: {e}')
+
+# Column types for Parquet exports (see export-changes)
+PARQUET_SCHEMA = [('id', 'int64'), ('userId', 'string'), ('access_token', 'string'), ('refresh_token', 'string'),
+                  ('expires_in', 'int32'), ('token_scope', 'string'), ('orcid', 'string'), ('timestamp', 'timestamp')]
+
+def open_parquet_writer(file):
+    '''
+    Returns a function that appends a batch of records (see Token.to_dict) to a Parquet file, and a function that closes the file. Requires the optional pyarrow package.
+    :param file: path to the Parquet file
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise click.UsageError('Parquet exports require the pyarrow package (pip install pyarrow).')
+    types = {'int64': pa.int64(), 'int32': pa.int32(), 'string': pa.string(), 'timestamp': pa.timestamp('us', tz='UTC')}
+    schema = pa.schema([(name, types[type_]) for name, type_ in PARQUET_SCHEMA])
+    writer = pq.ParquetWriter(file, schema, compression='zstd')
+
+    def write(records):
+        columns = {name: [record[name] for record in records] for name, _ in PARQUET_SCHEMA}
+        columns['timestamp'] = [datetime.fromisoformat(value) for value in columns['timestamp']]
+        writer.write_table(pa.table(columns, schema=schema))
+    return write, writer.close
+
+@click.command('export-changes')
+@click.argument('file', type=click.Path(dir_okay=False, writable=True))
+@click.option('--state', required=True, type=click.Path(dir_okay=False), help='File in which the position of the last exported token is kept between runs. If the file does not exist, all tokens are exported.')
+@click.option('--format', 'output_format', type=click.Choice(['jsonl', 'parquet']), default='jsonl', show_default=True, help='Write JSON Lines, or a Parquet file (requires pyarrow).')
+@click.option('--lag', default=60, show_default=True, help='Leave out tokens written within this many seconds, which may belong to transactions not yet committed. They are exported by the next run.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of records to load from the database at a time.')
+@click.option('--workers', default=1, show_default=True, help='Number of worker processes to use for decrypting tokens.')
+@with_appcontext
+def export_changes(file, state, output_format, lag, batch_size, workers):
+    '''
+    Exports the tokens inserted or replaced since the previous run, e.g., for syncing to another system. The position of the last exported token (its timestamp and id) is read from and saved to the state file, which is only updated once the export has been written in full; if a run fails, the next run exports the same tokens again. JSON Lines paths ending in .gz are gzip-compressed.
+    '''
+    after = None
+    if os.path.exists(state):
+        with open(state) as f:
+            position = json.load(f)
+        after = (datetime.fromisoformat(position['timestamp']), position['id'])
+        click.echo(f'Exporting tokens changed after {position["timestamp"]} (id {position["id"]})')
+    # Use the database's clock, with which the timestamps are written
+    until = db.session.query(func.now() - timedelta(seconds=lag)).scalar()
+    if output_format == 'parquet':
+        write, close = open_parquet_writer(file)
+    else:
+        f = open_dump_file(file, 'w')
+        write = lambda records: f.writelines(json.dumps(record) + '\n' for record in records)
+        close = f.close
+    total = 0
+    last = None
+    try:
+        for batch in Token.iter_changes(after=after, until=until, batch_size=batch_size, workers=workers):
+            write(batch)
+            total += len(batch)
+            last = batch[-1]
+    finally:
+        close()
+    if last is not None:
+        # Replace the state file in one step, so that it is never left partially written
+        with open(state + '.tmp', 'w') as f:
+            json.dump({'timestamp': last['timestamp'], 'id': last['id']}, f)
+        os.replace(state + '.tmp', state)
+    click.echo(f'Exported {total} tokens to {file}')
+
+@click.command('load-db')
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=10000, show_default=True, help='Number of records to insert per committed batch.')
+@click.option('--workers', default=1, show_default=True, help='Number of worker processes to use for encrypting tokens.')
+@click.option('--resume', is_flag=True, help='Skip the records with ids up to the highest id already in the database, e.g., to continue an interrupted load.')
+@with_appcontext
+def load_db(file, batch_size, workers, resume):
+    '''
+    Loads a dump written by serialize-db (a JSON array or JSON Lines, possibly gzip-compressed) into the token table, e.g., to restore a backup or to move the tokens to a new database. Tokens are encrypted with the current encryption key, so this can also be used to move tokens to a new key.
+    Records are streamed from the dump and inserted with COPY in batches, each in its own transaction. Records whose id is already in the table are skipped, so an interrupted load can be run again. Where the dump holds several tokens for the same user and ORCID iD (as dumps made before token_history was added may), the newest becomes the current token, and the others are copied to token_history.
+    '''
+    keys = get_encryption_keys()
+    after_id = (db.session.query(func.max(Token.id)).scalar() or 0) if resume else 0
+    if after_id:
+        click.echo(f'Resuming load after id {after_id}')
+    records = (record for record in iter_dump_records(file) if record['id'] > after_id)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    # Batches being encrypted, in order; at most two per worker are queued at a time, to bound memory use
+    pending = deque()
+    loaded = superseded = skipped = 0
+    start = time.perf_counter()
+
+    def insert(data, count):
+        nonlocal loaded, superseded, skipped
+        inserted, archived = copy_tokens(data)
+        db.session.commit()
+        loaded += inserted
+        superseded += archived
+        skipped += count - inserted - archived
+        click.echo(f'Loaded {loaded} tokens, {superseded} superseded tokens to token_history, skipped {skipped} already present '
+                   f'({(loaded + superseded + skipped) / (time.perf_counter() - start):,.0f} rows/s)')
+
+    try:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if batch:
+                if executor:
+                    pending.append((executor.submit(_encrypt_chunk, keys, batch), len(batch)))
+                else:
+                    insert(_encrypt_chunk(keys, batch), len(batch))
+            while pending and (not batch or len(pending) >= workers * 2):
+                future, count = pending.popleft()
+                insert(future.result(), count)
+            if not batch:
+                break
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    reset_token_id_sequence()
+    db.session.commit()
+    click.echo(f'Load complete in {time.perf_counter() - start:.1f}s: {loaded} tokens loaded, {superseded} superseded tokens copied to token_history '
+               f'and {skipped} skipped, as already present')
+
+@click.command('latest-tokens')
+@click.argument('values', nargs=-1)
+@click.option('--by', type=click.Choice(['orcid', 'userId']), default='orcid', show_default=True, help='Return the latest token per ORCID iD or per user.')
+@click.option('--include-expired', is_flag=True, help='Include tokens that have expired.')
+@click.option('--output', type=click.File('w'), default='-', help='File to which to write the tokens (defaults to stdout).')
+@with_appcontext
+def latest_tokens(values, by, include_expired, output):
+    '''
+    Writes the most recent valid token per ORCID iD (or per user) as JSON Lines. Optionally, provide one or more ORCID iDs (or user IDs) to which to limit the results.
+    '''
+    query = Token.latest(by=by, values=values or None, valid_only=not include_expired)
+    for record in query.yield_per(1000):
+        output.write(json.dumps(record.to_dict()) + '\n')
+
+@click.command('exchange-worker')
+@click.option('--concurrency', default=10, show_default=True, help='Maximum number of concurrent requests to ORCID.')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Number of seconds between checks for new codes.')
+@click.option('--retry-backoff', default=2.0, show_default=True, help='Number of seconds before the first retry of a failed exchange; doubles with each attempt.')
+@click.option('--once', is_flag=True, help='Exit once the queue is empty, instead of running until interrupted.')
+@with_appcontext
+def exchange_worker(concurrency, poll_interval, retry_backoff, once):
+    '''
+    Exchanges the one-time codes queued by the app for tokens, when ASYNC_TOKEN_EXCHANGE is enabled. Run this in a separate process (or container) alongside the app.
+    '''
+    from orcidflask.exchange import run_exchange_worker
+    asyncio.run(run_exchange_worker(concurrency=concurrency, poll_interval=poll_interval, retry_backoff=retry_backoff, once=once))
+
+@click.command('refresh-tokens')
+@click.option('--within', default=30, show_default=True, help='Refresh tokens that expire within this many days.')
+@click.option('--workers', default=4, show_default=True, help='Maximum number of concurrent requests to ORCID.')
+@click.option('--rate', default=5.0, show_default=True, help='Maximum number of requests per second to ORCID.')
+@click.option('--batch-size', default=500, show_default=True, help='Number of tokens to write back per transaction.')
+@click.option('--revoke-old', is_flag=True, help='Have ORCID revoke the access tokens being replaced.')
+@click.option('--dry-run', is_flag=True, help='List the tokens that would be refreshed, without contacting ORCID.')
+@with_appcontext
+def refresh_tokens(within, workers, rate, batch_size, revoke_old, dry_run):
+    '''
+    Renews tokens that are about to expire (based on their timestamp and expires_in values), using their refresh tokens. Suitable for running as a scheduled job.
+    '''
+    from orcidflask.refresh import refresh_tokens
+    start = time.perf_counter()
+    outcomes = refresh_tokens(within * 86400, workers=workers, rate=rate, batch_size=batch_size,
+                              revoke_old=revoke_old, dry_run=dry_run, log=click.echo)
+    failures = sum(count for outcome, count in outcomes.items() if outcome not in ('refreshed', 'would refresh'))
+    click.echo(f'Done in {time.perf_counter() - start:.1f}s: ' + 
+               (', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()) or 'no tokens to refresh'))
+    if failures:
+        raise click.ClickException(f'{failures} tokens could not be refreshed')
+
+@click.command('harvest-records')
+@click.argument('orcids', nargs=-1)
+@click.option('--cache-dir', required=True, type=click.Path(file_okay=False), help='Directory in which to cache responses between runs, so that unchanged records are revalidated rather than downloaded again.')
+@click.option('--section', 'sections', multiple=True, default=['record'], show_default=True, help='Section of the record to fetch (e.g., record, works, employments); may be repeated.')
+@click.option('--output', type=click.File('w'), default='-', help='File to which to write the records (defaults to stdout).')
+@click.option('--changed-only', is_flag=True, help='Leave out records that have not changed since the last run.')
+@click.option('--workers', default=4, show_default=True, help='Maximum number of concurrent requests to ORCID.')
+@click.option('--rate', default=8.0, show_default=True, help='Maximum number of requests per second to ORCID.')
+@click.option('--batch-size', default=500, show_default=True, help='Number of tokens to load from the database at a time.')
+@with_appcontext
+def harvest_records(orcids, cache_dir, sections, output, changed_only, workers, rate, batch_size):
+    '''
+    Fetches ORCID records with the latest valid token for each ORCID iD, and writes them as JSON Lines. Optionally, provide one or more ORCID iDs to which to limit the harvest.
+    '''
+    from orcidflask.harvest import harvest_records
+    start = time.perf_counter()
+    outcomes = harvest_records(output, cache_dir, sections=sections, orcids=orcids or None, changed_only=changed_only,
+                               workers=workers, rate=rate, batch_size=batch_size, log=lambda message: click.echo(message, err=True))
+    failures = sum(count for outcome, count in outcomes.items() if outcome not in ('fetched', 'not modified'))
+    click.echo(f'Done in {time.perf_counter() - start:.1f}s: ' +
+               (', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()) or 'no tokens to harvest with'), err=True)
+    if failures:
+        raise click.ClickException(f'{failures} sections could not be harvested')
+
+@click.command('push-works')
+@click.argument('feed', type=click.File('r'))
+@click.option('--index', 'index_path', required=True, type=click.Path(dir_okay=False), help='SQLite database in which to keep the put-codes of the works pushed, so that later runs update or skip them rather than adding them again.')
+@click.option('--errors', type=click.File('w'), help='File to which to write the works that could not be pushed, as JSON Lines.')
+@click.option('--workers', default=4, show_default=True, help='Maximum number of concurrent requests to ORCID.')
+@click.option('--rate', default=8.0, show_default=True, help='Maximum number of requests per second to ORCID.')
+@click.option('--batch-size', default=100, show_default=True, help='Number of researchers whose tokens to load from the database at a time.')
+@with_appcontext
+def push_works(feed, index_path, errors, workers, rate, batch_size):
+    '''
+    Adds works to (or updates them in) researchers' ORCID records. FEED is a JSON Lines file (or - for stdin) with one work per line: {"orcid": ..., "key": ..., "work": {...}}, where key identifies the work between runs and work is in ORCID's JSON format.
+    '''
+    from orcidflask.push import push_works
+    start = time.perf_counter()
+    outcomes = push_works(feed, index_path, workers=workers, rate=rate, batch_size=batch_size, errors=errors, log=click.echo)
+    failures = sum(count for outcome, count in outcomes.items() if outcome not in ('created', 'updated', 'unchanged'))
+    click.echo(f'Done in {time.perf_counter() - start:.1f}s: ' +
+               (', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()) or 'no works to push'))
+    if failures:
+        raise click.ClickException(f'{failures} works could not be pushed')
+
+@click.command('rotate-key')
+@click.option('--checkpoint', type=click.Path(dir_okay=False), help='File in which to record progress, so that an interrupted rotation can be resumed. Defaults to the path of the encryption key file, with .rotation appended.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of records to re-encrypt per committed batch.')
+@click.option('--workers', default=1, show_default=True, help='Number of worker processes to use for re-encryption.')
+@with_appcontext
+def rotate_key(checkpoint, batch_size, workers):
+    '''
+    Re-encrypts all encrypted values in the database (current and superseded tokens, including archived months of token_history, and the codes of pending token exchanges) with the current encryption key. Before running this command, set DB_ENCRYPTION_FILE to the new key (see create-secret-key) and DB_PREVIOUS_ENCRYPTION_FILES to the old key, and restart the app, so that it can continue to read existing tokens during the rotation. Once this command has completed, the old key can be removed.
+    '''
+    keys = get_encryption_keys()
+    if len(keys) < 2:
+        raise click.UsageError('No previous encryption keys are configured (see DB_PREVIOUS_ENCRYPTION_FILES).')
+    checkpoint = checkpoint or current_app.config['DB_ENCRYPTION_FILE'] + '.rotation'
+    # Identify the rotation by the current key, so that a checkpoint from an earlier rotation is ignored
+    key_id = hashlib.sha256(keys[0]).hexdigest()
+    from orcidflask.compaction import archived_tables
+    # Archived months of token_history are encrypted too (see compact-tokens)
+    tables = encrypted_tables() + archived_tables()
+    # Progress of each table, by name: the last id re-encrypted, and whether the table is done
+    progress = {table.name: {'last_id': 0, 'done': False} for table in tables}
+    if os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        if state['key'] == key_id:
+            # Checkpoints written before other tables were rotated only cover the token table
+            progress.update(state.get('tables', {'token': {'last_id': state.get('last_id', 0), 'done': False}}))
+            click.echo('Resuming rotation: ' + ', '.join(f'{name} {"done" if p["done"] else "after id " + str(p["last_id"])}'
+                                                        for name, p in progress.items()))
+
+    def save():
+        with open(checkpoint, 'w') as f:
+            json.dump({'key': key_id, 'tables': progress}, f)
+
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    start = time.perf_counter()
+    totals = {}
+    try:
+        for table in tables:
+            if progress[table.name]['done']:
+                continue
+            total = 0
+            table_start = time.perf_counter()
+            for last_id, count in rotate_encryption(table, batch_size=batch_size, after_id=progress[table.name]['last_id'], executor=executor):
+                progress[table.name]['last_id'] = last_id
+                save()
+                total += count
+                click.echo(f'{table.name}: re-encrypted {total} rows through id {last_id} ({total / (time.perf_counter() - table_start):,.0f} rows/s)')
+            progress[table.name]['done'] = True
+            save()
+            totals[table.name] = total
+    finally:
+        if executor:
+            executor.shutdown()
+    click.echo(f'Rotation complete in {time.perf_counter() - start:.1f}s: ' + ', '.join(f'{total} rows of {name}' for name, total in totals.items()))
+
+@click.command('compact-tokens')
+@click.option('--retention-days', type=int, help='Remove superseded tokens after this many days. Defaults to TOKEN_HISTORY_RETENTION_DAYS.')
+@click.option('--policy', type=click.Choice(['delete', 'archive']), help='Drop the partitions of token_history past the retention period, or detach them and keep them as separate archive tables. Defaults to TOKEN_HISTORY_RETENTION_POLICY.')
+@click.option('--expired-after-days', type=int, help='Move tokens that have been expired for this many days from the token table to token_history. Defaults to EXPIRED_TOKEN_RETENTION_DAYS.')
+@click.option('--ahead', default=3, show_default=True, help='Number of months ahead for which to create partitions of token_history.')
+@click.option('--batch-size', default=1000, show_default=True, help='Number of expired tokens to move per transaction.')
+@click.option('--lock-timeout', default=5.0, show_default=True, help='Number of seconds to wait for a lock on token_history before leaving a step for the next run.')
+@click.option('--dry-run', is_flag=True, help='Report what would be done, without changing anything.')
+@with_appcontext
+def compact_tokens(retention_days, policy, expired_after_days, ahead, batch_size, lock_timeout, dry_run):
+    '''
+    Maintains the monthly partitions of token_history, and removes superseded and expired tokens according to the retention policy. Suitable for running as a scheduled job (at least monthly, so that partitions are created ahead of time).
+    '''
+    from orcidflask.compaction import compact_tokens
+    config = current_app.config
+    start = time.perf_counter()
+    outcomes = compact_tokens(retention_days=config['TOKEN_HISTORY_RETENTION_DAYS'] if retention_days is None else retention_days,
+                              policy=policy or config['TOKEN_HISTORY_RETENTION_POLICY'],
+                              expired_after_days=config['EXPIRED_TOKEN_RETENTION_DAYS'] if expired_after_days is None else expired_after_days,
+                              ahead=ahead, batch_size=batch_size, lock_timeout=lock_timeout, dry_run=dry_run, log=click.echo)
+    click.echo(f'Done in {time.perf_counter() - start:.1f}s: ' +
+               (', '.join(f'{outcome}: {count:,}' for outcome, count in outcomes.items()) or 'nothing to do'))
+    if outcomes['lock timeouts']:
+        raise click.ClickException(f'{outcomes["lock timeouts"]} steps could not lock token_history and were skipped')
+
+def register_commands(app):
+    '''
+    Adds the commands in this module to the app's flask command
+    '''
+    for command in (create_secret_key, reset_db, serialize_db, load_db, export_changes, latest_tokens, exchange_worker, refresh_tokens, harvest_records, push_works, rotate_key, compact_tokens):
+        app.cli.add_command(command)
@@ -0,0 +1,191 @@
+'''
+Retention of superseded and expired tokens (see the compact-tokens command). token_history is partitioned by month of the superseded column, so that tokens older than the retention period are removed a month at a time, by detaching the month's partition (which is then dropped, or kept as an archive table), rather than by deleting rows. DDL statements are run with a lock timeout, so that compaction gives up, rather than holding up logins, if it cannot lock the table quickly.
+'''
+import re
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text, select, MetaData
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import func
+from orcidflask import db
+from orcidflask.models import Token, TokenHistory
+
+PARTITION_PATTERN = re.compile(r'token_history_p(\d{4})_(\d{2})$')
+
+def month_start(dt, months=0):
+    '''
+    Returns the start (in UTC) of the month containing dt, moved forward or back by the provided number of months
+    '''
+    dt = dt.astimezone(timezone.utc)
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+def set_lock_timeout(seconds):
+    db.session.execute(text(f"SET LOCAL lock_timeout = '{int(seconds * 1000)}ms'"))
+
+def history_partitions():
+    '''
+    Returns a dict mapping the start of each month that has a partition of token_history to the partition's name
+    '''
+    names = db.session.execute(text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                    "WHERE i.inhparent = 'token_history'::regclass")).scalars()
+    partitions = {}
+    for name in names:
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            partitions[datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc)] = name
+    return partitions
+
+def archived_tables():
+    '''
+    Returns Table objects for the archived partitions of token_history (see remove_partition), which have the same columns, so that they can be re-encrypted along with it (see models.rotate_encryption)
+    '''
+    names = db.session.execute(text(r"SELECT relname FROM pg_class WHERE relkind = 'r' AND relname LIKE 'token\_history\_archive\_%' "
+                                    "AND relnamespace = current_schema()::regnamespace ORDER BY relname")).scalars()
+    return [TokenHistory.__table__.to_metadata(MetaData(), name=name) for name in names]
+
+def storage_size():
+    '''
+    Returns the size on disk of the token table and of all partitions of token_history, with their indexes, in bytes
+    '''
+    return db.session.execute(text("SELECT pg_total_relation_size('token') + "
+                                   "(SELECT coalesce(sum(pg_total_relation_size(relid)), 0) FROM pg_partition_tree('token_history'))")).scalar()
+
+def create_partition(start, lock_timeout=5):
+    '''
+    Creates the partition of token_history for the month starting at start, and commits. Any rows for that month in the default partition are moved into it. The partition is filled while it is still a separate table and then attached, which does not block inserts into the other partitions.
+    Returns the number of rows moved.
+    '''
+    name = f'token_history_p{start:%Y_%m}'
+    bounds = f"FROM ('{start.isoformat()}') TO ('{month_start(start, 1).isoformat()}')"
+    condition = f"superseded >= '{start.isoformat()}' AND superseded < '{month_start(start, 1).isoformat()}'"
+    db.session.execute(text(f'CREATE TABLE {name} (LIKE token_history INCLUDING DEFAULTS)'))
+    # The constraint spares Postgres from scanning the new partition while attaching it
+    db.session.execute(text(f'ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK ({condition})'))
+    set_lock_timeout(lock_timeout)
+    # Keep rows for the month out of the default partition until the new partition is attached. Tokens are superseded at the current time, so for the current (or a future) month, inserts into token_history must wait, or they could be routed to the default partition just before the attach, and then fail. This takes long only if the default partition holds many of the month's rows, i.e., on the first run after the migration.
+    current = db.session.execute(select(func.now() < month_start(start, 1))).scalar()
+    db.session.execute(text(f'LOCK TABLE {"token_history" if current else "token_history_default"} IN SHARE ROW EXCLUSIVE MODE'))
+    moved = db.session.execute(text(f'WITH moved AS (DELETE FROM token_history_default WHERE {condition} RETURNING *) '
+                                    f'INSERT INTO {name} SELECT * FROM moved')).rowcount
+    db.session.execute(text(f'ALTER TABLE token_history ATTACH PARTITION {name} FOR VALUES {bounds}'))
+    db.session.execute(text(f'ALTER TABLE {name} DROP CONSTRAINT {name}_bounds'))
+    db.session.commit()
+    return moved
+
+def remove_partition(start, name, policy, lock_timeout=5):
+    '''
+    Detaches the partition of token_history for the month starting at start, and then drops it (policy 'delete') or renames it to token_history_archive_YYYY_MM (policy 'archive'), and commits.
+    Returns the number of rows and the number of bytes that the partition held.
+    '''
+    rows = db.session.execute(text(f'SELECT count(*) FROM {name}')).scalar()
+    size = db.session.execute(text(f"SELECT pg_total_relation_size('{name}')")).scalar()
+    set_lock_timeout(lock_timeout)
+    db.session.execute(text(f'ALTER TABLE token_history DETACH PARTITION {name}'))
+    if policy == 'delete':
+        db.session.execute(text(f'DROP TABLE {name}'))
+    else:
+        db.session.execute(text(f'ALTER TABLE {name} RENAME TO token_history_archive_{start:%Y_%m}'))
+    db.session.commit()
+    return rows, size
+
+def expire_tokens(after, batch_size=1000, dry_run=False):
+    '''
+    Moves the current tokens that expired more than after seconds ago to token_history, one committed batch at a time. Rows locked by concurrent upserts are skipped, and picked up by the next run.
+    Returns the number of tokens moved.
+    '''
+    table = Token.__table__
+    columns = ['userId', 'access_token', 'refresh_token', 'expires_in', 'token_scope', 'orcid']
+    expired = Token.expires_at() < func.now() - timedelta(seconds=after)
+    if dry_run:
+        return db.session.query(func.count(Token.id)).filter(expired).scalar()
+    total = 0
+    while True:
+        ids = [id for id, in db.session.query(Token.id).filter(expired).limit(batch_size).with_for_update(skip_locked=True)]
+        if not ids:
+            return total
+        db.session.execute(TokenHistory.__table__.insert().from_select(['token_id'] + columns + ['timestamp'],
+                           select(table.c.id, *[table.c[column] for column in columns], table.c.timestamp).where(table.c.id.in_(ids))))
+        db.session.execute(table.delete().where(table.c.id.in_(ids)))
+        db.session.commit()
+        total += len(ids)
+
+def compact_tokens(retention_days=None, policy='delete', expired_after_days=None, ahead=3, batch_size=1000, lock_timeout=5, dry_run=False, log=print):
+    '''
+    Compacts token storage in three steps:
+    1. Creates the monthly partitions of token_history for the coming months, and for any months whose rows are in the default partition (e.g., after the migration that partitioned the table), moving those rows into them.
+    2. Moves current tokens that have been expired for expired_after_days to token_history, if set.
+    3. Removes the partitions of token_history for months that ended more than retention_days ago, if set, according to the policy.
+    A step that cannot take a lock within lock_timeout seconds is skipped, and left for the next run.
+    Returns a Counter of outcomes (e.g., partitions created, rows deleted, and bytes freed by dropping partitions).
+    :param retention_days: number of days for which to keep superseded tokens, or None to keep them indefinitely
+    :param policy: either 'delete' (drop the partitions past the retention period) or 'archive' (detach them, and keep them as separate tables)
+    :param expired_after_days: number of days after which to move expired tokens out of the token table, or None to leave them
+    :param ahead: number of months ahead for which to create partitions
+    :param batch_size: number of expired tokens to move per transaction
+    :param lock_timeout: number of seconds to wait for a lock before giving up
+    :param dry_run: set to True to report what would be done, without changing anything
+    :param log: function with which to report progress
+    '''
+    outcomes = Counter()
+    size_before = storage_size()
+    db.session.rollback()
+
+    def attempt(description, step, *args):
+        try:
+            return step(*args)
+        except OperationalError as e:
+            db.session.rollback()
+            # lock_not_available, raised when the lock timeout is reached
+            if getattr(e.orig, 'pgcode', None) != '55P03':
+                raise
+            outcomes['lock timeouts'] += 1
+            log(f'Could not lock token_history within {lock_timeout}s; will {description} on the next run')
+
+    now = db.session.execute(select(func.now())).scalar()
+    partitions = history_partitions()
+    months = {month_start(now, i) for i in range(ahead + 1)}
+    months.update(month_start(superseded) for superseded, in db.session.execute(
+        text("SELECT DISTINCT date_trunc('month', superseded, 'UTC') FROM token_history_default")))
+    db.session.rollback()
+    for start in sorted(months - set(partitions)):
+        if dry_run:
+            partitions[start] = f'token_history_p{start:%Y_%m}'
+            log(f'Would create partition token_history_p{start:%Y_%m}')
+            continue
+        moved = attempt(f'create partition token_history_p{start:%Y_%m}', create_partition, start, lock_timeout)
+        if moved is not None:
+            partitions[start] = f'token_history_p{start:%Y_%m}'
+            outcomes['partitions created'] += 1
+            outcomes['rows moved from default partition'] += moved
+            log(f'Created partition token_history_p{start:%Y_%m} ({moved} rows moved from the default partition)')
+
+    if outcomes['rows moved from default partition']:
+        # Gives the space left by the moved rows back to the operating system (VACUUM skips this step rather than wait for a lock)
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(text('VACUUM token_history_default'))
+
+    if expired_after_days is not None:
+        moved = expire_tokens(expired_after_days * 86400, batch_size=batch_size, dry_run=dry_run)
+        outcomes['expired tokens would be moved' if dry_run else 'expired tokens moved'] += moved
+        log(f'{"Would move" if dry_run else "Moved"} {moved} expired tokens to token_history')
+
+    if retention_days is not None:
+        cutoff = now - timedelta(days=retention_days)
+        for start, name in sorted(partitions.items()):
+            if month_start(start, 1) > cutoff:
+                continue
+            if dry_run:
+                log(f'Would {policy} partition {name}')
+                continue
+            result = attempt(f'{policy} partition {name}', remove_partition, start, name, policy, lock_timeout)
+            if result is not None:
+                rows, size = result
+                outcomes['partitions deleted' if policy == 'delete' else 'partitions archived'] += 1
+                outcomes['rows deleted' if policy == 'delete' else 'rows archived'] += rows
+                outcomes['bytes freed' if policy == 'delete' else 'bytes archived'] += size
+                log(f'{"Dropped" if policy == "delete" else "Archived"} partition {name} ({rows} rows, {size / 2 ** 20:,.1f} MiB)')
+
+    log(f'token and token_history: {size_before / 2 ** 20:,.1f} MiB before, {storage_size() / 2 ** 20:,.1f} MiB after')
+    db.session.rollback()
+    return outcomes
@@ -1 +1,76 @@
-DEBUG = True
\ No newline at end of file
+DEBUG = True
+# Connect and read timeouts (in seconds) for requests to ORCID
+ORCID_HTTP_TIMEOUT = (3.05, 10)
+# Number of times to retry a request to ORCID after a connection error or a 429/5xx response, and the backoff factor (in seconds) between retries. POST requests (e.g., to the token endpoint) are retried only after connection errors and 429/503 responses, when ORCID cannot have processed them (see OrcidRetry).
+ORCID_HTTP_RETRIES = 3
+ORCID_HTTP_BACKOFF = 0.5
+# Maximum number of keep-alive connections to ORCID per worker process
+ORCID_HTTP_POOL_SIZE = 10
+# After this many consecutive failed requests, stop calling ORCID for ORCID_CIRCUIT_RESET_TIMEOUT seconds
+ORCID_CIRCUIT_FAILURE_THRESHOLD = 5
+ORCID_CIRCUIT_RESET_TIMEOUT = 30
+# Set to True to queue the one-time codes from ORCID for exchange by a separate process (flask exchange-worker), instead of exchanging them while the user waits
+ASYNC_TOKEN_EXCHANGE = False
+# Number of seconds between refreshes of the status page shown while a queued exchange is in progress
+ASYNC_TOKEN_EXCHANGE_POLL_INTERVAL = 2
+# Number of seconds for which a one-time code from ORCID is valid; queued codes older than this are not exchanged
+ORCID_CODE_LIFETIME = 600
+# Set to True to group tokens saved by concurrent requests into a single transaction (useful only with threaded workers, e.g., gunicorn's gthread)
+BATCH_TOKEN_WRITES = False
+# Maximum number of tokens per transaction, and maximum number of seconds to wait for more tokens before committing
+TOKEN_WRITE_BATCH_SIZE = 100
+TOKEN_WRITE_BATCH_WAIT = 0.05
+# Set to False to skip loading the SAML settings when the app starts (they are loaded on first use, and reloaded whenever the files change)
+SAML_VALIDATE_ON_STARTUP = True
+# Number of seconds for which clients may cache the SP metadata served at /metadata/
+SAML_METADATA_MAX_AGE = 3600
+# Optional path to a metadata file written by generate_saml_metadata.py, to serve at /metadata/ instead of rendering the metadata in the app
+SAML_METADATA_FILE = None
+# Where to record the IDs of consumed SAML responses, so that replayed (or resubmitted) responses are rejected before their signatures are verified: 'sqlalchemy' (the saml_replay table, shared by all worker processes), 'memory' (per worker process only) or None (no replay detection)
+SAML_REPLAY_CACHE = 'sqlalchemy'
+# Number of seconds for which to remember a response ID when its assertion carries no NotOnOrAfter time
+SAML_REPLAY_CACHE_TTL = 3600
+# Where to keep session data: 'cookie' (Flask's default signed-cookie sessions), 'sqlalchemy' (a database table shared by all workers) or 'memory' (an in-process cache; single worker process only). With the latter two, the cookie holds only a session id.
+SESSION_BACKEND = 'cookie'
+# Number of seconds for which server-side session data is kept after it was last modified
+SESSION_STORE_TTL = 28800
+# Number of seconds between purges of expired server-side sessions
+SESSION_PURGE_INTERVAL = 300
+# Maximum number of sessions kept by the 'memory' backend
+SESSION_STORE_MAXSIZE = 10000
+# Optional bearer token required to read /metrics (e.g., by Prometheus's authorization setting); if None, /metrics is open to anyone who can reach the app
+METRICS_TOKEN = None
+# Limits on requests to the endpoints that verify SAML responses or call ORCID, shared by all worker processes on a host (see orcidflask/admission.py). For each endpoint: rate (average requests per second), burst (requests allowed at once above the rate), concurrency (requests handled at once; optional), methods (the HTTP methods limited; optional, defaults to all) and retry_after (seconds to wait when the concurrency cap is reached; optional). Requests over a limit get a 503 page with a Retry-After header. Set to {} to turn off.
+RATE_LIMITS = {
+    # The ACS (SAML responses are posted to /?acs)
+    'views.index': {'rate': 100, 'burst': 200, 'concurrency': 32, 'methods': ['POST']},
+    'views.orcid_redirect': {'rate': 50, 'burst': 100, 'concurrency': 32},
+}
+# File in which the state of the limits is shared between worker processes; if None, a file in the system's temporary directory
+ADMISSION_STATE_FILE = None
+# Retention of tokens (see the compact-tokens command): number of days for which to keep superseded tokens in token_history (None to keep them indefinitely), whether to 'delete' them or 'archive' them (detaching each month's partition as a separate table, e.g., to be dumped and dropped), and number of days after which to move expired tokens out of the token table (None to leave them)
+TOKEN_HISTORY_RETENTION_DAYS = None
+TOKEN_HISTORY_RETENTION_POLICY = 'delete'
+EXPIRED_TOKEN_RETENTION_DAYS = None
+# Where to write the audit trail of authorizations (see orcidflask/audit.py): 'sqlalchemy' (the append-only audit_event table), 'jsonl' (JSON Lines files at AUDIT_LOG_FILE, rotated at AUDIT_LOG_MAX_BYTES, keeping AUDIT_LOG_BACKUP_COUNT old files) or None (no audit trail)
+AUDIT_SINK = 'sqlalchemy'
+AUDIT_LOG_FILE = '/opt/orcid_integration/data/audit.jsonl'
+AUDIT_LOG_MAX_BYTES = 100 * 1024 * 1024
+AUDIT_LOG_BACKUP_COUNT = 10
+# Maximum number of audit events waiting to be written, per worker process; further events are dropped (and logged) until the queue drains
+AUDIT_QUEUE_SIZE = 10000
+# Maximum number of audit events written at a time, and number of seconds to wait for more events before writing
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 1.0
+# Keys for the internal token lookup API (see orcidflask/api.py), as a dict of client names to keys, e.g., {'works-push': '...'}. Clients send a key as a bearer token. The API is turned off if this is empty.
+API_KEYS = {}
+# Number of seconds for which each worker process caches the tokens looked up through the API. Tokens saved by the app invalidate the cache of the process that saved them, but other processes (and the exchange-worker and refresh-tokens commands) may serve the previous token for up to this long.
+API_CACHE_TTL = 60
+# Maximum number of tokens cached per worker process
+API_CACHE_MAXSIZE = 100000
+# Maximum number of ORCID iDs per request to /api/tokens:lookup
+API_LOOKUP_MAX_BATCH = 1000
+# Connection pool settings for each worker process. With gthread or gevent workers (see gunicorn.conf.py), pool_size + max_overflow should be at least the number of threads (or concurrent greenlets) per worker, and the total across all workers should stay below Postgres's max_connections. pool_pre_ping replaces connections dropped by the database (e.g., after a restart), and pool_recycle replaces connections older than the given number of seconds.
+SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 5, 'max_overflow': 10, 'pool_timeout': 30, 'pool_pre_ping': True, 'pool_recycle': 1800}
+# Optional base URL of ORCID's site and API (the member API being served under /v3.0), overriding the one chosen by the ORCID_SERVER environment variable (e.g., to use a stub server for load testing)
+ORCID_BASE_URL = None
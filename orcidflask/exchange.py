@@ -0,0 +1,147 @@
+'''
+Worker for exchanging queued one-time codes from ORCID for tokens (see ASYNC_TOKEN_EXCHANGE). The worker claims codes from the token_exchange table, requests tokens from ORCID concurrently, and saves each token in the same transaction that marks its code as done, so that no exchange is lost. ORCID's response is saved on the exchange before the token is written, so that if the worker cannot write the token, the exchange is finished from the saved response, rather than by sending the (already used) code again. Several workers may be run at once.
+'''
+import asyncio
+import json
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import func
+from requests.exceptions import RequestException
+from orcidflask import db
+from orcidflask.models import Token, TokenExchange, upsert_tokens
+from orcidflask.audit import audit
+from orcid_utils import prepare_token_payload, request_orcid_token, CircuitOpenError
+
+# Number of times to try to save the outcome of an exchange (e.g., if the database is briefly unavailable) before leaving it to be reclaimed
+DB_ATTEMPTS = 5
+
+def expire_exchanges():
+    '''
+    Marks as failed any pending exchanges whose codes are too old to be used, and removes their codes. Exchanges being processed are left to their workers (or, if a worker has died, to the worker that reclaims them), since their codes may already have been exchanged.
+    '''
+    app = current_app._get_current_object()
+    expired = TokenExchange.query.filter(TokenExchange.status == 'pending',
+                                        TokenExchange.created < func.now() - timedelta(seconds=app.config['ORCID_CODE_LIFETIME']))
+    count = expired.update({'status': 'failed', 'error': 'Code expired', 'code': None}, synchronize_session=False)
+    db.session.commit()
+    return count
+
+def claim_exchanges(limit, processing_timeout=300):
+    '''
+    Claims up to limit exchanges that are ready to be attempted, returning them as a list of dicts. Rows locked by other workers are skipped.
+    :param limit: maximum number of exchanges to claim
+    :param processing_timeout: number of seconds after which an exchange claimed by a worker that has since died may be claimed again
+    '''
+    exchanges = (TokenExchange.query
+                .filter(or_(
+                    (TokenExchange.status == 'pending') & (TokenExchange.next_attempt <= func.now()),
+                    (TokenExchange.status == 'processing') & (TokenExchange.updated < func.now() - timedelta(seconds=processing_timeout))))
+                .order_by(TokenExchange.id)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+                .all())
+    claimed = []
+    for exchange in exchanges:
+        exchange.status = 'processing'
+        exchange.attempts += 1
+        claimed.append({'id': exchange.id, 'userId': exchange.userId, 'code': exchange.code, 'response': exchange.response,
+                        'redirect_uri': exchange.redirect_uri, 'attempts': exchange.attempts})
+    db.session.commit()
+    return claimed
+
+def request_token(app, exchange):
+    '''
+    Requests a token from ORCID for a claimed exchange. Runs in a worker thread, so pushes its own app context.
+    Returns a (status, result) tuple, where status is one of done, retry or failed, and result is either the decoded response or an error message.
+    '''
+    if exchange['response']:
+        # Exchanged by an earlier attempt, which could not store the token
+        return 'done', json.loads(exchange['response'])
+    with app.app_context():
+        try:
+            response = request_orcid_token(prepare_token_payload(exchange['code'], exchange['redirect_uri']))
+        except (RequestException, CircuitOpenError) as e:
+            return 'retry', str(e)
+        if response.ok:
+            return 'done', response.json()
+        # The client has already retried 429 and 5xx responses, but they may succeed later
+        elif response.status_code >= 500 or response.status_code == 429:
+            return 'retry', f'HTTPError {response.status_code}; Message {response.text}'
+        return 'failed', f'HTTPError {response.status_code}; Message {response.text}'
+
+def record_result(exchange, status, result, retry_backoff):
+    '''
+    Saves the outcome of an exchange. On success, ORCID's response is saved first, and the token is then stored in the same transaction that marks the exchange as done.
+    '''
+    app = current_app._get_current_object()
+    record = TokenExchange.query.get(exchange['id'])
+    if status == 'done':
+        if not exchange['response']:
+            # The code has been used, so keep the response until the token is stored
+            exchange['response'] = record.response = json.dumps(result)
+            record.code = None
+            db.session.commit()
+        token = Token.values_from_orcid_auth(exchange['userId'], result)
+        upsert_tokens([token])
+        record.status = 'done'
+        record.code = None
+        record.response = None
+        record.error = None
+    elif status == 'retry':
+        record.status = 'pending'
+        record.error = result
+        record.next_attempt = func.now() + timedelta(seconds=retry_backoff * 2 ** (exchange['attempts'] - 1))
+        app.logger.warning(f'Token exchange {exchange["id"]} will be retried: {result}')
+    else:
+        record.status = 'failed'
+        record.code = None
+        record.error = result
+        app.logger.error(f'Token exchange {exchange["id"]} failed: {result}')
+    db.session.commit()
+    # Audited once the outcome is saved, so that an exchange rolled back and retried is not recorded twice
+    if status == 'done':
+        audit('consent_granted', user_id=exchange['userId'], orcid=token['orcid'], scope=token['token_scope'], exchange=exchange['id'])
+    elif status == 'failed':
+        audit('oauth_error', user_id=exchange['userId'], error=result, exchange=exchange['id'])
+
+async def run_exchange_worker(concurrency=10, poll_interval=1.0, retry_backoff=2.0, once=False):
+    '''
+    Processes queued exchanges until interrupted, keeping up to concurrency requests to ORCID in flight. Database access happens on the event loop's thread; requests to ORCID run in worker threads.
+    :param concurrency: maximum number of concurrent requests to ORCID
+    :param poll_interval: number of seconds to wait between checks for new exchanges
+    :param retry_backoff: number of seconds to wait before the first retry of a failed exchange; doubles with each attempt
+    :param once: set to True to return once the queue is empty
+    '''
+    app = current_app._get_current_object()
+
+    async def process(exchange):
+        status, result = await asyncio.to_thread(request_token, app, exchange)
+        for attempt in range(DB_ATTEMPTS):
+            try:
+                return record_result(exchange, status, result, retry_backoff)
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                if attempt == DB_ATTEMPTS - 1:
+                    raise
+                app.logger.warning(f'Could not save the outcome of token exchange {exchange["id"]}; will try again: {e!r}')
+                await asyncio.sleep(retry_backoff * 2 ** attempt)
+
+    in_flight = set()
+    while True:
+        expire_exchanges()
+        if len(in_flight) < concurrency:
+            for exchange in claim_exchanges(concurrency - len(in_flight)):
+                in_flight.add(asyncio.create_task(process(exchange)))
+        if not in_flight:
+            if once:
+                return
+            await asyncio.sleep(poll_interval)
+            continue
+        done, in_flight = await asyncio.wait(in_flight, timeout=poll_interval, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Surface unexpected errors (e.g., the database being unavailable for longer than the retries); the exchange will be reclaimed after the processing timeout, and finished from the saved response, if any
+            if task.exception():
+                db.session.rollback()
+                app.logger.error(f'Token exchange worker error: {task.exception()!r}')
@@ -0,0 +1,137 @@
+'''
+Harvesting of ORCID records with the tokens collected by the app (see the harvest-records command). Responses are kept in an on-disk cache and revalidated with conditional requests, so that records that have not changed since the last harvest cost ORCID only a 304 Not Modified.
+'''
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from requests.exceptions import RequestException
+from orcidflask import db
+from orcidflask.models import Token
+from orcid_utils import create_orcid_client, HostRateLimiter, CircuitOpenError
+
+class RecordCache:
+    '''
+    Cache of API responses on disk, one JSON file per URL, with the validators (ETag and Last-Modified) needed to revalidate them. Files are replaced in one step, so that an interrupted harvest never leaves a partially written entry.
+    :param directory: directory in which to keep the cache (created if necessary)
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url):
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        # Spread the files across subdirectories, to keep directories small
+        return os.path.join(self.directory, digest[:2], digest + '.json')
+
+    def get(self, url):
+        '''
+        Returns the cached entry for url, a dict with the keys etag, last_modified and body, or None
+        '''
+        try:
+            with open(self.path(url)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, url, etag, last_modified, body):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'url': url, 'etag': etag, 'last_modified': last_modified, 'body': body}, f)
+        os.replace(tmp, path)
+
+def fetch_section(client, cache, url, access_token):
+    '''
+    Gets a section of a record from ORCID's API, revalidating the cached copy, if any. Runs in a worker thread.
+    Returns an (outcome, body) tuple, where outcome is 'fetched', 'not modified' or a short description of the failure, and body is the decoded record or an error message.
+    '''
+    headers = {'Accept': 'application/vnd.orcid+json', 'Authorization': f'Bearer {access_token}'}
+    cached = cache.get(url)
+    # Only a cached copy with a body can stand in for the record if it has not changed
+    if cached and cached.get('body') is None:
+        cached = None
+    validators = {}
+    if cached:
+        if cached['etag']:
+            validators['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            validators['If-Modified-Since'] = cached['last_modified']
+    try:
+        response = client.get(url, headers={**headers, **validators})
+        if response.status_code == 304 and not cached:
+            # Nothing to fall back on (e.g., the cached copy could not be read, or a proxy answered from its own cache), so ask for the full record
+            response = client.get(url, headers={**headers, 'Cache-Control': 'no-cache'})
+    except CircuitOpenError as e:
+        return 'circuit open', str(e)
+    except RequestException as e:
+        return type(e).__name__, str(e)
+    if response.status_code == 304:
+        if cached:
+            return 'not modified', cached['body']
+        return 'HTTP 304', 'Not modified, with no cached copy of the record'
+    if not response.ok:
+        return f'HTTP {response.status_code}', response.text
+    try:
+        body = response.json()
+    except ValueError as e:
+        return 'invalid JSON', str(e)
+    if response.headers.get('ETag') or response.headers.get('Last-Modified'):
+        cache.set(url, response.headers.get('ETag'), response.headers.get('Last-Modified'), body)
+    return 'fetched', body
+
+def harvest_records(output, cache_dir, sections=('record',), orcids=None, changed_only=False, workers=4, rate=8.0, batch_size=500, log=print):
+    '''
+    Fetches the provided sections of the record of every ORCID iD with a valid token (or of the provided ORCID iDs), using the latest token for each, and writes them to output as JSON Lines: {"orcid": ..., "section": ..., "status": "fetched" or "not modified", "record": ...}. Requests are made by a pool of worker threads, subject to a per-host rate limit.
+    Returns a Counter of outcomes (fetched, not modified, or the type of failure).
+    :param output: a file-like object opened for writing text
+    :param cache_dir: directory in which to cache responses (see RecordCache)
+    :param sections: sections of the record to fetch, e.g., 'record', 'works' or 'employments'
+    :param orcids: an optional list of ORCID iDs to which to limit the harvest
+    :param changed_only: set to True to leave out records that have not changed since the last harvest
+    :param workers: maximum number of concurrent requests to ORCID
+    :param rate: maximum number of requests per second to each ORCID host
+    :param batch_size: number of tokens to load from the database at a time
+    :param log: function with which to report progress
+    '''
+    app = current_app._get_current_object()
+    api_url = app.config['orcid_api_url']
+    client = create_orcid_client(pool_size=workers, rate_limiter=HostRateLimiter(rate, burst=workers))
+    cache = RecordCache(cache_dir)
+    # Find the latest tokens first, and then load and decrypt them in batches, rather than keeping a cursor open for the whole harvest
+    ids = [id for id, in Token.latest(by='orcid', values=orcids).with_entities(Token.id)]
+    outcomes = Counter()
+
+    def fetch(task):
+        token, section = task
+        try:
+            return fetch_section(client, cache, f'{api_url}/{token["orcid"]}/{section}', token['access_token'])
+        except Exception as e:
+            # An unexpected error (e.g., the cache's disk is full) fails this section, rather than the whole harvest
+            app.logger.exception(f'Error harvesting {section} for {token["orcid"]}')
+            return type(e).__name__, str(e)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(0, len(ids), batch_size):
+            rows = db.session.query(*Token.raw_columns()).filter(Token.id.in_(ids[i:i + batch_size])).order_by(Token.orcid).all()
+            tokens = Token.decrypt_rows(rows)
+            db.session.rollback()
+            tasks = [(token, section) for token in tokens for section in sections]
+            results = executor.map(fetch, tasks)
+            for (token, section), (outcome, body) in zip(tasks, results):
+                outcomes[outcome] += 1
+                if outcome == 'fetched' or (outcome == 'not modified' and not changed_only):
+                    output.write(json.dumps({'orcid': token['orcid'], 'section': section, 'status': outcome, 'record': body}) + '\n')
+                elif outcome != 'not modified':
+                    app.logger.error(f'Failed to harvest {section} for {token["orcid"]}: {outcome}; {body}')
+            output.flush()
+            elapsed = time.perf_counter() - start
+            log(f'Harvested {sum(outcomes.values())} sections in {elapsed:.1f}s ({sum(outcomes.values()) / elapsed:,.1f} sections/s); ' +
+                ', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()))
+    return outcomes
@@ -0,0 +1,82 @@
+'''
+Prometheus metrics for the app, served at /metrics. Under gunicorn, the PROMETHEUS_MULTIPROC_DIR environment variable is set to a directory (see gunicorn.conf.py), so that each worker process records its metrics there and /metrics reports the totals across all workers. It should not be set for flask commands, whose metrics are not served, or their files would build up in the directory and be reported with the web server's.
+'''
+import os
+import time
+from contextlib import contextmanager
+from flask import request, g
+from sqlalchemy import event
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+# Buckets (in seconds) spanning fast in-process work through slow calls to ORCID
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUESTS = Counter('orcidflask_requests_total', 'Number of HTTP requests handled', ['endpoint', 'method', 'status'])
+REQUEST_LATENCY = Histogram('orcidflask_request_duration_seconds', 'Time spent handling HTTP requests', ['endpoint'], buckets=BUCKETS)
+OPERATION_LATENCY = Histogram('orcidflask_operation_duration_seconds', 'Time spent in individual operations (SAML processing, ORCID calls, encryption, database commits)', ['operation'], buckets=BUCKETS)
+ORCID_RESPONSES = Counter('orcidflask_orcid_token_responses_total', 'Number of responses from ORCID\'s token endpoint, by status code (or error)', ['status'])
+
+@contextmanager
+def timed(operation):
+    '''
+    Records the time spent in the with block under the provided operation name
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        OPERATION_LATENCY.labels(operation).observe(time.perf_counter() - start)
+
+def observe(operation, elapsed):
+    '''
+    Records a time (in seconds) measured elsewhere under the provided operation name
+    '''
+    OPERATION_LATENCY.labels(operation).observe(elapsed)
+
+def instrument_app(app, db):
+    '''
+    Records the count and latency of requests to each endpoint, and the time spent in each database commit
+    :param app: the Flask app
+    :param db: the app's SQLAlchemy object
+    '''
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('request_start', None)
+        endpoint = request.endpoint or 'none'
+        if start is not None and endpoint != 'views.metrics':
+            REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+            REQUESTS.labels(endpoint, request.method, response.status_code).inc()
+        return response
+
+    # The session is shared by all apps, so its listeners are only added once
+    if not event.contains(db.session, 'before_commit', start_commit):
+        event.listen(db.session, 'before_commit', start_commit)
+        event.listen(db.session, 'after_commit', record_commit)
+        event.listen(db.session, 'after_rollback', discard_commit)
+
+def start_commit(session):
+    session.info['commit_start'] = time.perf_counter()
+
+def record_commit(session):
+    start = session.info.pop('commit_start', None)
+    if start is not None:
+        observe('db_commit', time.perf_counter() - start)
+
+def discard_commit(session):
+    session.info.pop('commit_start', None)
+
+def generate_metrics():
+    '''
+    Returns the metrics in Prometheus's text format, aggregated across worker processes if PROMETHEUS_MULTIPROC_DIR is set, along with their content type
+    '''
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
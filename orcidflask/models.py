@@ -1,30 +1,121 @@
-from orcidflask import db, app
+from orcidflask import db
+from orcidflask.metrics import timed
+from orcid_utils import load_encryption_key, load_previous_encryption_keys
+from flask import current_app
 from sqlalchemy.sql import func
-from sqlalchemy import TypeDecorator
-from cryptography.fernet import Fernet
+from sqlalchemy import TypeDecorator, type_coerce, bindparam, literal_column, select, tuple_, text, event, DDL
+from sqlalchemy.dialects import postgresql
+from cryptography.fernet import Fernet, MultiFernet
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import threading
+import csv
+import io
+
+# Ciphers, keyed by the SHA-256 fingerprint of their encryption keys. Each process builds a cipher once per set of keys, and a new one is built if the configured keys change.
+_ciphers = {}
+_keys_lock = threading.Lock()
+
+def get_encryption_keys():
+    '''
+    Returns the current encryption key, followed by any previous keys, from the files set in the app's config object (DB_ENCRYPTION_FILE and DB_PREVIOUS_ENCRYPTION_FILES). The keys are loaded on first use; if the current key's file does not exist, a new key is created.
+    '''
+    config = current_app.config
+    if 'db_encryption_key' not in config:
+        # Only one thread may create a missing key file
+        with _keys_lock:
+            if 'db_encryption_key' not in config:
+                config['db_previous_encryption_keys'] = load_previous_encryption_keys(config['DB_PREVIOUS_ENCRYPTION_FILES'])
+                config['db_encryption_key'] = load_encryption_key(config['DB_ENCRYPTION_FILE'])
+    return [config['db_encryption_key']] + config['db_previous_encryption_keys']
+
+def get_cipher(keys=None):
+    '''
+    Returns a (cached) cipher for the provided keys. If more than one key is provided, returns a MultiFernet cipher, which encrypts with the first key and decrypts with any of them.
+    :param keys: a list of Fernet keys; defaults to the keys set in the app's config object
+    '''
+    if keys is None:
+        keys = get_encryption_keys()
+    fingerprint = hashlib.sha256(b'\n'.join(keys)).hexdigest()
+    cipher = _ciphers.get(fingerprint)
+    if cipher is None:
+        if len(keys) > 1:
+            cipher = MultiFernet([Fernet(key) for key in keys])
+        else:
+            cipher = Fernet(keys[0])
+        _ciphers[fingerprint] = cipher
+    return cipher
 
 def fernet_encrypt(data):
     '''
     Encrypts data using the Fernet algorithm with the key set in the app's config object
     '''
-    fernet = Fernet(app.config['db_encryption_key'])
-    return fernet.encrypt(data.encode())
+    return get_cipher().encrypt(data.encode())
 
 
 def fernet_decrypt(data):
     '''
-    Decrypts data using the Fernet algorithm with the key set in the app's config object
+    Decrypts data using the Fernet algorithm with the key(s) set in the app's config object
+    '''
+    return get_cipher().decrypt(data).decode()
+
+def _decrypt_chunk(keys, chunk):
+    '''
+    Decrypts a list of values with the provided keys. Runs in a worker process for fernet_decrypt_many.
+    '''
+    cipher = get_cipher(keys)
+    return [cipher.decrypt(value).decode() for value in chunk]
+
+def fernet_decrypt_many(values, executor=None, chunk_size=1000, keys=None):
+    '''
+    Decrypts a list of values, returning the plaintexts in the same order.
+    :param values: a list of encrypted values
+    :param executor: an optional concurrent.futures executor (e.g., a ProcessPoolExecutor) across which to spread the work
+    :param chunk_size: number of values per task submitted to the executor
+    :param keys: a list of Fernet keys; defaults to the keys set in the app's config object
+    '''
+    if keys is None:
+        keys = get_encryption_keys()
+    if executor is None or len(values) <= chunk_size:
+        return _decrypt_chunk(keys, values)
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+    results = executor.map(_decrypt_chunk, [keys] * len(chunks), chunks)
+    return [value for chunk in results for value in chunk]
+
+def _rotate_chunk(keys, chunk):
+    '''
+    Re-encrypts a list of rows of encrypted values (which may be None) with the first of the provided keys. Runs in a worker process for rotate_encryption.
+    '''
+    cipher = get_cipher(keys)
+    return [[None if value is None else cipher.rotate(value) for value in row] for row in chunk]
+
+def _encrypt_chunk(keys, chunk):
+    '''
+    Encrypts the tokens in a list of records (as written by serialize-db) with the first of the provided keys, returning the rows as CSV for Postgres's COPY (see copy_tokens). Runs in a worker process for the load-db command.
     '''
-    fernet = Fernet(app.config['db_encryption_key'])
-    return fernet.decrypt(data).decode()
+    cipher = get_cipher(keys)
+    output = io.StringIO()
+    writer = csv.writer(output)
+    for record in chunk:
+        writer.writerow([record['id'], record['userId'],
+                         '\\x' + cipher.encrypt(record['access_token'].encode()).hex(),
+                         '\\x' + cipher.encrypt(record['refresh_token'].encode()).hex(),
+                         record['expires_in'], record['token_scope'], record['orcid'], record.get('timestamp') or ''])
+    return output.getvalue()
 
 class EncryptedValue(TypeDecorator):
     impl = db.LargeBinary
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
-        return fernet_encrypt(value)
+        if value is None:
+            return None
+        with timed('fernet_encrypt'):
+            return fernet_encrypt(value)
     
     def process_result_value(self, value, dialect):
+        if value is None:
+            return None
         return fernet_decrypt(value)
 
 
@@ -37,11 +128,28 @@ class Token(db.Model):
     token_scope = db.Column(db.String(80), unique=False, nullable=False)
     orcid = db.Column(db.String(80), unique=False, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    # Indexes for finding the latest token per ORCID iD or per user. The included columns allow those lookups to use index-only scans.
+    __table_args__ = (db.Index('ix_token_orcid_timestamp', orcid, timestamp.desc(), postgresql_include=['id', 'expires_in']),
+                      db.Index('ix_token_userId_timestamp', userId, timestamp.desc(), postgresql_include=['id', 'expires_in']),
+                      # For exporting the tokens changed since the last export (see iter_changes)
+                      db.Index('ix_token_timestamp_id', timestamp, id),
+                      # Each user has one current token per ORCID iD; superseded tokens are kept in token_history
+                      db.UniqueConstraint(userId, orcid, name='uq_token_userId_orcid'))
 
     def __repr__(self):
         return '<User %r, access_token=%r, token_scope=%r, orcid=%r' % \
                 (self.userId, self.access_token, self.token_scope, self.orcid)
     
+    @staticmethod
+    def values_from_orcid_auth(user_id, orcid_auth):
+        '''
+        Returns the column values for a record, as a dict, from the JSON response to a request to ORCID's token endpoint (see upsert_tokens)
+        :param user_id: the user's ID from the SSO process
+        :param orcid_auth: the decoded JSON response
+        '''
+        return {'userId': user_id, 'access_token': orcid_auth['access_token'], 'refresh_token': orcid_auth['refresh_token'],
+                'expires_in': orcid_auth['expires_in'], 'token_scope': orcid_auth['scope'], 'orcid': orcid_auth['orcid']}
+
     def to_dict(self):
         '''
         Returns the record as a Python dict
@@ -51,3 +159,346 @@ class Token(db.Model):
         # Convert timestamp to string
         record['timestamp'] = record['timestamp'].isoformat()
         return record
+
+    @classmethod
+    def iter_batches(cls, batch_size=1000, after_id=0):
+        '''
+        Yields lists of records in ascending order of id, using keyset pagination on the primary key so that only one batch is held in memory at a time.
+        :param batch_size: maximum number of records per batch
+        :param after_id: only records with an id greater than this value are returned (used to resume)
+        '''
+        while True:
+            batch = cls.query.filter(cls.id > after_id).order_by(cls.id).limit(batch_size).all()
+            if not batch:
+                break
+            after_id = batch[-1].id
+            yield batch
+            # Drop the previous batch from the session's identity map so memory use stays flat
+            db.session.expunge_all()
+
+    @classmethod
+    def expires_at(cls):
+        '''
+        Returns a SQL expression for the time at which a token expires
+        '''
+        return cls.timestamp + cls.expires_in * literal_column("interval '1 second'")
+
+    @classmethod
+    def latest(cls, by='orcid', values=None, valid_only=True):
+        '''
+        Returns a query for the most recent token per ORCID iD or per user, using Postgres's DISTINCT ON.
+        :param by: either 'orcid' or 'userId'
+        :param values: an optional list of ORCID iDs or user IDs to which to limit the query
+        :param valid_only: set to False to include expired tokens
+        '''
+        key = getattr(cls, by)
+        # Identify the latest tokens from the index alone, and then fetch only those rows
+        latest_ids = db.session.query(cls.id).distinct(key).order_by(key, cls.timestamp.desc())
+        if values is not None:
+            latest_ids = latest_ids.filter(key.in_(values))
+        if valid_only:
+            latest_ids = latest_ids.filter(cls.expires_at() > func.now())
+        return cls.query.filter(cls.id.in_(latest_ids)).order_by(key)
+
+    @classmethod
+    def encrypted_columns(cls):
+        '''
+        Returns the names of the columns stored as EncryptedValue
+        '''
+        return [column.name for column in cls.__table__.columns if isinstance(column.type, EncryptedValue)]
+
+    @classmethod
+    def iter_dict_batches(cls, batch_size=1000, after_id=0, workers=1, criteria=()):
+        '''
+        Like iter_batches, but yields lists of records as Python dicts (see to_dict). Encrypted columns are loaded as ciphertext and decrypted in bulk, rather than row by row.
+        :param batch_size: maximum number of records per batch
+        :param after_id: only records with an id greater than this value are returned (used to resume)
+        :param workers: number of worker processes to use for decryption (1 to decrypt in the current process)
+        :param criteria: optional SQL expressions by which to filter the records
+        '''
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while True:
+                rows = db.session.query(*cls.raw_columns()).filter(cls.id > after_id, *criteria).order_by(cls.id).limit(batch_size).all()
+                if not rows:
+                    break
+                after_id = rows[-1].id
+                yield cls.decrypt_rows(rows, executor=executor)
+        finally:
+            if executor:
+                executor.shutdown()
+
+    @classmethod
+    def iter_changes(cls, after=None, until=None, batch_size=1000, workers=1):
+        '''
+        Like iter_dict_batches, but yields the records inserted or replaced since a given point, in ascending order of (timestamp, id), using keyset pagination on the ix_token_timestamp_id index.
+        :param after: a (timestamp, id) tuple; only records that sort after it are returned (None for all records)
+        :param until: an optional datetime; only records with an earlier timestamp are returned
+        :param batch_size: maximum number of records per batch
+        :param workers: number of worker processes to use for decryption (1 to decrypt in the current process)
+        '''
+        criteria = [cls.timestamp < until] if until is not None else []
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            while True:
+                query = db.session.query(*cls.raw_columns()).filter(*criteria)
+                if after is not None:
+                    query = query.filter(tuple_(cls.timestamp, cls.id) > tuple_(*after))
+                rows = query.order_by(cls.timestamp, cls.id).limit(batch_size).all()
+                if not rows:
+                    break
+                after = (rows[-1].timestamp, rows[-1].id)
+                yield cls.decrypt_rows(rows, executor=executor)
+        finally:
+            if executor:
+                executor.shutdown()
+
+    @classmethod
+    def raw_columns(cls):
+        '''
+        Returns the table's columns for a query, with the encrypted columns loaded as ciphertext (see decrypt_rows), bypassing EncryptedValue's per-row decryption
+        '''
+        encrypted = cls.encrypted_columns()
+        return [type_coerce(column, db.LargeBinary).label(column.name) if column.name in encrypted else column
+                for column in cls.__table__.columns]
+
+    @classmethod
+    def decrypt_rows(cls, rows, executor=None):
+        '''
+        Converts rows queried with raw_columns to Python dicts (see to_dict), decrypting all encrypted columns with a single call
+        :param rows: the rows
+        :param executor: an optional ProcessPoolExecutor across which to spread decryption
+        '''
+        encrypted = cls.encrypted_columns()
+        records = [row._asdict() for row in rows]
+        ciphertexts = [bytes(record[name]) for name in encrypted for record in records]
+        plaintexts = iter(fernet_decrypt_many(ciphertexts, executor=executor))
+        for name in encrypted:
+            for record in records:
+                record[name] = next(plaintexts)
+        for record in records:
+            record['timestamp'] = record['timestamp'].isoformat()
+        return records
+
+
+class TokenHistory(db.Model):
+    '''
+    A token that has been replaced by a newer token for the same user and ORCID iD (or that has expired; see orcidflask/compaction.py). The table is partitioned by month of the superseded column.
+    '''
+    __tablename__ = 'token_history'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (superseded)'}
+    # The partition key is part of the primary key, as Postgres requires
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # id of the row in the token table that held this token
+    token_id = db.Column(db.Integer, nullable=False)
+    userId = db.Column(db.String(80), unique=False, nullable=False)
+    access_token = db.Column(EncryptedValue, unique=False, nullable=False)
+    refresh_token = db.Column(EncryptedValue, unique=False, nullable=False)
+    expires_in = db.Column(db.Integer, nullable=False)
+    token_scope = db.Column(db.String(80), unique=False, nullable=False)
+    orcid = db.Column(db.String(80), unique=False, nullable=False)
+    timestamp = db.Column(db.DateTime(timezone=True), nullable=True)
+    superseded = db.Column(db.DateTime(timezone=True), primary_key=True, server_default=func.now())
+
+    def __repr__(self):
+        return '<TokenHistory %r, user=%r, orcid=%r, superseded=%r>' % \
+                (self.token_id, self.userId, self.orcid, self.superseded)
+
+# Rows outside the monthly partitions go to the default partition (the migration creates it too)
+event.listen(TokenHistory.__table__, 'after_create', DDL('CREATE TABLE token_history_default PARTITION OF token_history DEFAULT'))
+
+# Namespace of the advisory locks taken by upsert_tokens (the first of the two keys of pg_advisory_xact_lock)
+UPSERT_LOCK_NAMESPACE = 1
+
+def upsert_tokens(records):
+    '''
+    Inserts tokens, replacing any current token for the same user and ORCID iD, in the current transaction (the caller should commit). Replaced tokens are first copied to the token_history table. Rows are written with one multi-row statement per batch rather than one statement per token.
+    :param records: a list of dicts of column values (see Token.values_from_orcid_auth)
+    '''
+    table = Token.__table__
+    columns = ['userId', 'access_token', 'refresh_token', 'expires_in', 'token_scope', 'orcid']
+    while records:
+        # A user and ORCID iD may appear only once per statement, so any duplicates are written in a subsequent pass
+        batch, remaining, keys = [], [], set()
+        for record in records:
+            key = (record['userId'], record['orcid'])
+            if key in keys:
+                remaining.append(record)
+            else:
+                keys.add(key)
+                batch.append(record)
+        # Lock each user and ORCID iD for the rest of the transaction, in a consistent order to avoid deadlocks. Row locks alone are not enough: if the token does not exist yet, there is no row to lock, and a concurrent upsert of the same (first) token would overwrite this one without archiving it.
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:namespace, hashtext(key)) FROM unnest(CAST(:keys AS text[])) AS key'),
+                           {'namespace': UPSERT_LOCK_NAMESPACE, 'keys': sorted(f'{user_id} {orcid}' for user_id, orcid in keys)})
+        # Archive the tokens about to be replaced, locking them against concurrent replacement
+        current = (select(table.c.id, *[table.c[column] for column in columns], table.c.timestamp)
+                  .where(tuple_(table.c.userId, table.c.orcid).in_(list(keys)))
+                  .with_for_update())
+        db.session.execute(TokenHistory.__table__.insert().from_select(['token_id'] + columns + ['timestamp'], current))
+        upsert = postgresql.insert(table)
+        upsert = upsert.on_conflict_do_update(constraint='uq_token_userId_orcid',
+                                            set_={**{column: upsert.excluded[column] for column in columns}, 'timestamp': func.now()})
+        db.session.execute(upsert, batch)
+        records = remaining
+
+# Columns in the CSV rows produced by _encrypt_chunk
+COPY_COLUMNS = ['id', 'userId', 'access_token', 'refresh_token', 'expires_in', 'token_scope', 'orcid', 'timestamp']
+
+def copy_tokens(data):
+    '''
+    Inserts tokens in bulk, in the current transaction (the caller should commit). The rows are streamed with COPY into a temporary staging table, and then merged into the token table:
+    - Rows whose id is already in the token table are skipped, so that loading the same rows again has no effect.
+    - Dumps taken before the token table held one token per user and ORCID iD may hold several. Only the newest (by timestamp, then id) becomes the current token, replacing an older current token, if any; the others are copied to token_history, as the migration that introduced token_history did. Rows already in token_history are skipped.
+    Returns the number of tokens loaded as current tokens, and the number copied to token_history.
+    :param data: rows of already encrypted values, as CSV (see _encrypt_chunk)
+    '''
+    cursor = db.session.connection().connection.cursor()
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS token_load (LIKE token INCLUDING DEFAULTS) ON COMMIT DELETE ROWS')
+    cursor.execute('CREATE TEMPORARY TABLE IF NOT EXISTS token_load_superseded (LIKE token INCLUDING DEFAULTS) ON COMMIT DELETE ROWS')
+    columns = ', '.join(f'"{column}"' for column in COPY_COLUMNS)
+    cursor.copy_expert(f'COPY token_load ({columns}) FROM STDIN WITH (FORMAT csv)', io.StringIO(data))
+    cursor.execute('DELETE FROM token_load l USING token t WHERE l.id = t.id')
+    # Set aside the rows superseded by a newer row for the same user and ORCID iD, either in this batch or in the token table
+    newer = 'n."userId" = l."userId" AND n.orcid = l.orcid AND (coalesce(n."timestamp", \'-infinity\'), n.id) > (coalesce(l."timestamp", \'-infinity\'), l.id)'
+    cursor.execute(f'WITH superseded AS (DELETE FROM token_load l WHERE EXISTS (SELECT 1 FROM token_load n WHERE {newer}) '
+                   f'OR EXISTS (SELECT 1 FROM token n WHERE {newer}) RETURNING *) '
+                   'INSERT INTO token_load_superseded SELECT * FROM superseded')
+    # The remaining rows replace the current tokens for the same user and ORCID iD, which are copied to token_history first
+    history_columns = ', '.join(f'"{column}"' for column in COPY_COLUMNS[1:])
+    cursor.execute(f'INSERT INTO token_history (token_id, {history_columns}) '
+                   f'SELECT t.id, {", ".join(f"t.{column}" for column in history_columns.split(", "))} '
+                   'FROM token t JOIN token_load l ON t."userId" = l."userId" AND t.orcid = l.orcid')
+    # Dumps of tokens without a timestamp leave it empty (NULL), so the column's default is applied here
+    values = columns.replace('"timestamp"', 'coalesce("timestamp", now())')
+    updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns.split(', ') if column not in ('"userId"', '"orcid"'))
+    cursor.execute(f'INSERT INTO token ({columns}) SELECT {values} FROM token_load '
+                   f'ON CONFLICT ON CONSTRAINT "uq_token_userId_orcid" DO UPDATE SET {updates}')
+    loaded = cursor.rowcount
+    cursor.execute(f'INSERT INTO token_history (token_id, {history_columns}) SELECT id, {history_columns} FROM token_load_superseded s '
+                   'WHERE NOT EXISTS (SELECT 1 FROM token_history h WHERE h.token_id = s.id AND h."userId" = s."userId" AND h.orcid = s.orcid)')
+    return loaded, cursor.rowcount
+
+def reset_token_id_sequence():
+    '''
+    Moves the token table's id sequence past the highest id, after tokens have been inserted with explicit ids (see copy_tokens)
+    '''
+    db.session.execute(text("SELECT setval(pg_get_serial_sequence('token', 'id'), coalesce((SELECT max(id) FROM token), 0) + 1, false)"))
+
+def save_token(record):
+    '''
+    Inserts or replaces a single token (see upsert_tokens) and commits
+    :param record: a dict of column values (see Token.values_from_orcid_auth)
+    '''
+    upsert_tokens([record])
+    db.session.commit()
+
+class AuditEvent(db.Model):
+    '''
+    An entry in the audit trail of authorizations (see orcidflask/audit.py). The table is append-only: its triggers reject updates and deletes.
+    '''
+    __tablename__ = 'audit_event'
+    id = db.Column(db.BigInteger, primary_key=True)
+    timestamp = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+    event = db.Column(db.String(32), nullable=False)
+    userId = db.Column(db.String(80), nullable=True, index=True)
+    orcid = db.Column(db.String(80), nullable=True, index=True)
+    ip = db.Column(db.String(45), nullable=True)
+    details = db.Column(postgresql.JSONB, nullable=True)
+
+    def __repr__(self):
+        return '<AuditEvent %r, event=%r, user=%r, orcid=%r>' % \
+                (self.timestamp, self.event, self.userId, self.orcid)
+
+class WebSession(db.Model):
+    '''
+    Session data for the server-side session backend (see SESSION_BACKEND), serialized as JSON
+    '''
+    __tablename__ = 'web_session'
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+class SamlReplay(db.Model):
+    '''
+    IDs of SAML responses and assertions that have already been consumed, kept until the assertion expires (see SAML_REPLAY_CACHE)
+    '''
+    __tablename__ = 'saml_replay'
+    id = db.Column(db.String(256), primary_key=True)
+    expires = db.Column(db.DateTime(timezone=True), nullable=False, index=True)
+
+class TokenExchange(db.Model):
+    '''
+    A one-time code from ORCID, queued for exchange for a token by the exchange-worker command. The code is removed once it has been used or has expired.
+    '''
+    id = db.Column(db.Integer, primary_key=True)
+    userId = db.Column(db.String(80), nullable=False)
+    code = db.Column(EncryptedValue, nullable=True)
+    # ORCID's response (JSON), saved once the code has been exchanged and until the token has been stored, so that the code is never sent again
+    response = db.Column(EncryptedValue, nullable=True)
+    redirect_uri = db.Column(db.String(255), nullable=False)
+    # One of pending, processing, done or failed
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    updated = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    next_attempt = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (db.Index('ix_token_exchange_status_next_attempt', status, next_attempt),)
+
+    def __repr__(self):
+        return '<TokenExchange %r, user=%r, status=%r, attempts=%r>' % \
+                (self.id, self.userId, self.status, self.attempts)
+
+def encrypted_tables():
+    '''
+    Returns the tables with EncryptedValue columns, all of which must be re-encrypted when the key is rotated (see rotate_encryption)
+    '''
+    return [Token.__table__, TokenHistory.__table__, TokenExchange.__table__]
+
+def rotate_encryption(table, batch_size=1000, after_id=0, executor=None, chunk_size=250):
+    '''
+    Re-encrypts the encrypted columns of every row of a table (see encrypted_tables) with the current key, decrypting with any of the configured keys. Rows are processed in ascending order of id and committed in batches; after each commit, yields the last id and the number of rows in the batch.
+    A row is only updated if its ciphertext is unchanged since it was read, so values written by the app during the rotation are not overwritten.
+    :param table: a Table with an integer id column
+    :param batch_size: maximum number of rows per batch
+    :param after_id: only rows with an id greater than this value are re-encrypted (used to resume)
+    :param executor: an optional concurrent.futures executor (e.g., a ProcessPoolExecutor) across which to spread the work
+    :param chunk_size: number of rows per task submitted to the executor
+    '''
+    keys = get_encryption_keys()
+    encrypted = [column.name for column in table.columns if isinstance(column.type, EncryptedValue)]
+    # Rows are updated by their full primary key (for token_history, the id and the partition key)
+    key_columns = list(table.primary_key.columns)
+    columns = key_columns + [type_coerce(table.c[name], db.LargeBinary).label(name) for name in encrypted]
+    # Bind parameters are typed as LargeBinary so that the already encrypted values are stored as is
+    update = table.update()
+    for column in key_columns:
+        update = update.where(column == bindparam(f'_key_{column.name}'))
+    for name in encrypted:
+        # Values may be NULL (e.g., the codes of finished exchanges), which = would never match
+        update = update.where(table.c[name].is_not_distinct_from(bindparam(f'_old_{name}', type_=db.LargeBinary)))
+    update = update.values({name: bindparam(f'_new_{name}', type_=db.LargeBinary) for name in encrypted})
+    while True:
+        rows = db.session.execute(select(*columns).where(table.c.id > after_id).order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+        after_id = rows[-1].id
+        ciphertexts = [[None if value is None else bytes(value) for value in row[len(key_columns):]] for row in rows]
+        if executor is None:
+            rotated = _rotate_chunk(keys, ciphertexts)
+        else:
+            chunks = [ciphertexts[i:i + chunk_size] for i in range(0, len(ciphertexts), chunk_size)]
+            rotated = [row for chunk in executor.map(_rotate_chunk, [keys] * len(chunks), chunks) for row in chunk]
+        params = []
+        for row, old, new in zip(rows, ciphertexts, rotated):
+            # Nothing to re-encrypt
+            if all(value is None for value in old):
+                continue
+            param = {f'_key_{column.name}': row[i] for i, column in enumerate(key_columns)}
+            param.update({f'_old_{name}': value for name, value in zip(encrypted, old)})
+            param.update({f'_new_{name}': value for name, value in zip(encrypted, new)})
+            params.append(param)
+        if params:
+            db.session.execute(update, params)
+        db.session.commit()
+        yield after_id, len(rows)
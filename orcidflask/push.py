@@ -0,0 +1,198 @@
+'''
+Pushing works (e.g., publications from a research-information system) to researchers' ORCID records, with the tokens granted the /activities/update scope (see the push-works command). New works are added with ORCID's bulk endpoint, up to 100 per request. The put-code that ORCID assigns to each work is kept in a local SQLite index, so that later runs update works that have changed, skip those that have not, and never add the same work twice.
+'''
+import hashlib
+import json
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from orcidflask import db
+from orcidflask.models import Token
+from orcid_utils import create_orcid_client, HostRateLimiter, CircuitOpenError
+
+# Maximum number of works per request to ORCID's bulk endpoint
+BULK_LIMIT = 100
+
+class PutCodeIndex:
+    '''
+    Maps each pushed work, identified by its ORCID iD and a key from the feed, to the put-code of the work in the ORCID record and a digest of its content. Used only from the thread that created it.
+    :param path: path to the SQLite database (created if necessary)
+    '''
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS work (orcid TEXT NOT NULL, key TEXT NOT NULL, put_code INTEGER NOT NULL, digest TEXT NOT NULL, '
+                                'updated TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (orcid, key))')
+
+    def lookup(self, orcid):
+        '''
+        Returns a dict of the works pushed to a record, mapping their keys to (put-code, digest) tuples
+        '''
+        rows = self.connection.execute('SELECT key, put_code, digest FROM work WHERE orcid = ?', (orcid,))
+        return {key: (put_code, digest) for key, put_code, digest in rows}
+
+    def record(self, orcid, entries):
+        '''
+        Saves the put-codes and digests of works pushed to a record
+        :param entries: a list of (key, put-code, digest) tuples
+        '''
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO work (orcid, key, put_code, digest) VALUES (?, ?, ?, ?)',
+                                        [(orcid, key, put_code, digest) for key, put_code, digest in entries])
+
+    def close(self):
+        self.connection.close()
+
+def work_digest(work):
+    return hashlib.sha256(json.dumps(work, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def read_feed(feed):
+    '''
+    Groups the works in a JSON Lines feed by ORCID iD. Each line should be an object with the keys orcid, key (an identifier for the work that is stable between runs, e.g., from the source system) and work (the work, in ORCID's JSON format). Later lines replace earlier ones with the same ORCID iD and key.
+    Returns a dict mapping ORCID iDs to dicts of works by key, and a list of (line number, error) tuples for invalid lines.
+    :param feed: a file-like object
+    '''
+    works = defaultdict(dict)
+    invalid = []
+    for number, line in enumerate(feed, 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            works[item['orcid']][str(item['key'])] = item['work']
+        except (ValueError, KeyError, TypeError) as e:
+            invalid.append((number, f'{type(e).__name__}: {e}'))
+    return works, invalid
+
+def push_record(client, api_url, orcid, access_token, creates, updates):
+    '''
+    Adds and updates the works in one researcher's record. Runs in a worker thread.
+    Returns a list of (key, outcome, put-code, detail) tuples, where outcome is 'created', 'updated' or a short description of the failure, and detail is an error message, if any.
+    :param creates: a list of (key, work) tuples of works to add
+    :param updates: a list of (key, put-code, work) tuples of works to replace
+    '''
+    headers = {'Accept': 'application/vnd.orcid+json', 'Content-Type': 'application/vnd.orcid+json', 'Authorization': f'Bearer {access_token}'}
+    results = []
+    creates = list(creates)
+    try:
+        # ORCID has no bulk update, so changed works are replaced one at a time
+        for key, put_code, work in updates:
+            response = client.put(f'{api_url}/{orcid}/work/{put_code}', headers=headers, json={**work, 'put-code': put_code})
+            if response.ok:
+                results.append((key, 'updated', put_code, None))
+            elif response.status_code == 404:
+                # The researcher has deleted the work from their record, so add it again
+                creates.append((key, work))
+            else:
+                results.append((key, f'HTTP {response.status_code}', put_code, response.text))
+        for i in range(0, len(creates), BULK_LIMIT):
+            chunk = creates[i:i + BULK_LIMIT]
+            response = client.post(f'{api_url}/{orcid}/works', headers=headers, json={'bulk': [{'work': work} for _, work in chunk]})
+            if not response.ok:
+                results.extend((key, f'HTTP {response.status_code}', None, response.text) for key, _ in chunk)
+                continue
+            try:
+                items = response.json()['bulk']
+            except (ValueError, KeyError, TypeError) as e:
+                # ORCID may have added the works, but without their put-codes they cannot be recorded
+                results.extend((key, 'invalid response', None, f'{type(e).__name__}: {e}') for key, _ in chunk)
+                continue
+            # The response lists the works added ({"work": ...}), or the errors ({"error": ...}), in the order of the request
+            for position, (key, _) in enumerate(chunk):
+                try:
+                    item = items[position]
+                    if 'error' in item:
+                        error = item['error']
+                        results.append((key, f'HTTP {error.get("response-code")}', None, error.get('developer-message')))
+                    else:
+                        results.append((key, 'created', item['work']['put-code'], None))
+                except (LookupError, TypeError, AttributeError) as e:
+                    results.append((key, 'invalid response', None, f'{type(e).__name__}: {e}'))
+    except CircuitOpenError as e:
+        failure = ('circuit open', str(e))
+    except Exception as e:
+        # A failed request (RequestException) or any other error: the works already created are still returned, so that their put-codes are recorded
+        failure = (type(e).__name__, str(e))
+    else:
+        return results
+    # Report the works not yet pushed when the push failed
+    done = {key for key, *_ in results}
+    pending = {key: put_code for key, put_code, _ in updates}
+    pending.update((key, None) for key, _ in creates)
+    results.extend((key, failure[0], put_code, failure[1]) for key, put_code in pending.items() if key not in done)
+    return results
+
+def push_works(feed, index_path, workers=4, rate=8.0, batch_size=100, errors=None, log=print):
+    '''
+    Pushes the works in a JSON Lines feed (see read_feed) to the researchers' ORCID records, using the latest token for each ORCID iD, which must have the /activities/update scope. Records are updated by a pool of worker threads, one researcher per thread at a time, subject to a rate limit on all requests to ORCID. Works are added, updated or skipped according to the put-code index (see PutCodeIndex).
+    Returns a Counter of outcomes by work (created, updated, unchanged, or the type of failure).
+    :param feed: a file-like object
+    :param index_path: path to the put-code index
+    :param workers: maximum number of concurrent requests to ORCID
+    :param rate: maximum number of requests per second to ORCID
+    :param batch_size: number of researchers whose tokens to load from the database at a time
+    :param errors: an optional file-like object to which to write the works that could not be pushed, as JSON Lines
+    :param log: function with which to report progress
+    '''
+    app = current_app._get_current_object()
+    api_url = app.config['orcid_api_url']
+    client = create_orcid_client(pool_size=workers, rate_limiter=HostRateLimiter(rate, burst=workers))
+    index = PutCodeIndex(index_path)
+    outcomes = Counter()
+    start = time.perf_counter()
+
+    def report_error(orcid, key, outcome, detail):
+        app.logger.error(f'Failed to push work {key} to {orcid}: {outcome}; {detail}')
+        if errors:
+            errors.write(json.dumps({'orcid': orcid, 'key': key, 'error': outcome, 'detail': detail}) + '\n')
+
+    works, invalid = read_feed(feed)
+    for number, error in invalid:
+        outcomes['invalid'] += 1
+        report_error(None, f'line {number}', 'invalid', error)
+    orcids = list(works)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i in range(0, len(orcids), batch_size):
+                batch = orcids[i:i + batch_size]
+                rows = Token.latest(by='orcid', values=batch).with_entities(*Token.raw_columns()).all()
+                tokens = {token['orcid']: token for token in Token.decrypt_rows(rows)}
+                db.session.rollback()
+                futures = {}
+                for orcid in batch:
+                    token = tokens.get(orcid)
+                    if token is None or '/activities/update' not in token['token_scope'].split():
+                        outcome = 'no token' if token is None else 'no /activities/update scope'
+                        for key in works[orcid]:
+                            outcomes[outcome] += 1
+                            report_error(orcid, key, outcome, None)
+                        continue
+                    pushed = index.lookup(orcid)
+                    creates, updates = [], []
+                    for key, work in works[orcid].items():
+                        if key not in pushed:
+                            creates.append((key, work))
+                        elif pushed[key][1] != work_digest(work):
+                            updates.append((key, pushed[key][0], work))
+                        else:
+                            outcomes['unchanged'] += 1
+                    if creates or updates:
+                        futures[orcid] = executor.submit(push_record, client, api_url, orcid, token['access_token'], creates, updates)
+                # Record each researcher's put-codes in the index as soon as their works have been pushed
+                for orcid, future in futures.items():
+                    results = future.result()
+                    # Before anything else can fail, so that works created on ORCID are never added again
+                    index.record(orcid, [(key, put_code, work_digest(works[orcid][key]))
+                                         for key, outcome, put_code, _ in results if outcome in ('created', 'updated')])
+                    for key, outcome, put_code, detail in results:
+                        outcomes[outcome] += 1
+                        if outcome not in ('created', 'updated'):
+                            report_error(orcid, key, outcome, detail)
+                elapsed = time.perf_counter() - start
+                log(f'Processed {sum(outcomes.values())} works for {min(i + batch_size, len(orcids))} researchers in {elapsed:.1f}s '
+                    f'({sum(outcomes.values()) / elapsed:,.1f} works/s); ' + ', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()))
+    finally:
+        index.close()
+    return outcomes
@@ -0,0 +1,73 @@
+'''
+Renewal of tokens that are about to expire, using the refresh tokens stored with them (see the refresh-tokens command).
+'''
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from flask import current_app
+from sqlalchemy.sql import func
+from requests.exceptions import RequestException
+from orcidflask import db
+from orcidflask.models import Token, upsert_tokens
+from orcid_utils import create_orcid_client, request_orcid_token, prepare_refresh_payload, HostRateLimiter, CircuitOpenError
+
+def expiring_criteria(within):
+    '''
+    Returns the SQL criteria for tokens that expire within the provided number of seconds (including tokens that have already expired)
+    '''
+    return [Token.expires_at() < func.now() + timedelta(seconds=within)]
+
+def refresh_token(app, client, record, revoke_old=False):
+    '''
+    Requests a new token from ORCID for the provided record. Runs in a worker thread, so pushes its own app context.
+    Returns a (record, outcome, result) tuple, where outcome is either 'refreshed' or a short description of the failure, and result is the decoded response or an error message.
+    '''
+    with app.app_context():
+        try:
+            response = request_orcid_token(prepare_refresh_payload(record['refresh_token'], revoke_old), client=client)
+        except CircuitOpenError as e:
+            return record, 'circuit open', str(e)
+        except RequestException as e:
+            return record, type(e).__name__, str(e)
+        if response.ok:
+            return record, 'refreshed', response.json()
+        return record, f'HTTP {response.status_code}', response.text
+
+def refresh_tokens(within, workers=4, rate=5.0, batch_size=500, revoke_old=False, dry_run=False, log=print):
+    '''
+    Refreshes all tokens that expire within the provided number of seconds. Requests to ORCID are made by a pool of worker threads, subject to a per-host rate limit, and the new tokens are written back (replacing the old ones) in one transaction per batch.
+    Returns a Counter of outcomes (refreshed, or the type of failure).
+    :param within: number of seconds
+    :param workers: maximum number of concurrent requests to ORCID
+    :param rate: maximum number of requests per second to each ORCID host
+    :param batch_size: number of tokens to load, refresh and write back at a time
+    :param revoke_old: set to True to have ORCID revoke the tokens being replaced
+    :param dry_run: set to True to report the tokens that would be refreshed, without contacting ORCID
+    :param log: function with which to report progress
+    '''
+    app = current_app._get_current_object()
+    client = create_orcid_client(pool_size=workers, rate_limiter=HostRateLimiter(rate, burst=workers))
+    outcomes = Counter()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in Token.iter_dict_batches(batch_size=batch_size, criteria=expiring_criteria(within)):
+            if dry_run:
+                for record in batch:
+                    log(f'Would refresh token {record["id"]} (user {record["userId"]}, ORCID iD {record["orcid"]}, issued {record["timestamp"]})')
+                outcomes['would refresh'] += len(batch)
+                continue
+            refreshed = []
+            for record, outcome, result in executor.map(lambda record: refresh_token(app, client, record, revoke_old), batch):
+                outcomes[outcome] += 1
+                if outcome == 'refreshed':
+                    # Replace the token for the same user and ORCID iD as the one refreshed
+                    refreshed.append(Token.values_from_orcid_auth(record['userId'], {**result, 'orcid': record['orcid']}))
+                else:
+                    app.logger.error(f'Failed to refresh token {record["id"]}: {outcome}; {result}')
+            upsert_tokens(refreshed)
+            db.session.commit()
+            elapsed = time.perf_counter() - start
+            log(f'Processed {sum(outcomes.values())} tokens in {elapsed:.1f}s ({sum(outcomes.values()) / elapsed:,.1f} tokens/s); ' +
+                ', '.join(f'{outcome}: {count}' for outcome, count in outcomes.items()))
+    return outcomes
@@ -0,0 +1,94 @@
+'''
+Detection of replayed SAML responses (see SAML_REPLAY_CACHE). The IDs of each consumed response and its assertion are recorded until the assertion expires; a response whose ID has already been recorded is rejected right after it has been parsed, before the (comparatively expensive) signature verification.
+'''
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import func
+from orcidflask import db
+from orcidflask.models import SamlReplay
+from orcidflask.cache import TTLCache
+
+class MemoryReplayCache:
+    '''
+    Records consumed IDs in an in-process cache. Each worker process has its own cache, so this detects only responses replayed to the same process.
+    :param maxsize: maximum number of IDs to keep
+    '''
+    def __init__(self, maxsize=100000):
+        self.cache = TTLCache(maxsize=maxsize)
+
+    def seen(self, ids):
+        '''
+        Returns True if any of the provided IDs has already been consumed
+        '''
+        return any(self.cache.get(id) for id in ids)
+
+    def claim(self, ids, ttl):
+        '''
+        Records the provided IDs as consumed for ttl seconds. Returns False if any of them had already been consumed.
+        '''
+        return all([self.cache.add(id, True, ttl=ttl) for id in ids])
+
+class SQLReplayCache:
+    '''
+    Records consumed IDs in the saml_replay table, shared by all worker processes. IDs claimed by this process are also kept in memory, so that repeated submissions to the same process do not query the database.
+    :param purge_interval: minimum number of seconds between deletions of expired IDs
+    '''
+    def __init__(self, maxsize=100000, purge_interval=300):
+        self.local = MemoryReplayCache(maxsize=maxsize)
+        self.purge_interval = purge_interval
+        self.purged = time.monotonic()
+
+    def seen(self, ids):
+        if self.local.seen(ids):
+            return True
+        return db.session.query(SamlReplay.query.filter(SamlReplay.id.in_(ids), SamlReplay.expires > func.now()).exists()).scalar()
+
+    def claim(self, ids, ttl):
+        expires = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        insert = postgresql.insert(SamlReplay.__table__).values([{'id': id, 'expires': expires} for id in ids])
+        # Rows that have expired (but not yet been purged) may be claimed again
+        insert = insert.on_conflict_do_update(index_elements=['id'], set_={'expires': insert.excluded.expires},
+                                              where=SamlReplay.__table__.c.expires <= func.now())
+        claimed = db.session.execute(insert.returning(SamlReplay.__table__.c.id)).fetchall()
+        if time.monotonic() - self.purged > self.purge_interval:
+            self.purged = time.monotonic()
+            SamlReplay.query.filter(SamlReplay.expires <= func.now()).delete(synchronize_session=False)
+        db.session.commit()
+        self.local.claim(ids, ttl)
+        return len(claimed) == len(ids)
+
+def replay_ttl(not_on_or_after):
+    '''
+    Returns the number of seconds for which to remember a response whose assertion expires at the provided time. python3-saml accepts assertions up to ALLOWED_CLOCK_DRIFT seconds after they expire.
+    :param not_on_or_after: the assertion's NotOnOrAfter time, as a Unix timestamp, or None
+    '''
+    from onelogin.saml2.constants import OneLogin_Saml2_Constants
+    if not not_on_or_after:
+        return current_app.config['SAML_REPLAY_CACHE_TTL']
+    return max(not_on_or_after - time.time(), 0) + OneLogin_Saml2_Constants.ALLOWED_CLOCK_DRIFT
+
+# One cache per process
+_caches = {}
+
+def get_replay_cache():
+    '''
+    Returns the current process's replay cache for the backend set in the app's config object (SAML_REPLAY_CACHE), or None if replay detection is turned off
+    '''
+    backend = current_app.config['SAML_REPLAY_CACHE']
+    if not backend:
+        return None
+    pid = os.getpid()
+    cache = _caches.get(pid)
+    if cache is None:
+        if backend == 'sqlalchemy':
+            cache = SQLReplayCache()
+        elif backend == 'memory':
+            cache = MemoryReplayCache()
+        else:
+            raise ValueError(f'Unknown SAML replay cache: {backend}')
+        _caches.clear()
+        _caches[pid] = cache
+    return cache
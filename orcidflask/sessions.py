@@ -0,0 +1,169 @@
+'''
+Server-side sessions (see SESSION_BACKEND). The session data is kept in a store on the server, and the session cookie holds only a signed, random session id, rather than the full (signed) session data as with Flask's default cookie sessions.
+'''
+import os
+import secrets
+import threading
+from datetime import datetime, timedelta, timezone
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import func
+from orcidflask import db
+from orcidflask.models import WebSession
+from orcidflask.cache import TTLCache
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    '''
+    Session data, which records whether it has been modified during the request
+    '''
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.previous_sid = None
+
+    def regenerate(self):
+        '''
+        Moves the session data to a new session id (e.g., upon login, to prevent session fixation)
+        '''
+        if not self.new:
+            self.previous_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+class MemorySessionStore:
+    '''
+    Keeps sessions in an in-process LRU cache. Suitable only for a single worker process, since each process has its own store.
+    :param maxsize: maximum number of sessions to keep
+    '''
+    def __init__(self, maxsize=10000):
+        self.cache = TTLCache(maxsize=maxsize)
+
+    def load(self, sid):
+        return self.cache.get(sid)
+
+    def save(self, sid, data, ttl):
+        self.cache.set(sid, data, ttl=ttl)
+
+    def delete(self, sid):
+        self.cache.delete(sid)
+
+    def purge_expired(self):
+        return self.cache.purge_expired()
+
+class SQLSessionStore:
+    '''
+    Keeps sessions in the web_session table, so that they are shared by all worker processes (and hosts)
+    '''
+    def load(self, sid):
+        return db.session.query(WebSession.data).filter(WebSession.id == sid, WebSession.expires > func.now()).scalar()
+
+    def save(self, sid, data, ttl):
+        expires = datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        upsert = postgresql.insert(WebSession.__table__).values(id=sid, data=data, expires=expires)
+        upsert = upsert.on_conflict_do_update(index_elements=['id'], set_={'data': upsert.excluded.data, 'expires': upsert.excluded.expires})
+        db.session.execute(upsert)
+        db.session.commit()
+
+    def delete(self, sid):
+        WebSession.query.filter_by(id=sid).delete()
+        db.session.commit()
+
+    def purge_expired(self):
+        count = WebSession.query.filter(WebSession.expires <= func.now()).delete(synchronize_session=False)
+        db.session.commit()
+        return count
+
+class ServerSideSessionInterface(SessionInterface):
+    '''
+    Flask session interface that stores session data in a MemorySessionStore or SQLSessionStore. Session data is written to the store only when it has been modified, and expires SESSION_STORE_TTL seconds after the last modification. Expired sessions are removed by a background thread in each worker process.
+    :param store: the session store
+    :param ttl: number of seconds for which to keep a session after it was last modified
+    :param purge_interval: number of seconds between purges of expired sessions
+    '''
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=28800, purge_interval=300):
+        self.store = store
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.purge_pid = None
+
+    @classmethod
+    def from_config(cls, app):
+        '''
+        Creates the session interface for the backend set in the app's config object (SESSION_BACKEND)
+        '''
+        backend = app.config['SESSION_BACKEND']
+        if backend == 'sqlalchemy':
+            store = SQLSessionStore()
+        elif backend == 'memory':
+            store = MemorySessionStore(maxsize=app.config['SESSION_STORE_MAXSIZE'])
+        else:
+            raise ValueError(f'Unknown session backend: {backend}')
+        return cls(store, ttl=app.config['SESSION_STORE_TTL'], purge_interval=app.config['SESSION_PURGE_INTERVAL'])
+
+    def get_signer(self, app):
+        return Signer(app.secret_key, salt='session-id')
+
+    def start_purge_thread(self, app):
+        '''
+        Starts the background thread that purges expired sessions, once per process (threads do not survive a fork)
+        '''
+        if self.purge_pid == os.getpid():
+            return
+        self.purge_pid = os.getpid()
+        stop = threading.Event()
+
+        def purge():
+            while not stop.wait(self.purge_interval):
+                with app.app_context():
+                    try:
+                        self.store.purge_expired()
+                    except Exception as e:
+                        db.session.rollback()
+                        app.logger.error(f'Failed to purge expired sessions: {e!r}')
+                    finally:
+                        db.session.remove()
+
+        threading.Thread(target=purge, name='session-purge', daemon=True).start()
+
+    def open_session(self, app, request):
+        self.start_purge_thread(app)
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.get_signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid:
+                data = self.store.load(sid)
+                if data is not None:
+                    return ServerSideSession(self.serializer.loads(data), sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        # Remove emptied sessions (e.g., after logout)
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), self.ttl)
+        response.set_cookie(name, self.get_signer(app).sign(session.sid).decode(),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
@@ -1,17 +1,25 @@
-from flask import request, url_for, redirect, session, render_template, make_response
-from orcidflask import app, db
-from orcidflask.models import Token
-from saml_utils import *
+from flask import Blueprint, current_app, request, url_for, redirect, session, render_template, make_response, abort
+from orcidflask import db
+from orcidflask.models import Token, TokenExchange, save_token
+from orcidflask.writer import get_token_writer
+from orcidflask.api import invalidate_tokens
+from orcidflask.audit import audit
+from orcidflask.replay import get_replay_cache, replay_ttl
+from orcidflask.metrics import generate_metrics, observe
 from orcid_utils import *
-from onelogin.saml2.utils import OneLogin_Saml2_Utils
-import requests
-from requests.exceptions import HTTPError
+from requests.exceptions import HTTPError, RequestException
+import hmac
 
-@app.route('/', methods=['GET', 'POST'])
+# The SAML views import saml_utils (and with it, python3-saml and xmlsec) when first called, so that the app can be created without loading them
+views = Blueprint('views', __name__)
+
+@views.route('/', methods=['GET', 'POST'])
 def index():
     '''
     Route handles the SSO process
     '''
+    from saml_utils import init_saml_auth, get_metadata_from_session, add_metadata_to_session, saml_response_ids
+    from onelogin.saml2.utils import OneLogin_Saml2_Utils
     auth, auth_req = init_saml_auth(request)
     errors = []
     error_reason = None
@@ -24,7 +32,7 @@ def index():
     # Initiating the SSO process
     if 'sso' in request.args:
         # Redirect to ORCID login upon successful SSO
-        return redirect(auth.login(return_to=url_for('orcid_login', scopes='/read-limited /activities/update', register=register, _external=True, _scheme='https')))
+        return redirect(auth.login(return_to=url_for('views.orcid_login', scopes='/read-limited /activities/update', register=register, _external=True, _scheme='https')))
     # Initiating the SLO process
     elif 'slo' in request.args:
         metadata = get_metadata_from_session(session)
@@ -36,15 +44,33 @@ def index():
         request_id = None
         if 'AuthNRequestID' in session:
             request_id = session['AuthNRequestID']
-        # Process the XML
-        auth.process_response(request_id=request_id)
+        # Process the XML, rejecting responses that have already been consumed before verifying the signature
+        replay_cache = get_replay_cache()
+        precheck = None
+        if replay_cache:
+            precheck = lambda response: 'replayed_response' if replay_cache.seen(saml_response_ids(response)) else None
+        auth.process_response(request_id=request_id, precheck=precheck)
         errors = auth.get_errors()
+        # Record the response as consumed; if another request has just done so, this one is a replay
+        if len(errors) == 0 and replay_cache:
+            response_ids = [id for id in (auth.get_last_message_id(), auth.get_last_assertion_id()) if id]
+            if not replay_cache.claim(response_ids, replay_ttl(auth.get_last_assertion_not_on_or_after())):
+                errors = ['replayed_response']
+        for stage, elapsed in auth.timings.items():
+            observe(f'saml_{stage}', elapsed)
+        if errors:
+            current_app.logger.warning(f'SAML ACS errors {errors}')
+            audit('saml_error', user_id=session.get('samlNameId'), errors=errors, reason=auth.get_last_error_reason())
         # Check for errors
         not_auth_warn = not auth.is_authenticated()
-        if len(errors) == 0:
+        # A browser resubmitting a response that has already logged the user in continues as if it had succeeded
+        if errors == ['replayed_response'] and session.get('samlNameId'):
+            errors = []
+        elif len(errors) == 0:
             # Update the Flask session object with the SAML attributes for this user
             # Updating by reference here; otherwise, we break the session context local
             add_metadata_to_session(auth, session)
+        if len(errors) == 0:
             # Redirect to a new page, if necessary
             self_url = OneLogin_Saml2_Utils.get_self_url(auth_req)
             if 'RelayState' in request.form and self_url != request.form['RelayState']:
@@ -58,10 +84,13 @@ def index():
         request_id = None
         if 'LogoutRequestID' in session:
             request_id = session['LogoutRequestID']
+        # Captured before the callback clears the session
+        user_id = session.get('samlNameId')
         dscb = lambda: session.clear()
         url = auth.process_slo(request_id=request_id, delete_session_cb=dscb)
         errors = auth.get_errors()
         if len(errors) == 0:
+            audit('slo', user_id=user_id)
             if url is not None:
                 return redirect(url)
             else:
@@ -72,34 +101,53 @@ def index():
     # Redirect for login if no params provided
     else:
         # Remove the scopes param in order to solicit scopes from users
-        return redirect(auth.login(return_to=url_for('orcid_login', scopes='/read-limited /activities/update', register=register, _external=True, _scheme='https')))
+        return redirect(auth.login(return_to=url_for('views.orcid_login', scopes='/read-limited /activities/update', register=register, _external=True, _scheme='https')))
 
     # Redirect from logout process
-    return redirect(app.config['SLO_REDIRECT'])
+    return redirect(current_app.config['SLO_REDIRECT'])
 
-@app.route('/attrs/')
+@views.route('/attrs/')
 def attrs():
+    from saml_utils import get_attributes
     attributes, paint_logout = get_attributes(session)
     return render_template('attrs.html', paint_logout=paint_logout,
                            attributes=attributes)
 
 
-@app.route('/metadata/')
+@views.route('/metadata/')
 def metadata():
-    auth, auth_req = init_saml_auth(request)
-    settings = auth.get_settings()
-    metadata = settings.get_sp_metadata()
-    errors = settings.validate_metadata(metadata)
+    '''
+    Serves the SP metadata, which is rendered once and cached until the SAML settings change. Supports conditional requests with If-None-Match.
+    '''
+    from saml_utils import get_sp_metadata
+    metadata, errors, etag = get_sp_metadata(current_app.config['SAML_PATH'], current_app.config['SAML_METADATA_FILE'])
 
     if len(errors) == 0:
         resp = make_response(metadata, 200)
         resp.headers['Content-Type'] = 'text/xml'
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = current_app.config['SAML_METADATA_MAX_AGE']
+        # Returns 304 Not Modified if the client already has this version
+        resp = resp.make_conditional(request)
     else:
         resp = make_response(', '.join(errors), 500)
     return resp
 
 
-@app.route('/orcid', methods=('GET', 'POST'))
+@views.route('/metrics')
+def metrics():
+    '''
+    Serves the app's metrics in Prometheus's format (see orcidflask.metrics). If METRICS_TOKEN is set, requires it as a bearer token.
+    '''
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(403)
+    data, content_type = generate_metrics()
+    return make_response(data, 200, {'Content-Type': content_type})
+
+
+@views.route('/orcid', methods=('GET', 'POST'))
 def orcid_login():
     '''
     Should render homepage and if behind SSO, retrieve netID from SAML and store in a session variable.
@@ -109,68 +157,83 @@ def orcid_login():
     register = request.args.get('register')
     # If no SAML attributes, redirect for SSO
     if not session.get('samlNameId'):
-        return redirect(url_for('index', _external=True, _scheme='https'))
+        return redirect(url_for('views.index', _external=True, _scheme='https'))
     # If the scopes param is part of the request, we're not using the form
     elif scopes or request.method == 'POST':
         # Get the scopes from the form is not part of the URL
         if not scopes:
             scopes = ' '.join(request.form.keys())
         # Get user data from SAML for registration form
-        saml_user_data = extract_saml_user_data(session, populate=app.config['PREFILL_REGISTRATION'])
-        if register == 'True':
-            orcid_auth_url = app.config['orcid_register_url']
-        else:
-            orcid_auth_url = app.config['orcid_auth_url']
-        return redirect(orcid_auth_url.format(orcid_client_id=app.config['CLIENT_ID'], 
-                                                        scopes=scopes,
-                                                        redirect_uri=url_for('orcid_redirect',
-                                                        _scheme='https', 
-                                                        _external=True),
-                                                        **saml_user_data))
+        saml_user_data = extract_saml_user_data(session, populate=current_app.config['PREFILL_REGISTRATION'])
+        return redirect(get_authorize_url_builder().build(scopes, register=register == 'True', **saml_user_data))
     # Used when not passing in scopes from the SLO process (i.e., when getting from the user)
     else:   
         return render_template('orcid_login.html')
 
-@app.route('/orcid-redirect')
+@views.route('/orcid-redirect')
 def orcid_redirect():
     '''
     Redirect route that retrieves the one-time code from ORCID after user logs in and approves.
     '''
     # Redirect here for access denied page
     if request.args.get('error') == 'access_denied':
-        return redirect(app.config['ORCID_FAILURE_URL'])
+        audit('access_denied', user_id=session.get('samlNameId'))
+        return redirect(current_app.config['ORCID_FAILURE_URL'])
     
     elif request.args.get('error'):
-        app.logger.error(f'OAuth Error {request.args.get("error")};')
+        current_app.logger.error(f'OAuth Error {request.args.get("error")};')
+        audit('oauth_error', user_id=session.get('samlNameId'), error=request.args.get('error'),
+              description=request.args.get('error_description'))
         return render_template('oauth_error.html')
         
     orcid_code = request.args.get('code')
-    headers = {'Accept': 'application/json',
-                'Content-Type': 'application/x-www-form-urlencoded'}
+    # Queue the code for the exchange-worker process, rather than waiting on ORCID and the database here
+    if current_app.config['ASYNC_TOKEN_EXCHANGE']:
+        exchange = TokenExchange(userId=session.get('samlNameId'), code=orcid_code,
+                                redirect_uri=get_redirect_uri())
+        db.session.add(exchange)
+        db.session.commit()
+        return redirect(url_for('views.orcid_status', exchange_id=exchange.id, _external=True, _scheme='https'))
     try:
-        response = requests.post(app.config['orcid_token_url'], 
-                                headers=headers, 
-                                data=prepare_token_payload(orcid_code))
+        response = request_orcid_token(prepare_token_payload(orcid_code))
         response.raise_for_status()
     except HTTPError as e:
-        app.logger.error(f'HTTPError {response.status_code}; Message {response.text}')
+        current_app.logger.error(f'HTTPError {response.status_code}; Message {response.text}')
+        audit('oauth_error', user_id=session.get('samlNameId'), error=f'HTTP {response.status_code}')
+        return render_template('oauth_error.html')
+    except (RequestException, CircuitOpenError) as e:
+        current_app.logger.error(f'ORCID token request failed: {e}')
+        audit('oauth_error', user_id=session.get('samlNameId'), error=type(e).__name__)
         return render_template('oauth_error.html')
     orcid_auth = response.json()
     # Get the user's ID from the SSO process
     saml_id = session.get('samlNameId')
-    # Get token info from the response object
-    access_token = orcid_auth['access_token']
-    refresh_token = orcid_auth['refresh_token']
-    expires_in = orcid_auth['expires_in']
-    token_scope = orcid_auth['scope']
-    orcid = orcid_auth['orcid']
-
-    # Save to data store
-    token = Token(userId = saml_id, access_token = access_token, refresh_token = refresh_token,
-            expires_in = expires_in, token_scope = token_scope, orcid = orcid)
-    db.session.add(token)
-    db.session.commit()
+
+    # Save to data store, replacing any previous token for this user and ORCID iD
+    token = Token.values_from_orcid_auth(saml_id, orcid_auth)
+    if current_app.config['BATCH_TOKEN_WRITES']:
+        get_token_writer().write(token)
+    else:
+        save_token(token)
+    # So that the token lookup API serves the new token
+    invalidate_tokens([token['orcid']])
+    audit('consent_granted', user_id=saml_id, orcid=token['orcid'], scope=token['token_scope'])
 
     # return success page - testing only
     #return render_template('orcid_success.html', saml_id=saml_id, orcid_auth={k: v for k,v in orcid_auth.items() if not k.endswith('token')})
-    return redirect(app.config['ORCID_SUCCESS_URL'])
\ No newline at end of file
+    return redirect(current_app.config['ORCID_SUCCESS_URL'])
+
+@views.route('/orcid-status/<int:exchange_id>')
+def orcid_status(exchange_id):
+    '''
+    Status page for a queued token exchange (see ASYNC_TOKEN_EXCHANGE). Refreshes itself until the exchange has completed, and then redirects.
+    '''
+    exchange = db.session.query(TokenExchange.userId, TokenExchange.status).filter_by(id=exchange_id).first_or_404()
+    # Only the user who authorized the exchange may see its status
+    if exchange.userId != session.get('samlNameId'):
+        abort(404)
+    if exchange.status == 'done':
+        return redirect(current_app.config['ORCID_SUCCESS_URL'])
+    elif exchange.status == 'failed':
+        return render_template('oauth_error.html')
+    return render_template('orcid_pending.html', refresh=current_app.config['ASYNC_TOKEN_EXCHANGE_POLL_INTERVAL'])
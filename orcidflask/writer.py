@@ -0,0 +1,87 @@
+'''
+Batched writing of tokens (see BATCH_TOKEN_WRITES). When a worker process handles requests concurrently (e.g., with gunicorn's gthread workers), tokens saved at about the same time are grouped into a single transaction, reducing the number of commits (and WAL flushes) under heavy load.
+'''
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from flask import current_app
+from orcidflask import db
+from orcidflask.models import upsert_tokens
+
+class BatchedTokenWriter:
+    '''
+    Collects tokens from request threads and writes them with upsert_tokens on a background thread. Each caller blocks until its token has been committed (or the commit has failed), so a token is never reported as saved before it is.
+    :param app: the Flask app
+    :param max_batch: maximum number of tokens per transaction
+    :param max_wait: maximum number of seconds to wait for more tokens before committing a batch
+    '''
+    def __init__(self, app, max_batch=100, max_wait=0.05):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='token-writer', daemon=True)
+        self.thread.start()
+
+    def write(self, record, timeout=30):
+        '''
+        Saves a token, returning once it has been committed. Raises the database error if the batch could not be committed.
+        :param record: a dict of column values (see Token.values_from_orcid_auth)
+        :param timeout: maximum number of seconds to wait for the commit
+        '''
+        future = Future()
+        self.queue.put((record, future))
+        return future.result(timeout=timeout)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            with self.app.app_context():
+                try:
+                    upsert_tokens([record for record, _ in batch])
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    for _, future in batch:
+                        future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        future.set_result(None)
+                finally:
+                    db.session.remove()
+
+# One writer per process, since threads do not survive a fork
+_writers = {}
+_writers_lock = threading.Lock()
+
+def get_token_writer():
+    '''
+    Returns the current process's BatchedTokenWriter, creating it from the app's config object if necessary
+    '''
+    pid = os.getpid()
+    writer = _writers.get(pid)
+    if writer is None:
+        # Only one request thread may create the writer (and its flush thread)
+        with _writers_lock:
+            writer = _writers.get(pid)
+            if writer is None:
+                app = current_app._get_current_object()
+                _writers.clear()
+                writer = _writers[pid] = BatchedTokenWriter(app, max_batch=app.config['TOKEN_WRITE_BATCH_SIZE'],
+                                                            max_wait=app.config['TOKEN_WRITE_BATCH_WAIT'])
+    return writer
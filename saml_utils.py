@@ -4,9 +4,173 @@ The following code closely follows the Flask example at https://github.com/onelo
 '''
 
 from onelogin.saml2.auth import OneLogin_Saml2_Auth
-from onelogin.saml2.utils import OneLogin_Saml2_Utils
+from onelogin.saml2.settings import OneLogin_Saml2_Settings
+from onelogin.saml2.utils import OneLogin_Saml2_Utils, OneLogin_Saml2_Error
 from flask import current_app
 from urllib.parse import urlparse
+import os
+import json
+import threading
+import hashlib
+import time
+
+# Certificate and key files that python3-saml reads from the certs directory, mapped to the corresponding settings
+CERT_FILES = {'sp.key': ('sp', 'privateKey'),
+              'sp.crt': ('sp', 'x509cert'),
+              'sp_new.crt': ('sp', 'x509certNew'),
+              'idp.crt': ('idp', 'x509cert')}
+
+# Parsed settings, cached per process by SAML path, along with the modification times of the files they were loaded from
+_settings_cache = {}
+_settings_lock = threading.Lock()
+
+def saml_settings_files(saml_path):
+    '''
+    Returns the paths to the files from which the SAML settings are loaded
+    :param saml_path: path to the directory containing settings.json
+    '''
+    return ([os.path.join(saml_path, name) for name in ('settings.json', 'advanced_settings.json')] +
+            [os.path.join(saml_path, 'certs', name) for name in CERT_FILES])
+
+def saml_settings_version(saml_path):
+    '''
+    Returns the modification times of the SAML settings files (None for a missing file), for detecting changes
+    :param saml_path: path to the directory containing settings.json
+    '''
+    version = []
+    for file in saml_settings_files(saml_path):
+        try:
+            version.append(os.stat(file).st_mtime_ns)
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+def load_saml_settings(saml_path):
+    '''
+    Loads and validates the SAML settings, including the certificate and key files, so that python3-saml does not need to read any files when handling a request. Raises OneLogin_Saml2_Error if the settings are invalid.
+    :param saml_path: path to the directory containing settings.json
+    returns a python-saml settings object
+    '''
+    with open(os.path.join(saml_path, 'settings.json')) as f:
+        settings = json.load(f)
+    advanced_settings = os.path.join(saml_path, 'advanced_settings.json')
+    if os.path.exists(advanced_settings):
+        with open(advanced_settings) as f:
+            settings.update(json.load(f))
+    for name, (section, key) in CERT_FILES.items():
+        cert_file = os.path.join(saml_path, 'certs', name)
+        if not settings.get(section, {}).get(key) and os.path.exists(cert_file):
+            with open(cert_file) as f:
+                settings.setdefault(section, {})[key] = f.read()
+    return OneLogin_Saml2_Settings(settings, custom_base_path=saml_path)
+
+def get_saml_settings(saml_path):
+    '''
+    Returns the SAML settings for the provided path, loading them only if they have not yet been loaded by this process or if the files have changed since
+    :param saml_path: path to the directory containing settings.json
+    '''
+    version = saml_settings_version(saml_path)
+    cached = _settings_cache.get(saml_path)
+    if cached is None or cached[0] != version:
+        with _settings_lock:
+            cached = _settings_cache.get(saml_path)
+            if cached is None or cached[0] != version:
+                cached = _settings_cache[saml_path] = (version, load_saml_settings(saml_path))
+    return cached[1]
+
+def render_sp_metadata(settings):
+    '''
+    Generates and validates the SP metadata
+    :param settings: a python-saml settings object
+    returns the metadata XML (as bytes) and a list of validation errors
+    '''
+    metadata = settings.get_sp_metadata()
+    errors = settings.validate_metadata(metadata)
+    if isinstance(metadata, str):
+        metadata = metadata.encode('utf-8')
+    return metadata, errors
+
+# Rendered metadata, cached per process by SAML path, along with the settings object (or metadata file version) it was rendered from
+_metadata_cache = {}
+
+def get_sp_metadata(saml_path, metadata_file=None):
+    '''
+    Returns the SP metadata, rendering it only when the SAML settings (or the metadata file) have changed.
+    :param saml_path: path to the directory containing settings.json
+    :param metadata_file: optional path to a pre-generated metadata file (see generate_saml_metadata.py) to serve instead of rendering the metadata
+    returns the metadata XML (as bytes), a list of validation errors, and a strong ETag for the metadata
+    '''
+    if metadata_file:
+        source = os.stat(metadata_file).st_mtime_ns
+    else:
+        source = get_saml_settings(saml_path)
+    cached = _metadata_cache.get(saml_path)
+    if cached is None or cached[0] != source:
+        if metadata_file:
+            with open(metadata_file, 'rb') as f:
+                metadata, errors = f.read(), []
+        else:
+            metadata, errors = render_sp_metadata(source)
+        cached = _metadata_cache[saml_path] = (source, metadata, errors, hashlib.sha256(metadata).hexdigest())
+    return cached[1:]
+
+class TimedSaml2Auth(OneLogin_Saml2_Auth):
+    '''
+    python3-saml auth object that records the time spent in each stage of processing a SAML response (in the timings dict), and that can reject a response after it has been parsed but before its signature is verified (see process_response).
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = {}
+
+    def process_response(self, request_id=None, precheck=None):
+        '''
+        Processes the SAML response sent by the IdP, as OneLogin_Saml2_Auth.process_response does.
+        :param request_id: the ID of the AuthNRequest sent to the IdP, if any
+        :param precheck: an optional function that receives the parsed (but not yet validated) response object and returns an error code to reject it with, or None to continue
+        '''
+        self._errors = []
+        self._error_reason = None
+        self.timings = {}
+        if 'post_data' not in self._request_data or 'SAMLResponse' not in self._request_data['post_data']:
+            self._errors.append('invalid_binding')
+            raise OneLogin_Saml2_Error(
+                'SAML Response not found, Only supported HTTP_POST Binding',
+                OneLogin_Saml2_Error.SAML_RESPONSE_NOT_FOUND
+            )
+        start = time.perf_counter()
+        response = self.response_class(self._settings, self._request_data['post_data']['SAMLResponse'])
+        self._last_response = response.get_xml_document()
+        self.timings['parse'] = time.perf_counter() - start
+        if precheck:
+            start = time.perf_counter()
+            error = precheck(response)
+            self.timings['precheck'] = time.perf_counter() - start
+            if error:
+                self._errors.append(error)
+                self._error_reason = f'Response rejected before validation: {error}'
+                return
+        start = time.perf_counter()
+        valid = response.is_valid(self._request_data, request_id)
+        self.timings['validate'] = time.perf_counter() - start
+        if valid:
+            start = time.perf_counter()
+            self.store_valid_response(response)
+            self.timings['attributes'] = time.perf_counter() - start
+        else:
+            self._errors.append('invalid_response')
+            self._error_reason = response.get_error()
+
+def saml_response_ids(response):
+    '''
+    Returns the IDs of a parsed SAML response and of its assertion (if the response contains exactly one), for detecting replayed responses
+    :param response: a python-saml response object
+    '''
+    ids = [response.get_id()]
+    try:
+        ids.append(response.get_assertion_id())
+    except Exception:
+        pass
+    return [id for id in ids if id]
 
 def init_saml_auth(request):
     '''
@@ -16,7 +180,7 @@ def init_saml_auth(request):
     # Get current Flask app (to access configurations)
     app = current_app._get_current_object()
     auth_req = prepare_flask_request(request)
-    auth = OneLogin_Saml2_Auth(auth_req, custom_base_path=app.config['SAML_PATH'])
+    auth = TimedSaml2Auth(auth_req, old_settings=get_saml_settings(app.config['SAML_PATH']))
     return auth, auth_req
 
 def prepare_flask_request(request):
@@ -58,6 +222,9 @@ def add_metadata_to_session(auth, session):
     # Delete the previous session ID if storing this
     if 'AuthNRequestID' in session:
         del session['AuthNRequestID']
+    # With server-side sessions, issue a new session id upon login
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
     # Store SAML attributes in the session object
     session['samlUserdata'] = auth.get_attributes()
     session['samlNameId'] = auth.get_nameid()
@@ -0,0 +1,34 @@
+'''
+Shared fixtures. The tests import the app's modules, and the helpers in tests/helpers.py, from the repository's root.
+'''
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.helpers import start_stub
+
+@pytest.fixture
+def stub():
+    '''
+    A stub ORCID server (see tests.helpers.StubOrcidHandler) on a local port, with its URL as stub.url
+    '''
+    server, url = start_stub(0)
+    server.url = url
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def db_app():
+    '''
+    The app, in an app context, for tests that use the database. These write (and should afterwards delete) test rows, so they need the app's settings and a throwaway database (see the POSTGRES_* variables), and are skipped otherwise.
+    '''
+    if not (os.getenv('ORCIDFLASK_SETTINGS') and os.getenv('POSTGRES_DB')):
+        pytest.skip('needs ORCIDFLASK_SETTINGS and a database (POSTGRES_*)')
+    from orcidflask import create_app, db
+    app = create_app()
+    with app.app_context():
+        yield app
+        db.session.rollback()
@@ -0,0 +1,184 @@
+'''
+Helpers shared by the tests and benchmark.py: a stub ORCID server to run against on a local port, a fake SAML identity provider, and test tokens in the database.
+'''
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+def seed_tokens(rows, prefix, scope='/read-limited'):
+    '''
+    Inserts the provided number of fake tokens, with user IDs starting with prefix
+    '''
+    from orcidflask import db
+    from orcidflask.models import Token, upsert_tokens
+    for start in range(0, rows, 1000):
+        upsert_tokens([Token.values_from_orcid_auth(f'{prefix}{i}', {'orcid': f'0000-0000-{i:09d}', 'name': 'Benchmark User',
+                                                                     'access_token': str(uuid.uuid4()), 'refresh_token': str(uuid.uuid4()),
+                                                                     'expires_in': 631138518, 'scope': scope})
+                       for i in range(start, min(start + 1000, rows))])
+        db.session.commit()
+
+def delete_tokens(prefix):
+    '''
+    Deletes the tokens (and their history) created by a benchmark or test
+    '''
+    from orcidflask import db
+    from orcidflask.models import Token, TokenHistory
+    TokenHistory.query.filter(TokenHistory.userId.startswith(prefix)).delete(synchronize_session=False)
+    Token.query.filter(Token.userId.startswith(prefix)).delete(synchronize_session=False)
+    db.session.commit()
+
+class StubOrcidHandler(BaseHTTPRequestHandler):
+    '''
+    Stand-in for ORCID's /oauth/token endpoint, which returns a new token for every code, and for the record sections of its API (GET /v3.0/<orcid>/<section>), which return an ETag (changed by incrementing server.version) and honor If-None-Match. Responses are sent after an optional delay (server.delay) simulating ORCID's latency. Requests are counted by method in server.requests; statuses appended to server.failures are returned, one per request, before any other response (e.g., to simulate 503s).
+    '''
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, data=None, headers={}):
+        body = json.dumps(data).encode() if data is not None else b''
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (e.g., after a read timeout)
+            pass
+
+    def fail(self):
+        '''
+        Sends the next queued failure, if any, returning True if one was sent
+        '''
+        with self.server.lock:
+            status = self.server.failures.popleft() if self.server.failures else None
+        if status is not None:
+            self.send_json(status, {'error': 'stub_failure', 'error_description': f'HTTP {status} from the stub'})
+        return status is not None
+
+    def count(self):
+        with self.server.lock:
+            self.server.requests[self.command] += 1
+
+    def do_GET(self):
+        self.count()
+        time.sleep(self.server.delay)
+        if self.fail():
+            return
+        _, version, orcid, section = self.path.split('/', 3)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            return self.send_json(401, {'error': 'invalid_token'})
+        etag = f'"{orcid}-{section}-{self.server.version}"'
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_json(304, headers={'ETag': etag})
+        record = {'orcid-identifier': {'path': orcid}, 'section': section,
+                  'works': [{'put-code': i, 'title': {'title': {'value': f'Benchmark work {i}'}}, 'type': 'journal-article'} for i in range(20)]}
+        self.send_json(200, record, headers={'ETag': etag})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        self.count()
+        time.sleep(self.server.delay)
+        if self.fail():
+            return
+        if self.path.endswith('/works'):
+            # ORCID's bulk endpoint, which returns each work with the put-code assigned to it
+            works = [item['work'] for item in json.loads(body)['bulk']]
+            with self.server.lock:
+                put_codes = [next(self.server.put_codes) for _ in works]
+            return self.send_json(200, {'bulk': [{'work': {**work, 'put-code': put_code}} for work, put_code in zip(works, put_codes)]})
+        form = parse_qs(body)
+        self.send_json(200, {'access_token': str(uuid.uuid4()), 'refresh_token': str(uuid.uuid4()), 'expires_in': 631138518,
+                             'scope': '/read-limited', 'name': 'Benchmark User', 'orcid': form.get('code', [''])[0]})
+
+    def do_PUT(self):
+        work = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        self.count()
+        time.sleep(self.server.delay)
+        if self.fail():
+            return
+        self.send_json(200, work)
+
+def start_stub(delay):
+    '''
+    Starts a StubOrcidHandler server on a background thread, returning the server and its URL
+    '''
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubOrcidHandler)
+    stub.delay = delay
+    stub.version = 1
+    stub.lock = threading.Lock()
+    stub.put_codes = itertools.count(1)
+    stub.requests = Counter()
+    stub.failures = deque()
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    return stub, f'http://127.0.0.1:{stub.server_address[1]}'
+
+class FakeIdp:
+    '''
+    Stand-in for the SAML identity provider: signs assertions for any user with a throwaway key. Writes a copy of the app's SAML settings, trusting this IdP instead of the real one, to a temporary directory (saml_path).
+    '''
+    entity_id = 'https://idp.benchmark.invalid/'
+
+    def __init__(self, app_saml_path):
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'benchmark-idp')])
+        cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(private_key.public_key())
+                .serial_number(x509.random_serial_number()).not_valid_before(datetime.utcnow() - timedelta(days=1))
+                .not_valid_after(datetime.utcnow() + timedelta(days=1)).sign(private_key, hashes.SHA256()))
+        self.key = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                             serialization.NoEncryption()).decode()
+        self.cert = cert.public_bytes(serialization.Encoding.PEM).decode()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saml_path = os.path.join(self.tmp.name, 'saml')
+        shutil.copytree(app_saml_path, self.saml_path)
+        with open(os.path.join(self.saml_path, 'settings.json')) as f:
+            settings = json.load(f)
+        settings['idp'].update(entityId=self.entity_id, x509cert=self.cert)
+        with open(os.path.join(self.saml_path, 'settings.json'), 'w') as f:
+            json.dump(settings, f)
+        idp_cert = os.path.join(self.saml_path, 'certs', 'idp.crt')
+        if os.path.exists(idp_cert):
+            os.remove(idp_cert)
+        self.sp_entity_id = settings['sp']['entityId']
+        self.acs_url = settings['sp']['assertionConsumerService']['url']
+
+    def response(self, name_id, attributes):
+        '''
+        Returns a base64-encoded SAML response, with a signed assertion, for the provided user
+        '''
+        from onelogin.saml2.utils import OneLogin_Saml2_Utils
+        from onelogin.saml2.constants import OneLogin_Saml2_Constants
+        now = datetime.utcnow()
+        fmt = lambda t: t.strftime('%Y-%m-%dT%H:%M:%SZ')
+        expires = fmt(now + timedelta(minutes=5))
+        attribute_xml = ''.join(f'<saml:Attribute Name="{name}"><saml:AttributeValue>{value}</saml:AttributeValue></saml:Attribute>'
+                                for name, value in attributes.items())
+        assertion = (f'<saml:Assertion xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_{uuid.uuid4().hex}" Version="2.0" IssueInstant="{fmt(now)}">'
+                     f'<saml:Issuer>{self.entity_id}</saml:Issuer>'
+                     f'<saml:Subject><saml:NameID Format="urn:oasis:names:tc:SAML:1.1:nameid-format:unspecified">{name_id}</saml:NameID>'
+                     f'<saml:SubjectConfirmation Method="urn:oasis:names:tc:SAML:2.0:cm:bearer"><saml:SubjectConfirmationData NotOnOrAfter="{expires}" Recipient="{self.acs_url}"/></saml:SubjectConfirmation></saml:Subject>'
+                     f'<saml:Conditions NotBefore="{fmt(now - timedelta(minutes=1))}" NotOnOrAfter="{expires}"><saml:AudienceRestriction><saml:Audience>{self.sp_entity_id}</saml:Audience></saml:AudienceRestriction></saml:Conditions>'
+                     f'<saml:AuthnStatement AuthnInstant="{fmt(now)}" SessionIndex="_{uuid.uuid4().hex}"><saml:AuthnContext><saml:AuthnContextClassRef>urn:oasis:names:tc:SAML:2.0:ac:classes:Password</saml:AuthnContextClassRef></saml:AuthnContext></saml:AuthnStatement>'
+                     f'<saml:AttributeStatement>{attribute_xml}</saml:AttributeStatement></saml:Assertion>')
+        assertion = OneLogin_Saml2_Utils.add_sign(assertion, self.key, self.cert, sign_algorithm=OneLogin_Saml2_Constants.RSA_SHA256,
+                                                  digest_algorithm=OneLogin_Saml2_Constants.SHA256).decode()
+        response = (f'<samlp:Response xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_{uuid.uuid4().hex}" Version="2.0" IssueInstant="{fmt(now)}" Destination="{self.acs_url}">'
+                    f'<saml:Issuer>{self.entity_id}</saml:Issuer><samlp:Status><samlp:StatusCode Value="urn:oasis:names:tc:SAML:2.0:status:Success"/></samlp:Status>'
+                    f'{assertion}</samlp:Response>')
+        return OneLogin_Saml2_Utils.b64encode(response)
@@ -0,0 +1,25 @@
+'''
+Tests of the token buckets of AdmissionController
+'''
+import time
+import pytest
+from orcidflask.admission import AdmissionController, BUCKET, HEADER, SLOT_SIZE
+
+RULES = {'views.index': {'rate': 0.001, 'burst': 2}}
+
+@pytest.fixture
+def controller(tmp_path):
+    return AdmissionController(str(tmp_path / 'admission'), RULES)
+
+def test_burst_then_rate_limited(controller):
+    assert controller.acquire('views.index') is None
+    assert controller.acquire('views.index') is None
+    reason, retry_after = controller.acquire('views.index')
+    assert reason == 'rate' and retry_after > 0
+
+def test_bucket_from_an_earlier_boot_starts_full(controller):
+    # An empty bucket, last updated later than now by the monotonic clock, as if the host had restarted since
+    BUCKET.pack_into(controller.map, HEADER.size + SLOT_SIZE * controller.slots['views.index'], 0, time.monotonic() + 86400)
+    assert controller.acquire('views.index') is None
+    assert controller.acquire('views.index') is None
+    assert controller.acquire('views.index')[0] == 'rate'
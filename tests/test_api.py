@@ -0,0 +1,97 @@
+'''
+Tests of the token lookup API (see orcidflask.api): authentication with the keys in API_KEYS, lookups, and the invalidation of cached tokens when the app saves a new one. These use the database (see the db_app fixture).
+'''
+import uuid
+import pytest
+from tests.helpers import delete_tokens
+
+KEY = 'test-key'
+
+@pytest.fixture
+def app(db_app, monkeypatch):
+    from orcidflask import api
+    db_app.config.update(API_KEYS={'test-client': KEY}, API_CACHE_TTL=60, API_LOOKUP_MAX_BATCH=4, BATCH_TOKEN_WRITES=False, ASYNC_TOKEN_EXCHANGE=False)
+    monkeypatch.setattr(api, '_caches', {})
+    db_app.prefix = f'test-api-{uuid.uuid4().hex[:8]}-'
+    yield db_app
+    delete_tokens(db_app.prefix)
+
+def save_token(app, name, access_token='access'):
+    '''
+    Saves a token for a new user and ORCID iD, returning the ORCID iD
+    '''
+    from orcidflask import db
+    from orcidflask.models import Token, upsert_tokens
+    orcid = f'{app.prefix}{name}'
+    upsert_tokens([Token.values_from_orcid_auth(app.prefix + name, {'orcid': orcid, 'name': 'Test User', 'access_token': access_token,
+                                                                    'refresh_token': 'refresh', 'expires_in': 631138518, 'scope': '/read-limited'})])
+    db.session.commit()
+    return orcid
+
+def get(app, path, key=KEY):
+    headers = {'Authorization': f'Bearer {key}'} if key else {}
+    return app.test_client().get('/api' + path, headers=headers, base_url='https://localhost')
+
+def post(app, body):
+    return app.test_client().post('/api/tokens:lookup', json=body, headers={'Authorization': f'Bearer {KEY}'}, base_url='https://localhost')
+
+def lookup(app, orcids):
+    return post(app, {'orcids': orcids})
+
+def test_requests_need_a_key(app):
+    orcid = save_token(app, 'a')
+    for key in (None, 'wrong', KEY + 'x'):
+        response = get(app, f'/tokens/{orcid}', key=key)
+        assert response.status_code == 401
+        assert response.json['error'] == 'Unauthorized'
+    assert get(app, f'/tokens/{orcid}').status_code == 200
+
+def test_api_is_off_without_keys(app):
+    app.config['API_KEYS'] = {}
+    assert get(app, f'/tokens/{save_token(app, "a")}').status_code == 404
+
+def test_get_token(app):
+    orcid = save_token(app, 'a', access_token='access a')
+    response = get(app, f'/tokens/{orcid}')
+    assert response.json['orcid'] == orcid and response.json['access_token'] == 'access a'
+    response = get(app, f'/tokens/{app.prefix}missing')
+    assert response.status_code == 404
+    assert response.json['error'] == 'Not Found'
+
+def test_batch_lookup(app):
+    a, b = save_token(app, 'a'), save_token(app, 'b')
+    missing = app.prefix + 'missing'
+    response = lookup(app, [a, missing, b, a])
+    assert response.status_code == 200
+    assert set(response.json['tokens']) == {a, b}
+    assert response.json['missing'] == [missing]
+
+@pytest.mark.parametrize('body', [{}, {'orcids': 'not a list'}, {'orcids': [1]}, {'orcids': ['a', 'b', 'c', 'd', 'e']}])
+def test_invalid_batch_lookup(app, body):
+    response = post(app, body)
+    assert response.status_code == 400
+    assert response.json['error'] == 'Bad Request'
+
+def test_cached_token_is_served_until_invalidated(app):
+    from orcidflask.api import invalidate_tokens
+    orcid = save_token(app, 'a', access_token='old')
+    assert get(app, f'/tokens/{orcid}').json['access_token'] == 'old'
+    # Saved without invalidating the cache, as by another process
+    save_token(app, 'a', access_token='new')
+    assert get(app, f'/tokens/{orcid}').json['access_token'] == 'old'
+    assert lookup(app, [orcid]).json['tokens'][orcid]['access_token'] == 'old'
+    invalidate_tokens([orcid])
+    assert get(app, f'/tokens/{orcid}').json['access_token'] == 'new'
+
+def test_new_token_from_orcid_invalidates_cache(app, stub):
+    app.config['orcid_token_url'] = stub.url + '/oauth/token'
+    orcid = save_token(app, 'a', access_token='old')
+    assert get(app, f'/tokens/{orcid}').json['access_token'] == 'old'
+    # The user authorizes the app again; the stub returns the code as the token's ORCID iD
+    client = app.test_client()
+    with client.session_transaction(base_url='https://localhost') as session:
+        session['samlNameId'] = app.prefix + 'a'
+    response = client.get('/orcid-redirect', query_string={'code': orcid}, base_url='https://localhost')
+    assert response.status_code == 302 and response.location == app.config['ORCID_SUCCESS_URL']
+    assert stub.requests['POST'] == 1
+    assert get(app, f'/tokens/{orcid}').json['access_token'] != 'old'
@@ -0,0 +1,43 @@
+'''
+Tests of the triggers that keep the audit_event table append-only (see migration a343d46edbf1). These use the database (see the db_app fixture), and leave no rows behind: each test's event is rolled back.
+'''
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import InternalError
+
+@pytest.fixture
+def event_id(db_app):
+    '''
+    The id of an event inserted in the test's transaction, which is rolled back afterwards
+    '''
+    from orcidflask import db
+    from orcidflask.models import AuditEvent
+    insert = AuditEvent.__table__.insert().values(timestamp=text('now()'), event='test', userId='test-audit', details={'a': 1})
+    yield db.session.execute(insert.returning(AuditEvent.__table__.c.id)).scalar()
+    db.session.rollback()
+
+def event(id):
+    from orcidflask import db
+    return db.session.execute(text('SELECT event, details FROM audit_event WHERE id = :id'), {'id': id}).fetchone()
+
+def test_insert_is_allowed(event_id):
+    assert tuple(event(event_id)) == ('test', {'a': 1})
+
+@pytest.mark.parametrize('statement', ["UPDATE audit_event SET event = 'changed' WHERE id = :id",
+                                       "UPDATE audit_event SET details = NULL WHERE id = :id",
+                                       'DELETE FROM audit_event WHERE id = :id',
+                                       'TRUNCATE audit_event'])
+def test_changes_are_rejected(event_id, statement):
+    from orcidflask import db
+    with pytest.raises(InternalError, match='audit_event is append-only'):
+        with db.session.begin_nested():
+            db.session.execute(text(statement), {'id': event_id})
+    assert tuple(event(event_id)) == ('test', {'a': 1})
+
+def test_orm_delete_is_rejected(event_id):
+    from orcidflask import db
+    from orcidflask.models import AuditEvent
+    with pytest.raises(InternalError, match='audit_event is append-only'):
+        with db.session.begin_nested():
+            AuditEvent.query.filter_by(id=event_id).delete(synchronize_session=False)
+    assert event(event_id) is not None
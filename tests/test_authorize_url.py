@@ -0,0 +1,93 @@
+'''
+Tests of building the ORCID authorization URL (AuthorizeUrlBuilder) from the SAML attributes in the session (extract_saml_user_data)
+'''
+import random
+from urllib.parse import urlparse, parse_qs
+import pytest
+from orcid_utils import AuthorizeUrlBuilder, extract_saml_user_data
+
+AUTHORIZE_URL = 'https://sandbox.orcid.org/oauth/authorize'
+REDIRECT_URI = 'https://orcid.example.edu/orcid-redirect?next=a&b=c d'
+SCOPES = '/read-limited /activities/update'
+
+@pytest.fixture
+def builder():
+    return AuthorizeUrlBuilder(AUTHORIZE_URL, 'APP-1', REDIRECT_URI)
+
+def query(url):
+    assert url.startswith(AUTHORIZE_URL + '?')
+    return parse_qs(urlparse(url).query, keep_blank_values=True)
+
+def session(**attributes):
+    return {'samlUserdata': attributes}
+
+def test_fixed_parameters(builder):
+    params = query(builder.build(SCOPES))
+    assert params == {'client_id': ['APP-1'], 'response_type': ['code'], 'redirect_uri': [REDIRECT_URI], 'scope': [SCOPES]}
+
+@pytest.mark.parametrize('value', ['Jane', 'a&b=c', 'x+y', 'who?#frag', '100%', 'a/b;c,d:e@f', 'Zoë', '日本', 'non\u00a0breaking', "O'Brien (Jr.)"])
+def test_values_round_trip(builder, value):
+    user_data = extract_saml_user_data(session(lastname=[value], firstname=[value], emailaddress=[value]))
+    params = query(builder.build(SCOPES + ' ' + value, **user_data))
+    assert params['scope'] == [SCOPES + ' ' + value]
+    assert params['family_names'] == params['given_names'] == params['email'] == [value]
+    assert params['redirect_uri'] == [REDIRECT_URI]
+
+def test_random_values_round_trip(builder):
+    alphabet = 'abcXYZ019 &=+?#%/;,:@!$\'()*[]~-_.é日\u00a0'
+    rng = random.Random(0)
+    for _ in range(1000):
+        values = {attr: ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 12))) for attr in ('scopes', 'lastname', 'firstname', 'emailaddress')}
+        user_data = extract_saml_user_data(session(**{attr: [values[attr]] for attr in ('lastname', 'firstname', 'emailaddress')}))
+        params = query(builder.build(values['scopes'], **user_data))
+        assert params['scope'] == [values['scopes']]
+        for attr, param in builder.user_params.items():
+            # Blank values are left out
+            assert params.get(param, [''])[0] == user_data[attr]
+
+def test_blank_attributes_are_left_out(builder):
+    user_data = extract_saml_user_data(session(lastname=['  '], firstname=[''], emailaddress=[]))
+    assert user_data == {'emailaddress': '', 'firstname': '', 'lastname': ''}
+    params = query(builder.build(SCOPES, **user_data))
+    assert not {'family_names', 'given_names', 'email'} & set(params)
+
+def test_missing_attributes(builder):
+    assert extract_saml_user_data(session(firstname=['Jane'])) == {'emailaddress': '', 'firstname': 'Jane', 'lastname': ''}
+    assert extract_saml_user_data({}) == {'emailaddress': '', 'firstname': '', 'lastname': ''}
+    assert extract_saml_user_data(session(lastname=None)) == {'emailaddress': '', 'firstname': '', 'lastname': ''}
+
+def test_multi_valued_attributes_use_the_first_non_blank_value():
+    user_data = extract_saml_user_data(session(emailaddress=['', '  ', ' jdoe@example.edu ', 'jane@example.edu'], lastname=[None, 'Doe']))
+    assert user_data['emailaddress'] == 'jdoe@example.edu'
+    assert user_data['lastname'] == 'Doe'
+
+def test_str_and_list_values_are_equivalent():
+    assert extract_saml_user_data(session(firstname='Jane', lastname=' Doe ')) == \
+           extract_saml_user_data(session(firstname=['Jane'], lastname=['Doe']))
+
+def test_populate_false():
+    assert extract_saml_user_data(session(firstname=['Jane']), populate=False) == {'emailaddress': '', 'firstname': '', 'lastname': ''}
+
+def test_register(builder):
+    assert query(builder.build(SCOPES, register=True))['show_login'] == ['false']
+    assert 'show_login' not in query(builder.build(SCOPES))
+
+def test_without_server_name(tmp_path, monkeypatch):
+    # Without SERVER_NAME, the redirect URI is built for the host of each request
+    from orcidflask import create_app
+    from orcid_utils import prepare_token_payload
+    settings = tmp_path / 'settings.py'
+    settings.write_text("SECRET_KEY = b'x' * 32\nCLIENT_ID = 'APP-1'\nCLIENT_SECRET = 'secret'\nPREFILL_REGISTRATION = True\n")
+    monkeypatch.setenv('ORCIDFLASK_SETTINGS', str(settings))
+    app = create_app()
+    client = app.test_client()
+    with client.session_transaction(base_url='https://orcid.example.edu') as session:
+        session['samlNameId'] = 'jdoe'
+        session['samlUserdata'] = {'firstname': ['Jane']}
+    response = client.get('/orcid', query_string={'scopes': SCOPES}, base_url='https://orcid.example.edu')
+    assert response.status_code == 302
+    params = parse_qs(urlparse(response.location).query)
+    assert params['redirect_uri'] == ['https://orcid.example.edu/orcid-redirect']
+    assert params['scope'] == [SCOPES] and params['given_names'] == ['Jane']
+    with app.test_request_context(base_url='https://orcid.example.edu'):
+        assert prepare_token_payload('code')['redirect_uri'] == 'https://orcid.example.edu/orcid-redirect'
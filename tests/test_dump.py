@@ -0,0 +1,113 @@
+'''
+Tests of reading the dumps written by serialize-db: finding where to resume a truncated JSON Lines dump (find_last_serialized_id), and decoding dumps, complete or not (iter_dump_records). The test of serialize-db --resume uses the database (see the db_app fixture).
+'''
+import gzip
+import json
+import uuid
+import click
+import pytest
+from orcidflask.commands import find_last_serialized_id, iter_dump_records
+from tests.helpers import seed_tokens, delete_tokens
+
+RECORDS = [{'id': i, 'userId': f'user{i}', 'access_token': f'token {i}', 'orcid': '0000-0001-2345-6789'} for i in range(1, 6)]
+
+def jsonl(records):
+    return ''.join(json.dumps(record) + '\n' for record in records)
+
+def array(records):
+    # As written by serialize-db, on a single line
+    return '[' + ', '.join(json.dumps(record) for record in records) + ']'
+
+def write(path, text):
+    if str(path).endswith('.gz'):
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        path.write_text(text, encoding='utf-8')
+    return str(path)
+
+def truncated_gzip(path, text):
+    # As left by a process killed part way through writing: the end of the compressed stream is missing
+    write(path, text)
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+    return str(path)
+
+def test_missing_or_empty_dump(tmp_path):
+    assert find_last_serialized_id(str(tmp_path / 'missing.jsonl')) == 0
+    assert find_last_serialized_id(write(tmp_path / 'empty.jsonl', '')) == 0
+
+@pytest.mark.parametrize('name', ['dump.jsonl', 'dump.jsonl.gz'])
+def test_complete_dump(tmp_path, name):
+    file = write(tmp_path / name, jsonl(RECORDS))
+    assert find_last_serialized_id(file) == 5
+    assert list(iter_dump_records(file)) == RECORDS
+
+@pytest.mark.parametrize('partial', ['{"id": 6, "userId": "us', '{"id": 6}'])
+def test_partial_final_line_is_truncated(tmp_path, partial):
+    # Even if what was written of the last line parses, it was cut off without its newline
+    text = jsonl(RECORDS)
+    file = write(tmp_path / 'dump.jsonl', text + partial)
+    assert find_last_serialized_id(file) == 5
+    assert (tmp_path / 'dump.jsonl').read_text() == text
+    # So that the records appended on resuming follow on from the last complete one
+    with open(file, 'a') as f:
+        f.write(jsonl([{'id': 6}]))
+    assert [record['id'] for record in iter_dump_records(file)] == [1, 2, 3, 4, 5, 6]
+
+def test_partial_final_line_of_gzip_dump(tmp_path):
+    # A compressed dump cannot be truncated in place
+    file = write(tmp_path / 'dump.jsonl.gz', jsonl(RECORDS) + '{"id": 6, "userId": "us')
+    with pytest.raises(click.ClickException, match='the last record is incomplete'):
+        find_last_serialized_id(file)
+
+def test_truncated_gzip_dump(tmp_path):
+    file = truncated_gzip(tmp_path / 'dump.jsonl.gz', jsonl(RECORDS * 200))
+    with pytest.raises(click.ClickException, match='EOFError'):
+        find_last_serialized_id(file)
+
+def test_invalid_record(tmp_path):
+    file = write(tmp_path / 'dump.jsonl', jsonl(RECORDS[:2]) + 'not JSON\n' + jsonl(RECORDS[2:]))
+    with pytest.raises(click.ClickException, match='Cannot resume'):
+        find_last_serialized_id(file)
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 20])
+def test_array_dump(tmp_path, chunk_size):
+    file = write(tmp_path / 'dump.json', array(RECORDS))
+    assert list(iter_dump_records(file, chunk_size=chunk_size)) == RECORDS
+    assert list(iter_dump_records(write(tmp_path / 'empty.json', '[]'), chunk_size=chunk_size)) == []
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 20])
+def test_truncated_array_dump(tmp_path, chunk_size):
+    text = array(RECORDS)
+    file = write(tmp_path / 'dump.json', text[:text.index('"token 4"')])
+    records = []
+    with pytest.raises(click.ClickException, match='not a complete JSON dump'):
+        for record in iter_dump_records(file, chunk_size=chunk_size):
+            records.append(record)
+    # The complete records before the cut are read
+    assert records == RECORDS[:3]
+
+@pytest.mark.parametrize('text', [array(RECORDS * 200), jsonl(RECORDS * 200)], ids=['array', 'jsonl'])
+def test_truncated_gzip_dump_is_not_loaded_silently(tmp_path, text):
+    file = truncated_gzip(tmp_path / 'dump.json.gz', text)
+    with pytest.raises(click.ClickException, match='not a complete'):
+        list(iter_dump_records(file))
+
+def test_serialize_resumes_after_truncated_dump(db_app, tmp_path):
+    prefix = f'test-dump-{uuid.uuid4().hex[:8]}-'
+    seed_tokens(5, prefix)
+    try:
+        runner = db_app.test_cli_runner()
+        path = tmp_path / 'dump.jsonl'
+        result = runner.invoke(args=['serialize-db', '--jsonl', '--batch-size', '2', str(path)])
+        assert result.exit_code == 0, result.output
+        complete = path.read_text()
+        # Interrupted part way through the third record from the end
+        lines = complete.splitlines(keepends=True)
+        path.write_text(''.join(lines[:-3]) + lines[-3][:20])
+        result = runner.invoke(args=['serialize-db', '--jsonl', '--resume', '--batch-size', '2', str(path)])
+        assert result.exit_code == 0, result.output
+        assert path.read_text() == complete
+    finally:
+        delete_tokens(prefix)
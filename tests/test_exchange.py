@@ -0,0 +1,109 @@
+'''
+Tests of the exchange worker (see orcidflask.exchange) against the stub ORCID token server, including failures to store the token once ORCID has accepted the code. These use the database (see the db_app fixture).
+'''
+import asyncio
+import uuid
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import func
+from tests.helpers import delete_tokens
+
+ORCID = '0000-0001-2345-6789'
+
+@pytest.fixture
+def app(db_app, stub):
+    from orcidflask import db
+    from orcidflask.models import TokenExchange
+    db_app.config['orcid_token_url'] = stub.url + '/oauth/token'
+    db_app.prefix = f'test-exchange-{uuid.uuid4().hex[:8]}-'
+    yield db_app
+    db.session.rollback()
+    TokenExchange.query.filter(TokenExchange.userId.startswith(db_app.prefix)).delete(synchronize_session=False)
+    db.session.commit()
+    delete_tokens(db_app.prefix)
+
+def queue(app):
+    from orcidflask import db
+    from orcidflask.models import TokenExchange
+    # The stub returns the code as the token's ORCID iD
+    exchange = TokenExchange(userId=app.prefix + 'user', code=ORCID, redirect_uri='https://example.org/orcid-redirect')
+    db.session.add(exchange)
+    db.session.commit()
+    return exchange.id
+
+def exchange(id):
+    from orcidflask import db
+    from orcidflask.models import TokenExchange
+    db.session.rollback()
+    return TokenExchange.query.get(id)
+
+def tokens(app):
+    from orcidflask.models import Token
+    return Token.query.filter(Token.userId.startswith(app.prefix)).all()
+
+def run_worker():
+    from orcidflask.exchange import run_exchange_worker
+    asyncio.run(run_exchange_worker(poll_interval=0.1, retry_backoff=0, once=True))
+
+def failing_upsert(monkeypatch, failures):
+    '''
+    Makes storing the token fail the provided number of times, as if the database were unavailable
+    '''
+    from orcidflask import exchange
+    upsert_tokens = exchange.upsert_tokens
+    remaining = [failures]
+
+    def upsert(records):
+        if remaining[0]:
+            remaining[0] -= 1
+            raise OperationalError('INSERT', {}, Exception('connection lost'))
+        upsert_tokens(records)
+    monkeypatch.setattr(exchange, 'upsert_tokens', upsert)
+
+def test_exchange(app, stub):
+    id = queue(app)
+    run_worker()
+    assert exchange(id).status == 'done'
+    assert exchange(id).code is None and exchange(id).response is None
+    assert [token.orcid for token in tokens(app)] == [ORCID]
+    assert stub.requests['POST'] == 1
+
+def test_storing_the_token_is_retried(app, stub, monkeypatch):
+    from orcidflask.exchange import DB_ATTEMPTS
+    failing_upsert(monkeypatch, DB_ATTEMPTS - 1)
+    id = queue(app)
+    run_worker()
+    assert exchange(id).status == 'done'
+    assert len(tokens(app)) == 1
+    assert stub.requests['POST'] == 1
+
+def test_reclaimed_exchange_is_finished_from_saved_response(app, stub, monkeypatch):
+    from orcidflask import db
+    from orcidflask.exchange import DB_ATTEMPTS
+    from orcidflask.models import TokenExchange
+    failing_upsert(monkeypatch, DB_ATTEMPTS)
+    id = queue(app)
+    run_worker()
+    # Left for another worker, with the response saved and the used code removed
+    assert exchange(id).status == 'processing'
+    assert exchange(id).code is None and exchange(id).response
+    assert not tokens(app)
+    # Once the processing timeout has passed, it is reclaimed, without sending the code to ORCID again
+    TokenExchange.query.filter_by(id=id).update({'updated': func.now() - func.make_interval(0, 0, 0, 0, 1)}, synchronize_session=False)
+    db.session.commit()
+    run_worker()
+    assert exchange(id).status == 'done' and exchange(id).response is None
+    assert [token.orcid for token in tokens(app)] == [ORCID]
+    assert stub.requests['POST'] == 1
+
+def test_expiry_leaves_exchanges_being_processed(app):
+    from orcidflask import db
+    from orcidflask.exchange import expire_exchanges
+    from orcidflask.models import TokenExchange
+    pending, processing = queue(app), queue(app)
+    TokenExchange.query.filter(TokenExchange.id.in_([pending, processing])).update({'created': func.now() - func.make_interval(0, 0, 0, 1)}, synchronize_session=False)
+    TokenExchange.query.filter_by(id=processing).update({'status': 'processing'}, synchronize_session=False)
+    db.session.commit()
+    expire_exchanges()
+    assert exchange(pending).status == 'failed' and exchange(pending).code is None
+    assert exchange(processing).status == 'processing' and exchange(processing).code == ORCID
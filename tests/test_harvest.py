@@ -0,0 +1,65 @@
+'''
+Tests of fetching record sections with revalidation of the on-disk cache (see orcidflask.harvest.fetch_section), against the stub ORCID API, and against canned responses for what the stub does not do
+'''
+import pytest
+import requests
+from orcid_utils import OrcidClient
+from orcidflask.harvest import RecordCache, fetch_section
+
+ORCID = '0000-0001-2345-6789'
+
+@pytest.fixture
+def cache(tmp_path):
+    return RecordCache(str(tmp_path / 'cache'))
+
+def response(status, content=b'', headers={}):
+    response = requests.Response()
+    response.status_code = status
+    response._content = content
+    response.headers.update(headers)
+    return response
+
+class CannedClient:
+    '''
+    Returns the provided responses in turn, recording the headers of each request
+    '''
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+def test_fetched_and_then_not_modified(stub, cache):
+    client = OrcidClient(timeout=(1, 1), retries=0)
+    url = f'{stub.url}/v3.0/{ORCID}/works'
+    outcome, body = fetch_section(client, cache, url, 'token')
+    assert outcome == 'fetched'
+    assert body['orcid-identifier']['path'] == ORCID
+    assert fetch_section(client, cache, url, 'token') == ('not modified', body)
+    stub.version += 1
+    assert fetch_section(client, cache, url, 'token')[0] == 'fetched'
+    assert stub.requests['GET'] == 3
+
+def test_cached_copy_without_body_is_not_revalidated(stub, cache):
+    client = OrcidClient(timeout=(1, 1), retries=0)
+    url = f'{stub.url}/v3.0/{ORCID}/works'
+    cache.set(url, f'"{ORCID}-works-1"', None, None)
+    outcome, body = fetch_section(client, cache, url, 'token')
+    assert outcome == 'fetched'
+    assert cache.get(url)['body'] == body
+
+def test_304_without_cached_copy_is_retried_unconditionally(cache):
+    client = CannedClient(response(304), response(200, b'{"works": []}', {'ETag': '"1"'}))
+    assert fetch_section(client, cache, 'https://api.example.org/works', 'token') == ('fetched', {'works': []})
+    assert 'If-None-Match' not in client.requests[1] and client.requests[1]['Cache-Control'] == 'no-cache'
+
+def test_repeated_304_without_cached_copy_is_a_failure(cache):
+    client = CannedClient(response(304), response(304))
+    assert fetch_section(client, cache, 'https://api.example.org/works', 'token')[0] == 'HTTP 304'
+
+def test_invalid_json_is_a_failure(cache):
+    client = CannedClient(response(200, b'<html>Service unavailable</html>', {'ETag': '"1"'}))
+    assert fetch_section(client, cache, 'https://api.example.org/works', 'token')[0] == 'invalid JSON'
+    assert cache.get('https://api.example.org/works') is None
@@ -0,0 +1,63 @@
+'''
+Tests of the load-db command with dumps holding several tokens per user and ORCID iD, as dumps made before token_history was added may
+'''
+import json
+import uuid
+import pytest
+from sqlalchemy.sql import func
+from tests.helpers import delete_tokens
+
+@pytest.fixture
+def prefix(db_app):
+    prefix = f'test-load-{uuid.uuid4().hex[:8]}-'
+    yield prefix
+    delete_tokens(prefix)
+
+def record(id, user_id, orcid, timestamp, access_token):
+    return {'id': id, 'userId': user_id, 'access_token': access_token, 'refresh_token': 'refresh', 'expires_in': 631138518,
+            'token_scope': '/read-limited', 'orcid': orcid, 'timestamp': timestamp}
+
+def load(db_app, tmp_path, records):
+    path = tmp_path / 'dump.jsonl'
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+    return db_app.test_cli_runner().invoke(args=['load-db', '--batch-size', '2', str(path)])
+
+def current(prefix):
+    from orcidflask.models import Token
+    return {(token.userId, token.orcid): (token.id, token.access_token) for token in Token.query.filter(Token.userId.startswith(prefix))}
+
+def history(prefix):
+    from orcidflask.models import TokenHistory
+    return sorted(token.access_token for token in TokenHistory.query.filter(TokenHistory.userId.startswith(prefix)))
+
+def test_newest_token_per_user_and_orcid_is_loaded(db_app, tmp_path, prefix):
+    from orcidflask import db
+    from orcidflask.models import Token, upsert_tokens
+    # Current tokens: one newer than the dump's token for the same user and ORCID iD, one older
+    upsert_tokens([dict(userId=prefix + 'c', orcid='C', access_token='current C', refresh_token='r', expires_in=1, token_scope='s'),
+                   dict(userId=prefix + 'd', orcid='D', access_token='current D', refresh_token='r', expires_in=1, token_scope='s')])
+    Token.query.filter(Token.userId == prefix + 'd').update({'timestamp': '2000-01-01T00:00:00+00:00'}, synchronize_session=False)
+    db.session.commit()
+    base = (db.session.query(func.max(Token.id)).scalar() or 0) + 1000
+    # The newest of the three tokens for A comes first, and the oldest in a later batch
+    records = [record(base + 3, prefix + 'a', 'A', '2020-03-01T00:00:00+00:00', 'A3'),
+               record(base + 2, prefix + 'a', 'A', '2020-02-01T00:00:00+00:00', 'A2'),
+               record(base + 4, prefix + 'b', 'B', '2020-01-01T00:00:00+00:00', 'B'),
+               record(base + 5, prefix + 'c', 'C', '2020-01-01T00:00:00+00:00', 'C old'),
+               record(base + 1, prefix + 'a', 'A', '2020-01-01T00:00:00+00:00', 'A1'),
+               record(base + 6, prefix + 'd', 'D', '2020-01-01T00:00:00+00:00', 'D new')]
+    result = load(db_app, tmp_path, records)
+    assert result.exit_code == 0, result.output
+    assert '3 tokens loaded, 3 superseded tokens copied to token_history and 0 skipped' in result.output
+    tokens = current(prefix)
+    assert {key: access_token for key, (_, access_token) in tokens.items()} == \
+           {(prefix + 'a', 'A'): 'A3', (prefix + 'b', 'B'): 'B', (prefix + 'c', 'C'): 'current C', (prefix + 'd', 'D'): 'D new'}
+    # Loaded tokens keep their ids, so that loading them again skips them
+    assert tokens[(prefix + 'a', 'A')][0] == base + 3 and tokens[(prefix + 'd', 'D')][0] == base + 6
+    assert history(prefix) == ['A1', 'A2', 'C old', 'current D']
+
+    # Loading the same dump again changes nothing
+    result = load(db_app, tmp_path, records)
+    assert result.exit_code == 0, result.output
+    assert '0 tokens loaded, 0 superseded tokens copied to token_history and 6 skipped' in result.output
+    assert history(prefix) == ['A1', 'A2', 'C old', 'current D']
@@ -0,0 +1,75 @@
+'''
+Tests of OrcidClient and request_orcid_token against the stub ORCID token server
+'''
+import time
+import pytest
+from flask import Flask
+from requests.exceptions import ReadTimeout
+from orcid_utils import OrcidClient, CircuitOpenError, request_orcid_token
+
+@pytest.fixture
+def app(stub):
+    app = Flask(__name__)
+    app.config['orcid_token_url'] = stub.url + '/oauth/token'
+    with app.app_context():
+        yield app
+
+def client(**kwargs):
+    # No backoff, so that retries do not slow down the tests
+    return OrcidClient(**{'timeout': (1, 1), 'retries': 2, 'backoff_factor': 0, **kwargs})
+
+def test_success(app, stub):
+    response = request_orcid_token({'code': '0000-0001-2345-6789'}, client=client())
+    assert response.status_code == 200
+    assert response.json()['orcid'] == '0000-0001-2345-6789'
+    assert stub.requests['POST'] == 1
+
+def test_503_is_retried(app, stub):
+    stub.failures.extend([503, 503])
+    response = request_orcid_token({'code': '0000-0001-2345-6789'}, client=client())
+    assert response.status_code == 200
+    assert stub.requests['POST'] == 3
+
+def test_retries_are_limited(app, stub):
+    stub.failures.extend([503] * 5)
+    response = request_orcid_token({'code': '0000-0001-2345-6789'}, client=client())
+    assert response.status_code == 503
+    assert stub.requests['POST'] == 3
+
+def test_500_is_not_retried_for_post(app, stub):
+    # ORCID may have consumed the code already, so posting it again would fail with invalid_grant
+    stub.failures.append(500)
+    response = request_orcid_token({'code': '0000-0001-2345-6789'}, client=client())
+    assert response.status_code == 500
+    assert stub.requests['POST'] == 1
+
+def test_500_is_retried_for_get(app, stub):
+    stub.failures.append(500)
+    response = client().get(stub.url + '/v3.0/0000-0001-2345-6789/record', headers={'Authorization': 'Bearer token'})
+    assert response.status_code == 200
+    assert stub.requests['GET'] == 2
+
+def test_read_timeout_is_not_retried_for_post(app, stub):
+    stub.delay = 1.5
+    with pytest.raises(ReadTimeout):
+        request_orcid_token({'code': '0000-0001-2345-6789'}, client=client())
+    assert stub.requests['POST'] == 1
+
+def test_circuit_opens_after_consecutive_failures(app, stub):
+    orcid = client(retries=0, failure_threshold=2, reset_timeout=60)
+    stub.failures.extend([503, 503])
+    for _ in range(2):
+        assert request_orcid_token({'code': '0000-0001-2345-6789'}, client=orcid).status_code == 503
+    with pytest.raises(CircuitOpenError):
+        request_orcid_token({'code': '0000-0001-2345-6789'}, client=orcid)
+    # The last call was refused without contacting ORCID
+    assert stub.requests['POST'] == 2
+
+def test_circuit_closes_after_reset_timeout(app, stub):
+    orcid = client(retries=0, failure_threshold=1, reset_timeout=0.2)
+    stub.failures.append(503)
+    request_orcid_token({'code': '0000-0001-2345-6789'}, client=orcid)
+    with pytest.raises(CircuitOpenError):
+        request_orcid_token({'code': '0000-0001-2345-6789'}, client=orcid)
+    time.sleep(0.3)
+    assert request_orcid_token({'code': '0000-0001-2345-6789'}, client=orcid).status_code == 200
@@ -0,0 +1,74 @@
+'''
+Tests of pushing works to a record (see orcidflask.push.push_record), against the stub ORCID API, and against canned responses for failures part way through
+'''
+import json
+import requests
+from orcid_utils import OrcidClient
+from orcidflask.push import push_record, BULK_LIMIT
+
+ORCID = '0000-0001-2345-6789'
+
+def works(count, start=0):
+    return [(f'key{i}', {'title': {'title': {'value': f'Work {i}'}}, 'type': 'journal-article'}) for i in range(start, start + count)]
+
+def response(status, data):
+    response = requests.Response()
+    response.status_code = status
+    response._content = data if isinstance(data, bytes) else json.dumps(data).encode()
+    return response
+
+def created(chunk, start):
+    return response(200, {'bulk': [{'work': {**work, 'put-code': start + i}} for i, (_, work) in enumerate(chunk)]})
+
+class CannedClient:
+    '''
+    Returns the provided responses (or raises the provided exceptions) to POSTs in turn
+    '''
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def post(self, url, **kwargs):
+        result = self.responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+def test_created_in_bulk(stub):
+    client = OrcidClient(timeout=(1, 1), retries=0)
+    creates = works(BULK_LIMIT + 10)
+    results = push_record(client, stub.url + '/v3.0', ORCID, 'token', creates, [])
+    assert [(key, outcome, put_code) for key, outcome, put_code, _ in results] == \
+           [(key, 'created', put_code) for put_code, (key, _) in enumerate(creates, 1)]
+    assert stub.requests['POST'] == 2
+
+def test_updated_and_recreated(stub):
+    client = OrcidClient(timeout=(1, 1), retries=0)
+    (key0, work0), (key1, work1) = works(2)
+    # The first update fails as if the work had been deleted from the record, so it is added again
+    stub.failures.append(404)
+    results = push_record(client, stub.url + '/v3.0', ORCID, 'token', [], [(key0, 10, work0), (key1, 11, work1)])
+    assert sorted(results) == [(key0, 'created', 1, None), (key1, 'updated', 11, None)]
+
+def test_errors_in_bulk_response():
+    (key0, _), (key1, work1) = creates = works(2)
+    client = CannedClient(response(200, {'bulk': [{'error': {'response-code': 409, 'developer-message': 'Duplicate'}},
+                                                  {'work': {**work1, 'put-code': 7}}]}))
+    assert push_record(client, 'https://api.example.org/v3.0', ORCID, 'token', creates, []) == \
+           [(key0, 'HTTP 409', None, 'Duplicate'), (key1, 'created', 7, None)]
+
+def test_invalid_response_fails_only_its_chunk():
+    creates = works(BULK_LIMIT * 3)
+    first, second, third = creates[:BULK_LIMIT], creates[BULK_LIMIT:BULK_LIMIT * 2], creates[BULK_LIMIT * 2:]
+    client = CannedClient(created(first, 1), response(200, b'<html>Bad gateway</html>'), response(200, {'bulk': [{'put-code': 1}]}))
+    results = push_record(client, 'https://api.example.org/v3.0', ORCID, 'token', creates, [])
+    assert [outcome for _, outcome, _, _ in results] == ['created'] * BULK_LIMIT + ['invalid response'] * BULK_LIMIT * 2
+    assert [put_code for _, _, put_code, _ in results[:BULK_LIMIT]] == list(range(1, BULK_LIMIT + 1))
+
+def test_created_works_are_returned_when_a_later_chunk_fails():
+    creates = works(BULK_LIMIT * 2)
+    client = CannedClient(created(creates[:BULK_LIMIT], 1), requests.exceptions.ConnectionError('Connection refused'))
+    results = push_record(client, 'https://api.example.org/v3.0', ORCID, 'token', creates, [])
+    assert [outcome for _, outcome, _, _ in results] == ['created'] * BULK_LIMIT + ['ConnectionError'] * BULK_LIMIT
+    client = CannedClient(created(creates[:BULK_LIMIT], 1), RuntimeError('Unexpected'))
+    results = push_record(client, 'https://api.example.org/v3.0', ORCID, 'token', creates, [])
+    assert [outcome for _, outcome, _, _ in results] == ['created'] * BULK_LIMIT + ['RuntimeError'] * BULK_LIMIT
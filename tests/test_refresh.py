@@ -0,0 +1,84 @@
+'''
+Tests of the refresh-tokens command against the stub ORCID token server. These use the database (see the db_app fixture).
+'''
+import uuid
+import pytest
+from tests.helpers import seed_tokens, delete_tokens
+
+ROWS = 3
+
+@pytest.fixture
+def app(db_app, stub, monkeypatch):
+    '''
+    The app, with ORCID's token endpoint pointed at the stub, and ROWS expired test tokens to which the refresh is limited
+    '''
+    from orcidflask import db
+    from orcidflask import refresh
+    from orcidflask.models import Token
+    app = db_app
+    app.config['orcid_token_url'] = stub.url + '/oauth/token'
+    # Every failure is counted once, and quickly
+    app.config.update(ORCID_HTTP_RETRIES=0, ORCID_HTTP_BACKOFF=0, ORCID_HTTP_TIMEOUT=(1, 1))
+    prefix = f'test-refresh-{uuid.uuid4().hex[:8]}-'
+    expiring_criteria = refresh.expiring_criteria
+    monkeypatch.setattr(refresh, 'expiring_criteria', lambda within: expiring_criteria(within) + [Token.userId.startswith(prefix)])
+    seed_tokens(ROWS, prefix)
+    Token.query.filter(Token.userId.startswith(prefix)).update({'expires_in': 0}, synchronize_session=False)
+    db.session.commit()
+    app.prefix = prefix
+    yield app
+    db.session.rollback()
+    delete_tokens(prefix)
+
+def tokens(app):
+    from orcidflask.models import Token
+    return {token.userId: token for token in Token.query.filter(Token.userId.startswith(app.prefix))}
+
+def history_count(app):
+    from orcidflask.models import TokenHistory
+    return TokenHistory.query.filter(TokenHistory.userId.startswith(app.prefix)).count()
+
+def refresh_tokens(app, *args):
+    return app.test_cli_runner().invoke(args=['refresh-tokens', '--workers', '1', *args])
+
+def test_refresh(app, stub):
+    before = {user_id: token.access_token for user_id, token in tokens(app).items()}
+    result = refresh_tokens(app)
+    assert result.exit_code == 0, result.output
+    assert f'refreshed: {ROWS}' in result.output
+    assert stub.requests['POST'] == ROWS
+    after = tokens(app)
+    # The tokens are replaced, and the old ones kept in token_history
+    assert set(after) == set(before)
+    assert all(token.access_token != before[user_id] and token.expires_in == 631138518 for user_id, token in after.items())
+    assert history_count(app) == ROWS
+
+def test_http_failures_are_counted_by_status(app, stub):
+    stub.failures.extend([400, 503])
+    result = refresh_tokens(app)
+    assert result.exit_code != 0
+    assert 'refreshed: 1' in result.output
+    assert 'HTTP 400: 1' in result.output
+    assert 'HTTP 503: 1' in result.output
+    assert '2 tokens could not be refreshed' in result.output
+    # Only the refreshed token is replaced
+    assert sum(token.expires_in == 631138518 for token in tokens(app).values()) == 1
+    assert history_count(app) == 1
+
+def test_connection_errors_are_counted_by_type(app, stub):
+    # Nothing listens on the stub's port once it is closed
+    stub.shutdown()
+    stub.server_close()
+    result = refresh_tokens(app)
+    assert result.exit_code != 0
+    assert f'ConnectionError: {ROWS}' in result.output
+    assert f'{ROWS} tokens could not be refreshed' in result.output
+    assert all(token.expires_in == 0 for token in tokens(app).values())
+
+def test_dry_run_makes_no_requests(app, stub):
+    result = refresh_tokens(app, '--dry-run')
+    assert result.exit_code == 0, result.output
+    assert f'would refresh: {ROWS}' in result.output
+    assert sum(stub.requests.values()) == 0
+    assert all(token.expires_in == 0 for token in tokens(app).values())
+    assert history_count(app) == 0
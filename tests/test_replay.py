@@ -0,0 +1,133 @@
+'''
+Tests of detecting replayed SAML responses (see orcidflask.replay): the caches' seen and claim, and the ACS rejecting a response submitted again, before verifying its signature. The tests of the 'sqlalchemy' cache and of the ACS use the database (see the db_app fixture).
+'''
+import uuid
+from datetime import datetime, timedelta, timezone
+import pytest
+from orcidflask.replay import MemoryReplayCache, SQLReplayCache
+from tests.helpers import FakeIdp
+
+RELAY_STATE = 'https://localhost/orcid?scopes=%2Fread-limited'
+
+@pytest.fixture(params=['memory', 'sqlalchemy'])
+def backend(request):
+    if request.param == 'sqlalchemy':
+        request.getfixturevalue('db_app')
+    return request.param
+
+@pytest.fixture
+def ids(request):
+    '''
+    Returns new IDs, which are deleted from the saml_replay table afterwards by the tests that use the database
+    '''
+    prefix = f'_test-replay-{uuid.uuid4().hex[:8]}-'
+    count = iter(range(1000))
+    yield lambda: prefix + str(next(count))
+    if 'db_app' in request.fixturenames:
+        from orcidflask import db
+        from orcidflask.models import SamlReplay
+        db.session.rollback()
+        SamlReplay.query.filter(SamlReplay.id.startswith(prefix)).delete(synchronize_session=False)
+        db.session.commit()
+
+def new_cache(backend):
+    return SQLReplayCache() if backend == 'sqlalchemy' else MemoryReplayCache()
+
+def test_claim_rejects_second_submission(backend, ids):
+    cache = new_cache(backend)
+    response_id, assertion_id = ids(), ids()
+    assert not cache.seen([response_id, assertion_id])
+    assert cache.claim([response_id, assertion_id], 60)
+    assert cache.seen([response_id, assertion_id])
+    assert not cache.claim([response_id, assertion_id], 60)
+
+def test_claim_rejects_reused_assertion(backend, ids):
+    # E.g., an assertion wrapped in a new response
+    cache = new_cache(backend)
+    assertion_id = ids()
+    assert cache.claim([ids(), assertion_id], 60)
+    response_id = ids()
+    assert cache.seen([response_id, assertion_id])
+    assert not cache.claim([response_id, assertion_id], 60)
+
+def test_sql_cache_is_shared_between_processes(db_app, ids):
+    # Each worker process has its own cache
+    first, second = SQLReplayCache(), SQLReplayCache()
+    response_id = ids()
+    assert first.claim([response_id], 60)
+    assert second.seen([response_id])
+    assert not second.claim([response_id], 60)
+
+def test_sql_cache_expired_id_can_be_claimed_again(db_app, ids):
+    from orcidflask import db
+    from orcidflask.models import SamlReplay
+    response_id = ids()
+    assert SQLReplayCache().claim([response_id], 60)
+    SamlReplay.query.filter_by(id=response_id).update({'expires': datetime.now(timezone.utc) - timedelta(seconds=1)}, synchronize_session=False)
+    db.session.commit()
+    cache = SQLReplayCache()
+    assert not cache.seen([response_id])
+    assert cache.claim([response_id], 60)
+
+@pytest.fixture
+def acs(db_app, backend, monkeypatch):
+    '''
+    The app, trusting a fake IdP (as app.idp), with the provided replay cache. Validations of SAML responses are counted in app.validations.
+    '''
+    from onelogin.saml2.response import OneLogin_Saml2_Response
+    from orcidflask import replay
+    idp = FakeIdp(db_app.config['SAML_PATH'])
+    db_app.config.update(SAML_PATH=idp.saml_path, SAML_REPLAY_CACHE=backend)
+    monkeypatch.setattr(replay, '_caches', {})
+    db_app.validations = 0
+    is_valid = OneLogin_Saml2_Response.is_valid
+
+    def counting_is_valid(self, *args, **kwargs):
+        db_app.validations += 1
+        return is_valid(self, *args, **kwargs)
+    monkeypatch.setattr(OneLogin_Saml2_Response, 'is_valid', counting_is_valid)
+    db_app.idp = idp
+    yield db_app
+    from orcidflask import db
+    from orcidflask.models import SamlReplay
+    db.session.rollback()
+    # The IDs claimed by the app are also kept in the cache's memory
+    cache = replay._caches and next(iter(replay._caches.values()))
+    if isinstance(cache, SQLReplayCache):
+        SamlReplay.query.filter(SamlReplay.id.in_(list(cache.local.cache.entries))).delete(synchronize_session=False)
+        db.session.commit()
+    idp.tmp.cleanup()
+
+def submit(app, client, saml_response):
+    '''
+    Posts a SAML response to the ACS, returning whether the user was logged in
+    '''
+    response = client.post('/?acs', data={'SAMLResponse': saml_response, 'RelayState': RELAY_STATE}, base_url='https://localhost')
+    assert response.status_code == 302
+    return response.location == RELAY_STATE
+
+def test_replayed_response_is_rejected_before_validation(acs):
+    saml_response = acs.idp.response('jdoe', {'firstname': 'Jane'})
+    assert submit(acs, acs.test_client(), saml_response)
+    assert acs.validations == 1
+    # Submitted again, e.g., by someone who captured it
+    assert not submit(acs, acs.test_client(), saml_response)
+    assert acs.validations == 1
+
+def test_concurrent_submission_is_rejected_by_claim(acs, monkeypatch):
+    from orcidflask.replay import get_replay_cache
+    saml_response = acs.idp.response('jdoe', {'firstname': 'Jane'})
+    assert submit(acs, acs.test_client(), saml_response)
+    # As if both had passed the precheck before either was claimed
+    with acs.app_context():
+        monkeypatch.setattr(get_replay_cache(), 'seen', lambda ids: False)
+    assert not submit(acs, acs.test_client(), saml_response)
+    assert acs.validations == 2
+
+def test_resubmission_by_logged_in_user_continues(acs):
+    # E.g., after the browser's back button
+    saml_response = acs.idp.response('jdoe', {'firstname': 'Jane'})
+    client = acs.test_client()
+    assert submit(acs, client, saml_response)
+    assert submit(acs, client, saml_response)
+    assert acs.validations == 1
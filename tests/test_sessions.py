@@ -0,0 +1,169 @@
+'''
+Tests of server-side sessions (see orcidflask.sessions): expiry, and a new session id upon login (regenerate). These run against both stores; those of the 'sqlalchemy' store use the database (see the db_app fixture).
+'''
+import time
+from datetime import timedelta
+import pytest
+from flask import Flask, Blueprint, session
+from sqlalchemy.sql import func
+from orcidflask.sessions import ServerSideSessionInterface, MemorySessionStore, SQLSessionStore
+
+TTL = 60
+
+routes = Blueprint('test_sessions', __name__)
+
+@routes.route('/set/<value>')
+def set_value(value):
+    session['value'] = value
+    return ''
+
+@routes.route('/get')
+def get_value():
+    return session.get('value', '')
+
+@routes.route('/login')
+def login():
+    session.regenerate()
+    session['user'] = 'jdoe'
+    return ''
+
+@routes.route('/logout')
+def logout():
+    session.clear()
+    return ''
+
+@pytest.fixture(params=['memory', 'sqlalchemy'])
+def app(request):
+    if request.param == 'memory':
+        app = Flask(__name__)
+        app.secret_key = 'test'
+        store = MemorySessionStore()
+    else:
+        app = request.getfixturevalue('db_app')
+        store = SQLSessionStore()
+    app.session_interface = ServerSideSessionInterface(store, ttl=TTL, purge_interval=3600)
+    app.register_blueprint(routes, url_prefix='/test-sessions')
+    # The session ids written, to delete afterwards
+    app.sids = set()
+    save = store.save
+
+    def recording_save(sid, data, ttl):
+        app.sids.add(sid)
+        save(sid, data, ttl)
+    store.save = recording_save
+    yield app
+    if request.param == 'sqlalchemy':
+        from orcidflask import db
+        from orcidflask.models import WebSession
+        db.session.rollback()
+        WebSession.query.filter(WebSession.id.in_(app.sids)).delete(synchronize_session=False)
+        db.session.commit()
+
+def get(client, path):
+    response = client.get('/test-sessions' + path)
+    assert response.status_code == 200
+    return response
+
+def session_id(app, client):
+    cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'], domain=app.config['SESSION_COOKIE_DOMAIN'] or 'localhost')
+    return app.session_interface.get_signer(app).unsign(cookie.value).decode() if cookie else None
+
+def set_session_cookie(app, client, value):
+    client.set_cookie(app.config['SESSION_COOKIE_NAME'], value, domain=app.config['SESSION_COOKIE_DOMAIN'] or 'localhost')
+
+def stored(app, sid):
+    data = app.session_interface.store.load(sid)
+    return data and app.session_interface.serializer.loads(data)
+
+def present(app, sid):
+    '''
+    Returns True if the store still holds the session, expired or not
+    '''
+    store = app.session_interface.store
+    if isinstance(store, MemorySessionStore):
+        return sid in store.cache.entries
+    from orcidflask.models import WebSession
+    return WebSession.query.get(sid) is not None
+
+def expire(app, sid):
+    '''
+    Moves the expiry of the stored session into the past, as if TTL seconds had passed since it was last modified
+    '''
+    store = app.session_interface.store
+    if isinstance(store, MemorySessionStore):
+        value, _ = store.cache.entries[sid]
+        store.cache.entries[sid] = (value, time.monotonic() - 1)
+    else:
+        from orcidflask import db
+        from orcidflask.models import WebSession
+        WebSession.query.filter_by(id=sid).update({'expires': func.now() - timedelta(seconds=1)}, synchronize_session=False)
+        db.session.commit()
+
+def test_session_is_stored_server_side(app):
+    client = app.test_client()
+    assert 'Set-Cookie' not in get(client, '/get').headers
+    get(client, '/set/a')
+    sid = session_id(app, client)
+    assert stored(app, sid) == {'value': 'a'}
+    assert get(client, '/get').data == b'a'
+    # Unmodified sessions are not written again
+    assert 'Set-Cookie' not in get(client, '/get').headers
+
+def test_expired_session_is_not_loaded(app):
+    client = app.test_client()
+    get(client, '/set/a')
+    sid = session_id(app, client)
+    expire(app, sid)
+    assert stored(app, sid) is None
+    assert get(client, '/get').data == b''
+    # The expired session's id is not reused
+    get(client, '/set/b')
+    assert session_id(app, client) != sid
+    assert get(client, '/get').data == b'b'
+
+def test_expired_sessions_are_purged(app):
+    client = app.test_client()
+    get(client, '/set/a')
+    expired = session_id(app, client)
+    other = app.test_client()
+    get(other, '/set/b')
+    expire(app, expired)
+    assert present(app, expired)
+    assert app.session_interface.store.purge_expired() >= 1
+    assert not present(app, expired)
+    assert stored(app, session_id(app, other)) == {'value': 'b'}
+
+def test_login_rotates_session_id(app):
+    client = app.test_client()
+    get(client, '/set/a')
+    before = session_id(app, client)
+    get(client, '/login')
+    after = session_id(app, client)
+    assert after != before
+    # The data moves to the new id, and the old id can no longer be used
+    assert stored(app, after) == {'value': 'a', 'user': 'jdoe'}
+    assert stored(app, before) is None
+    # E.g., by whoever fixed it in the user's browser before login
+    attacker = app.test_client()
+    set_session_cookie(app, attacker, app.session_interface.get_signer(app).sign(before).decode())
+    assert get(attacker, '/get').data == b''
+
+def test_login_without_session(app):
+    client = app.test_client()
+    get(client, '/login')
+    assert stored(app, session_id(app, client)) == {'user': 'jdoe'}
+
+def test_logout_deletes_session(app):
+    client = app.test_client()
+    get(client, '/set/a')
+    sid = session_id(app, client)
+    get(client, '/logout')
+    assert stored(app, sid) is None
+    assert session_id(app, client) is None
+
+def test_tampered_cookie_is_ignored(app):
+    client = app.test_client()
+    get(client, '/set/a')
+    sid = session_id(app, client)
+    set_session_cookie(app, client, sid + '.forged')
+    assert get(client, '/get').data == b''
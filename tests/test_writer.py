@@ -0,0 +1,34 @@
+'''
+Tests of the per-process BatchedTokenWriter
+'''
+import threading
+import time
+from flask import Flask
+from orcidflask import writer
+
+def test_one_writer_per_process(monkeypatch):
+    app = Flask(__name__)
+    app.config.update(TOKEN_WRITE_BATCH_SIZE=10, TOKEN_WRITE_BATCH_WAIT=0.01)
+    created = []
+
+    class SlowWriter:
+        # Slow to create, so that concurrent callers all find no writer unless creation is locked
+        def __init__(self, app, **kwargs):
+            time.sleep(0.05)
+            created.append(self)
+    monkeypatch.setattr(writer, 'BatchedTokenWriter', SlowWriter)
+    monkeypatch.setattr(writer, '_writers', {})
+    barrier = threading.Barrier(8)
+    writers = []
+
+    def get():
+        with app.app_context():
+            barrier.wait()
+            writers.append(writer.get_token_writer())
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == 1
+    assert all(w is created[0] for w in writers)
@@ -0,0 +1,8 @@
+'''
+Entry point for running the web app under gunicorn (see gunicorn.conf.py and the Dockerfile): gunicorn -c gunicorn.conf.py web:app
+(This module is not named wsgi.py, since the flask command would then load it when run without FLASK_APP, e.g., for --help.) Unlike the flask command, which creates the app with only what its commands need, this also loads the encryption keys and SAML settings, so that with preload_app they are loaded once, before the workers are forked.
+'''
+from orcidflask import create_app, preload
+
+app = create_app()
+preload(app)